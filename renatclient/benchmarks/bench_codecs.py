@@ -0,0 +1,59 @@
+# Copyright (C) 2014 Stefan C. Mueller
+"""
+Throughput and size of the value codecs of `WebClient`.
+
+Measures the complete value encoding, compression plus encryption and base64,
+for each codec and payload size. Payloads are either JSON-like text or
+random bytes, which do not compress at all.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import timeit
+
+from renat import webclient
+
+KEY = "x" * 16
+
+
+def text_payload(size):
+    rng = random.Random(42)
+    words = ["record", "version", "value", "id", "true", "false", "null", "key"]
+    items = []
+    while len(json.dumps(items)) < size:
+        items.append({rng.choice(words): rng.randint(0, 100000)})
+    return json.dumps(items)[:size]
+
+
+def measure(codec, payload, number):
+    encoded = webclient._encrypt_value(KEY, payload, codec)
+    encode = timeit.timeit(lambda: webclient._encrypt_value(KEY, payload, codec), number=number)
+    decode = timeit.timeit(lambda: webclient._decrypt_value(KEY, encoded), number=number)
+    return len(encoded), encode / number * 1e6, decode / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="16,64,256,1024,4096,65536", help="comma separated payload sizes in bytes")
+    parser.add_argument("--time", type=float, default=0.2, help="approximate seconds per measurement")
+    args = parser.parse_args()
+
+    codecs = ["none", "zlib", "bz2", "auto"]
+    if webclient.lzma is not None:
+        codecs.insert(3, "lzma")
+
+    print("%-7s %-6s %8s %8s %10s %10s" % ("payload", "codec", "size", "encoded", "encode us", "decode us"))
+    for size in [int(s) for s in args.sizes.split(",")]:
+        for kind, payload in (("text", text_payload(size)), ("random", os.urandom(size))):
+            # calibrate the number of repetitions with the slowest codec.
+            number = max(1, int(args.time / max(1e-6, timeit.timeit(lambda: webclient._encrypt_value(KEY, payload, "bz2"), number=1))))
+            for codec in codecs:
+                encoded_size, encode_us, decode_us = measure(codec, payload, number)
+                print("%-7s %-6s %8d %8d %10.1f %10.1f" % (kind, codec, size, encoded_size, encode_us, decode_us))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# Copyright (C) 2014 Stefan C. Mueller
+"""
+Reactor responsiveness and throughput of `WebClient` under a burst of
+concurrent puts and gets, with encryption on the reactor thread or on
+the crypto threads.
+
+Needs a running server. While the burst is in flight, a timer that should
+fire every 10 ms records how late it actually fires. That delay is what
+every other request on the same reactor waits in addition to the network.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import timeit
+
+from twisted.internet import reactor, defer, task
+
+from renat import webclient
+
+TICK = 0.01
+
+
+@defer.inlineCallbacks
+def measure(server, threads, inline_size, count, size):
+    client = webclient.WebClient(server, os.urandom(16), crypto_threads=threads, inline_size=inline_size)
+    # warm up connections and threads.
+    yield client.put("warmup", os.urandom(size))
+
+    lags = []
+    last = [timeit.default_timer()]
+    def tick():
+        now = timeit.default_timer()
+        lags.append(now - last[0] - TICK)
+        last[0] = now
+    ticker = task.LoopingCall(tick)
+    ticker.start(TICK, now=False)
+
+    values = [os.urandom(size) for _ in range(256)]
+    start = timeit.default_timer()
+    versions = yield defer.gatherResults([client.put("key%s" % i, values[i % len(values)]) for i in range(count)])
+    yield defer.gatherResults([client.get("key%s" % i, version) for i, version in enumerate(versions)])
+    elapsed = timeit.default_timer() - start
+
+    ticker.stop()
+    yield client.close()
+
+    lags.sort()
+    lags = lags or [0.0]
+    defer.returnValue({"ops_per_s": 2 * count / elapsed,
+                       "lag_p50_ms": lags[len(lags) // 2] * 1000,
+                       "lag_p99_ms": lags[int(len(lags) * 0.99)] * 1000,
+                       "lag_max_ms": lags[-1] * 1000})
+
+
+@defer.inlineCallbacks
+def run(args):
+    print("%s puts and gets of %s byte values" % (args.count, args.size))
+    try:
+        for threads, inline_size in ((0, 0), (args.threads, args.inline_size), (args.threads, 0)):
+            result = yield measure(args.server, threads, inline_size, args.count, args.size)
+            print("threads %2d, inline below %5d: %8.0f ops/s, reactor lag p50 %6.1f ms, p99 %6.1f ms, max %6.1f ms" % (
+                threads, inline_size, result["ops_per_s"], result["lag_p50_ms"], result["lag_p99_ms"], result["lag_max_ms"]))
+    finally:
+        reactor.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--server", default="http://localhost:8888")
+    parser.add_argument("--count", type=int, default=500, help="number of concurrent puts, then gets")
+    parser.add_argument("--size", type=int, default=512, help="plaintext size in bytes")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--inline-size", type=int, default=512)
+    args = parser.parse_args()
+    reactor.callWhenRunning(run, args)
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main()
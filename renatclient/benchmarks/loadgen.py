@@ -0,0 +1,359 @@
+# Copyright (C) 2014 Stefan C. Mueller
+"""
+End-to-end load generator for the server and `WebClient`.
+
+Starts a local server (unless `--server` is given) and stores one version
+for each of `--keys` keys. Then, for `--duration` seconds, `--concurrency`
+workers each run one operation after the other, picked at random with the
+weights of `--mix`:
+
+    put      stores a new version of a random key.
+    get      gets a random recent version of a random key.
+    jungest  gets the jungest version of a random key.
+    oldest   gets the oldest version of a random key.
+
+At the same time `--pollers` long-polls wait with `get(key, version + 1, wait=True)`
+for the next version of random keys. Their latency (`poll`) is the time until
+one of the workers put that version.
+
+Every second the RSS of the server processes and the waiter counts from its
+`/stats` are sampled. With several server processes `/stats` only describes
+the process that answered. The result is written as JSON, so that releases
+can be compared::
+
+    python -m benchmarks.loadgen --duration 30 --output result.json
+"""
+from __future__ import print_function
+
+import argparse
+import bisect
+import collections
+import datetime
+import json
+import os
+import random
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import time
+import timeit
+
+from twisted.internet import reactor, defer, task
+
+from renat import webclient, httpclient
+
+#: Directory from which the server is started.
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "renatserver")
+
+#: Metrics of `/stats` that are sampled.
+SERVER_STATS = ("records", "get_waiters", "limit_waiters", "any_waiters", "woken_waiters")
+
+#: Recent versions per key that `get` chooses from.
+RECENT_VERSIONS = 10
+
+
+def start_server(python, port, server_args, log):
+    """
+    Starts a server in its own process group and waits until it accepts connections.
+    
+    :param log: File to which the output of the server is written.
+    """
+    with open(log, "w") as output:
+        process = subprocess.Popen([python, "-m", "renatserver.server", "--port=%s" % port] + server_args,
+                                   cwd=SERVER_DIR, preexec_fn=os.setsid, stdout=output, stderr=subprocess.STDOUT)
+    deadline = time.time() + 10
+    while True:
+        try:
+            socket.create_connection(("localhost", port), timeout=1).close()
+            return process
+        except socket.error:
+            if process.poll() is not None or time.time() > deadline:
+                stop_server(process)
+                raise RuntimeError("The server did not start.")
+            time.sleep(0.1)
+
+
+def stop_server(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except OSError:
+        pass
+    process.wait()
+
+
+def rss(pid):
+    """
+    Returns the resident memory of the process and its descendants in bytes,
+    or `None` if it cannot be read from `/proc`.
+    """
+    try:
+        with open("/proc/%s/status" % pid) as f:
+            size = sum(int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS:"))
+        with open("/proc/%s/task/%s/children" % (pid, pid)) as f:
+            children = [int(child) for child in f.read().split()]
+    except (IOError, OSError):
+        return None
+    for child in children:
+        size += rss(child) or 0
+    return size
+
+
+def parse_stats(text):
+    """
+    Returns a dict with the values of the metrics without labels of a `/stats` response.
+    """
+    stats = {}
+    for line in text.splitlines():
+        if line.startswith("renat_") and "{" not in line:
+            name, value = line.rsplit(" ", 1)
+            stats[name[len("renat_"):]] = float(value)
+    return stats
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class LoadState(object):
+    """
+    Keys and the versions put so far, shared by the workers and pollers.
+    """
+
+    def __init__(self, keys, value_size, rng):
+        self.rng = rng
+        self.keys = ["key%s" % i for i in range(keys)]
+        self.values = [os.urandom(value_size) for _ in range(64)]
+
+        #: maps the key to the last `RECENT_VERSIONS` versions put.
+        self.versions = dict((key, []) for key in self.keys)
+
+        #: maps the operation to the list of latencies in seconds.
+        self.latencies = collections.defaultdict(list)
+
+        #: maps the operation to the number of failures.
+        self.errors = collections.Counter()
+
+        self.stopping = False
+
+    def random_key(self):
+        return self.rng.choice(self.keys)
+
+    def random_value(self):
+        return self.rng.choice(self.values)
+
+    def stored(self, key, version):
+        versions = self.versions[key]
+        versions.append(version)
+        del versions[:-RECENT_VERSIONS]
+
+    def jungest(self, key):
+        versions = self.versions[key]
+        return max(versions) if versions else 0
+
+
+@defer.inlineCallbacks
+def put_key(client, state, key):
+    version = yield client.put(key, state.random_value())
+    state.stored(key, version)
+
+
+@defer.inlineCallbacks
+def put_all(client, state, concurrency):
+    """
+    Puts a new version of every key, `concurrency` at a time.
+    """
+    for i in range(0, len(state.keys), concurrency):
+        yield defer.gatherResults([put_key(client, state, key) for key in state.keys[i:i + concurrency]])
+
+
+def do_put(client, state):
+    return put_key(client, state, state.random_key())
+
+
+@defer.inlineCallbacks
+def do_get(client, state):
+    key = state.random_key()
+    yield client.get(key, state.rng.choice(state.versions[key]))
+
+
+def do_jungest(client, state):
+    return client.get_jungest(state.random_key())
+
+
+def do_oldest(client, state):
+    return client.get_oldest(state.random_key())
+
+
+OPERATIONS = {"put": do_put, "get": do_get, "jungest": do_jungest, "oldest": do_oldest}
+
+
+def parse_mix(mix):
+    """
+    Parses `"put=4,get=4"` into a list of operations and their cumulative weights.
+    """
+    operations, weights = [], []
+    for item in mix.split(","):
+        name, weight = item.split("=")
+        if name not in OPERATIONS:
+            raise ValueError("Unknown operation %s" % repr(name))
+        operations.append(name)
+        weights.append((weights[-1] if weights else 0) + float(weight))
+    return operations, weights
+
+
+@defer.inlineCallbacks
+def worker(client, state, mix, end):
+    operations, weights = mix
+    while timeit.default_timer() < end:
+        op = operations[bisect.bisect_right(weights, state.rng.random() * weights[-1])]
+        start = timeit.default_timer()
+        try:
+            yield OPERATIONS[op](client, state)
+        except Exception:
+            state.errors[op] += 1
+        else:
+            state.latencies[op].append(timeit.default_timer() - start)
+
+
+@defer.inlineCallbacks
+def poller(client, state):
+    while not state.stopping:
+        key = state.random_key()
+        start = timeit.default_timer()
+        try:
+            yield client.get(key, state.jungest(key) + 1, wait=True)
+        except Exception:
+            state.errors["poll"] += 1
+        else:
+            state.latencies["poll"].append(timeit.default_timer() - start)
+
+
+@defer.inlineCallbacks
+def sample(client, url, pid, samples, start):
+    entry = {"time_s": timeit.default_timer() - start, "rss_bytes": rss(pid) if pid else None}
+    try:
+        text = yield httpclient.request("GET", url + "/stats", pool=client.pools[url], proxy="")
+    except Exception:
+        pass
+    else:
+        stats = parse_stats(text)
+        for name in SERVER_STATS:
+            entry[name] = stats.get(name)
+    samples.append(entry)
+
+
+def summarize(args, state, samples, elapsed):
+    result = {"started": args.started,
+              "python": sys.version.split()[0],
+              "config": dict((name, value) for name, value in vars(args).items() if name != "started"),
+              "duration_s": elapsed,
+              "ops": {},
+              "server": {},
+              "samples": samples}
+    total = 0
+    for op in sorted(set(state.latencies) | set(state.errors)):
+        latencies = sorted(state.latencies[op])
+        total += len(latencies)
+        entry = {"count": len(latencies), "errors": state.errors[op], "ops_per_s": len(latencies) / elapsed}
+        if latencies:
+            for name, fraction in (("p50_ms", 0.5), ("p99_ms", 0.99), ("p999_ms", 0.999)):
+                entry[name] = percentile(latencies, fraction) * 1000
+            entry["max_ms"] = latencies[-1] * 1000
+        result["ops"][op] = entry
+    result["ops_per_s"] = total / elapsed
+
+    for name in ("rss_bytes",) + SERVER_STATS:
+        values = [entry[name] for entry in samples if entry.get(name) is not None]
+        if values:
+            result["server"][name + "_max"] = max(values)
+            result["server"][name + "_end"] = values[-1]
+    return result
+
+
+def print_result(result):
+    print("%.0f ops/s in %.1f s" % (result["ops_per_s"], result["duration_s"]))
+    for op, entry in sorted(result["ops"].items()):
+        print("  %-8s %8d ops %8.0f ops/s %6d errors  p50 %8.2f ms  p99 %8.2f ms  p999 %8.2f ms" % (
+            op, entry["count"], entry["ops_per_s"], entry["errors"],
+            entry.get("p50_ms", 0), entry.get("p99_ms", 0), entry.get("p999_ms", 0)))
+    server = result["server"]
+    if "rss_bytes_max" in server:
+        print("  server rss max %.1f MB" % (server["rss_bytes_max"] / 1e6))
+    if "get_waiters_max" in server:
+        print("  waiters max: get %d, limit %d, any %d" % (
+            server["get_waiters_max"], server["limit_waiters_max"], server["any_waiters_max"]))
+
+
+@defer.inlineCallbacks
+def run(args, url, pid):
+    try:
+        client = webclient.WebClient(url, "loadgen", proxy="")
+        state = LoadState(args.keys, args.size, random.Random(args.seed))
+        mix = parse_mix(args.mix)
+
+        yield put_all(client, state, args.concurrency)
+
+        start = timeit.default_timer()
+        samples = []
+        sampler = task.LoopingCall(sample, client, url, pid, samples, start)
+        sampler.start(1.0)
+
+        pollers = [poller(client, state) for _ in range(args.pollers)]
+        end = start + args.duration
+        yield defer.gatherResults([worker(client, state, mix, end) for _ in range(args.concurrency)])
+        elapsed = timeit.default_timer() - start
+        sampler.stop()
+        yield sample(client, url, pid, samples, start)
+
+        # a new version of every key releases the pollers.
+        state.stopping = True
+        yield put_all(client, state, args.concurrency)
+        yield defer.gatherResults(pollers)
+        yield client.close()
+
+        result = summarize(args, state, samples, elapsed)
+        print_result(result)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(result, f, indent=2, sort_keys=True)
+    finally:
+        reactor.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--server", default=None, help="URL of a running server. By default a local server is started.")
+    parser.add_argument("--port", type=int, default=8889, help="port of the local server")
+    parser.add_argument("--server-python", default=sys.executable, help="interpreter for the local server")
+    parser.add_argument("--server-args", default="", help="options for the local server, e.g. '--processes=4'")
+    parser.add_argument("--server-log", default=os.devnull, help="file for the output of the local server")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+    parser.add_argument("--concurrency", type=int, default=50, help="number of workers")
+    parser.add_argument("--pollers", type=int, default=200, help="number of concurrent long-polls")
+    parser.add_argument("--mix", default="put=2,get=4,jungest=2,oldest=1", help="weights of the operations")
+    parser.add_argument("--keys", type=int, default=1000)
+    parser.add_argument("--size", type=int, default=256, help="plaintext size in bytes")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default=None, help="file for the JSON result")
+    args = parser.parse_args()
+    args.started = datetime.datetime.now().isoformat()
+    parse_mix(args.mix)
+
+    process = None
+    if args.server:
+        url = args.server
+    else:
+        process = start_server(args.server_python, args.port, shlex.split(args.server_args), args.server_log)
+        url = "http://localhost:%s" % args.port
+    try:
+        reactor.callWhenRunning(run, args, url, process.pid if process else None)
+        reactor.run()
+    finally:
+        if process:
+            stop_server(process)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import collections
+import time
+
+
+class ValueCache(object):
+    """
+    Least recently used cache of the plaintext values of `(key, version)` pairs.
+
+    Stored versions never change, but the server may evict a version and later
+    store a different value under the same version number. Values received
+    from the server are therefore only fresh for the `max_age` the server sent,
+    or the `max_age` of the cache if it sent none. After that they are kept 
+    together with their ETag, so that they can be revalidated with a conditional request.
+    """
+
+    #: Bytes accounted per entry in addition to the key and value, an
+    #: estimate of the memory used by the dict entry, tuple and strings.
+    ENTRY_OVERHEAD = 200
+
+    def __init__(self, max_bytes, clock=time.time, max_age=None):
+        """
+        :param max_bytes: Maximal total size of the cached keys and values.
+        :param clock: Function that returns the current time in seconds.
+        :param max_age: Seconds values put without a `max_age` are fresh.
+          `None` if they are fresh forever.
+        """
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.max_age = max_age
+
+        #: total size of the cached entries, including `ENTRY_OVERHEAD`.
+        self.size = 0
+
+        #: number of lookups that found a fresh value.
+        self.hits = 0
+
+        #: number of lookups that did not find a fresh value.
+        self.misses = 0
+
+        #: number of stale values the server confirmed to be unchanged.
+        self.revalidated = 0
+
+        #: maps `(key, version)` to `_Entry`. Most recently used on the right.
+        self._entries = collections.OrderedDict()
+
+    def get(self, key, version):
+        """
+        Returns the cached value if it is fresh, `None` otherwise.
+        """
+        entry = self._entries.pop((key, version), None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries[(key, version)] = entry
+        if entry.expires is not None and entry.expires <= self.clock():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry.value
+
+    def etag(self, key, version):
+        """
+        Returns the ETag of a cached value, fresh or not, or `None`.
+        """
+        entry = self._entries.get((key, version), None)
+        return entry.etag if entry is not None else None
+
+    def revalidate(self, key, version):
+        """
+        Marks the value as fresh again, after the server confirmed that
+        it did not change. Returns the value or `None` if it is no longer cached.
+        """
+        entry = self._entries.get((key, version), None)
+        if entry is None:
+            return None
+        if entry.max_age is not None:
+            entry.expires = self.clock() + entry.max_age
+        self.revalidated += 1
+        return entry.value
+
+    def put(self, key, version, value, etag=None, max_age=None):
+        """
+        Adds a value. Values larger than the cache are not stored.
+
+        :param etag: ETag of the server response that contained the value.
+        :param max_age: Seconds the value is fresh. Defaults to the `max_age` of the cache.
+        """
+        size = self._size(key, value)
+        if size > self.max_bytes:
+            return
+        old = self._entries.pop((key, version), None)
+        if old is not None:
+            self.size -= self._size(key, old.value)
+        if max_age is None:
+            max_age = self.max_age
+        expires = self.clock() + max_age if max_age is not None else None
+        self._entries[(key, version)] = _Entry(value, etag, max_age, expires)
+        self.size += size
+        while self.size > self.max_bytes:
+            (old_key, _), old_entry = self._entries.popitem(last=False)
+            self.size -= self._size(old_key, old_entry.value)
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _size(self, key, value):
+        return len(key) + len(value) + self.ENTRY_OVERHEAD
+
+
+class _Entry(object):
+
+    __slots__ = ("value", "etag", "max_age", "expires")
+
+    def __init__(self, value, etag, max_age, expires):
+        self.value = value
+        self.etag = etag
+        self.max_age = max_age
+        self.expires = expires
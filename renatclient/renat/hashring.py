@@ -0,0 +1,96 @@
+import bisect
+import hashlib
+import struct
+
+#: Points on the ring per node. More points spread the keys more evenly.
+VNODES = 160
+
+_POSITION = struct.Struct(">Q")
+
+
+class HashRing(object):
+    """
+    Consistent hashing of keys onto nodes.
+
+    Each node is placed on a ring at `vnodes` points derived from its name,
+    and a key belongs to the node of the first point at or after the key's
+    position. Adding a node therefore only takes over the keys from the
+    points before its own, about `1 / (number of nodes)` of them, and removing
+    one only moves its own keys. The order in which the nodes are added does not matter.
+    """
+
+    def __init__(self, nodes=(), vnodes=VNODES):
+        self.vnodes = vnodes
+
+        #: sorted positions of the points on the ring.
+        self._positions = []
+
+        #: node of each point, same order as `_positions`.
+        self._nodes = []
+
+        for node in nodes:
+            self.add(node)
+
+
+    def __len__(self):
+        """
+        Number of nodes.
+        """
+        return len(self._nodes) // self.vnodes
+
+
+    def __contains__(self, node):
+        return node in self._nodes
+
+
+    def nodes(self):
+        """
+        Returns the list of the nodes, sorted.
+        """
+        return sorted(set(self._nodes))
+
+
+    def add(self, node):
+        """
+        Adds a node. Does nothing if it is on the ring already.
+        """
+        if node in self:
+            return
+        for i in range(self.vnodes):
+            position = _position("%s#%s" % (node, i))
+            index = bisect.bisect_left(self._positions, position)
+            # on collisions, the node that sorts first wins, regardless of the order of `add`.
+            while (index < len(self._positions) and self._positions[index] == position
+                   and self._nodes[index] < node):
+                index += 1
+            self._positions.insert(index, position)
+            self._nodes.insert(index, node)
+
+
+    def remove(self, node):
+        """
+        Removes a node. Its keys are spread across the remaining ones.
+        """
+        if node not in self:
+            raise KeyError(node)
+        keep = [i for i, n in enumerate(self._nodes) if n != node]
+        self._positions = [self._positions[i] for i in keep]
+        self._nodes = [self._nodes[i] for i in keep]
+
+
+    def get(self, key):
+        """
+        Returns the node the key belongs to.
+        """
+        if not self._nodes:
+            raise LookupError("The ring has no nodes.")
+        index = bisect.bisect_left(self._positions, _position(key))
+        if index == len(self._positions):
+            index = 0
+        return self._nodes[index]
+
+
+def _position(key):
+    if not isinstance(key, bytes):
+        key = key.encode("utf-8")
+    return _POSITION.unpack(hashlib.md5(key).digest()[:8])[0]
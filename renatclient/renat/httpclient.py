@@ -13,17 +13,18 @@ from twisted.python.failure import Failure
 
 GET = "GET"
 POST = "POST"
+HEAD = "HEAD"
 
-def request(method, url, values={}, header={}, return_headers=False, pool=None, proxy=None):
+def request(method, url, values={}, header={}, return_headers=False, pool=None, proxy=None, body=None, return_both=False):
     """
     Performs an HTTP request.
     
-    :param method: Either `GET` or `POST`.
+    :param method: `GET`, `POST` or `HEAD`. A HEAD request returns an empty body.
     
     :param url: URL to which the request is made.
     
     :param values: Either a dict or a list of tuples with the values
-      passed along with the request. For a GET request, they are encoded into the URL,
+      passed along with the request. For a GET or HEAD request, they are encoded into the URL,
       for a POST request they are passed in the body of the request.
     
     :param headers: Dict with the header values to send.
@@ -35,16 +36,29 @@ def request(method, url, values={}, header={}, return_headers=False, pool=None,
     
     :param proxy: URL to the proxy. An empty string or no proxy. `None` to check
       the environment variable `http_proxy`.
+      
+    :param body: String to send as the body of a POST request instead of
+      the encoded `values`. The `Content-Type` has to be set in `header`.
+      
+    :param return_both: If `True` the function will return a tuple with the headers
+      and the body.
+      
+    Responses other than 200 fail with `twisted.web.error.Error`, unless `return_headers`
+    is set. The headers of the response are in its `headers` attribute.
     """
     
-    if method != GET and method != POST:
+    if method not in (GET, POST, HEAD):
         raise ValueError("Unsupported method")
     
     agent = _make_agent(pool, proxy)
     
     values = urllib.urlencode(values)
-    if values:
-        if method == GET:
+    if body is not None:
+        if method != POST:
+            raise ValueError("Only POST requests can have a body")
+        request_body = FileBodyProducer(StringIO.StringIO(body))
+    elif values:
+        if method != POST:
             url = url + "?" + values
             request_body = None
         else:
@@ -59,7 +73,12 @@ def request(method, url, values={}, header={}, return_headers=False, pool=None,
                 return dict(response.headers.getAllRawHeaders())
             else:
                 if response.code != httplib.OK:
-                    return Failure(Error(response.code))
+                    error = Error(response.code)
+                    # e.g. for the `Retry-After` of a 429.
+                    error.headers = dict(response.headers.getAllRawHeaders())
+                    return Failure(error)
+                if return_both:
+                    return dict(response.headers.getAllRawHeaders()), body
                 return body
             
         d = readBody(response)
@@ -0,0 +1,133 @@
+import collections
+import json
+
+from twisted.internet import defer, error
+from autobahn.twisted.websocket import WebSocketClientProtocol, WebSocketClientFactory, connectWS
+
+
+class Subscription(object):
+    """
+    Stream of the versions of one record, pushed by the server over a WebSocket.
+    
+    Created by :meth:`WebClient.subscribe`.
+    """
+    
+    def __init__(self, url, record_id, from_version, decrypt):
+        """
+        :param url: WebSocket URL of the subscription endpoint.
+        :param record_id: Encrypted key.
+        :param from_version: First version to receive, `None` for only new versions.
+        :param decrypt: Function that decrypts a value.
+        """
+        self.record_id = record_id
+        self.from_version = from_version
+        self._decrypt = decrypt
+        
+        #: deferred that fires with the first version to be received
+        #: once the server has registered the subscription.
+        self.ready = defer.Deferred()
+        
+        #: received `(version, value)` tuples nobody asked for yet.
+        self._values = collections.deque()
+        
+        #: deferreds returned by `get` that wait for a value.
+        self._waiting = collections.deque()
+        
+        self._failure = None
+        self._protocol = None
+        
+        #: fires once the connection is closed.
+        self._closed = defer.Deferred()
+        
+        factory = WebSocketClientFactory(url)
+        factory.protocol = _SubscriptionProtocol
+        factory.subscription = self
+        connectWS(factory)
+        
+        
+    def get(self):
+        """
+        Returns a deferred with the next `(version, value)` tuple.
+        Versions arrive in increasing order. Fails if the connection is lost.
+        """
+        if self._values:
+            return defer.succeed(self._values.popleft())
+        elif self._failure:
+            return defer.fail(self._failure)
+        else:
+            d = defer.Deferred()
+            self._waiting.append(d)
+            return d
+        
+        
+    def close(self):
+        """
+        Ends the subscription by dropping the connection, without a close
+        handshake that would leave timers behind. Pending `get` calls fail.
+        May be called more than once, also after the connection was lost.
+        
+        Returns a deferred that fires once the connection is closed.
+        """
+        self._fail(error.ConnectionDone("Subscription closed."))
+        if self._protocol:
+            self._protocol.dropConnection(abort=True)
+        elif not self._closed.called:
+            self._closed.callback(None)
+        return self._closed
+    
+    
+    def _opened(self, protocol):
+        if self._failure:
+            protocol.dropConnection(abort=True)
+            return
+        self._protocol = protocol
+        message = {"subscribe": self.record_id, "from_version": self.from_version}
+        protocol.sendMessage(json.dumps(message))
+        
+        
+    def _received(self, message):
+        message = json.loads(message)
+        if "error" in message:
+            self._fail(ValueError(message["error"]))
+            if self._protocol:
+                self._protocol.sendClose()
+            return
+        if "subscribed" in message:
+            self.ready.callback(message["from_version"])
+            return
+        
+        try:
+            value = (message["record_version"], self._decrypt(message["value"]))
+        except ValueError as e:
+            self._fail(e)
+            return
+        
+        if self._waiting:
+            self._waiting.popleft().callback(value)
+        else:
+            self._values.append(value)
+            
+            
+    def _fail(self, exception):
+        if not self._failure:
+            self._failure = exception
+        if not self.ready.called:
+            self.ready.errback(self._failure)
+        while self._waiting:
+            self._waiting.popleft().errback(self._failure)
+            
+
+class _SubscriptionProtocol(WebSocketClientProtocol):
+    
+    def onOpen(self):
+        self.factory.subscription._opened(self)
+        
+    def onMessage(self, payload, isBinary):
+        self.factory.subscription._received(payload)
+        
+    def onClose(self, wasClean, code, reason):
+        subscription = self.factory.subscription
+        subscription._protocol = None
+        subscription._fail(error.ConnectionLost(reason))
+        if not subscription._closed.called:
+            subscription._closed.callback(None)
@@ -0,0 +1,56 @@
+import unittest
+from Crypto import Random
+from renat import webclient
+from renat.test_replication import start_server, stop_server
+from utwist import with_reactor
+from twisted.internet import defer
+from twisted.web.error import Error
+
+SERVER = "http://localhost:8893"
+
+
+class TestAdmission(unittest.TestCase):
+    """
+    Runs a server with a rate limit as a separate process.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = start_server(8893, "--rate_limit=20", "--rate_burst=2")
+
+    @classmethod
+    def tearDownClass(cls):
+        stop_server(cls.server)
+
+    def setUp(self):
+        self.secret = Random.get_random_bytes(64)
+        self.client = webclient.WebClient(SERVER, self.secret, proxy="")
+
+    def twisted_teardown(self):
+        return self.client.close()
+
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_retried(self):
+        versions = yield defer.gatherResults([self.client.put("mykey", "myvalue%s" % i) for i in range(4)])
+        self.assertEqual([1, 2, 3, 4], sorted(versions))
+
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_no_retries(self):
+        client = webclient.WebClient(SERVER, self.secret, proxy="", max_retries=0)
+        try:
+            results = yield defer.DeferredList([client.put("mykey", "myvalue%s" % i) for i in range(4)],
+                                               consumeErrors=True)
+            failures = [result for success, result in results if not success]
+            self.assertTrue(failures)
+            for failure in failures:
+                failure.trap(Error)
+                self.assertEqual("429", failure.value.status)
+                self.assertEqual(["1"], failure.value.headers["Retry-After"])
+        finally:
+            yield client.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import unittest
+
+from renat import cache
+
+
+class TestValueCache(unittest.TestCase):
+
+    def setUp(self):
+        self.target = cache.ValueCache(3 * (cache.ValueCache.ENTRY_OVERHEAD + 10))
+
+    def test_miss(self):
+        self.assertEqual(None, self.target.get("key", 1))
+        self.assertEqual((0, 1), (self.target.hits, self.target.misses))
+
+    def test_hit(self):
+        self.target.put("key", 1, "value")
+        self.assertEqual("value", self.target.get("key", 1))
+        self.assertEqual((1, 0), (self.target.hits, self.target.misses))
+
+    def test_versions(self):
+        self.target.put("key", 1, "value1")
+        self.target.put("key", 2, "value2")
+        self.assertEqual("value1", self.target.get("key", 1))
+        self.assertEqual("value2", self.target.get("key", 2))
+
+    def test_evict_least_recently_used(self):
+        for i in range(3):
+            self.target.put("key", i, "value")
+        self.target.get("key", 0)
+        self.target.put("key", 3, "value")
+        self.assertEqual(3, len(self.target))
+        self.assertEqual(None, self.target.get("key", 1))
+        self.assertEqual("value", self.target.get("key", 0))
+
+    def test_size(self):
+        self.target.put("key", 1, "value")
+        self.target.put("key", 1, "value")
+        self.assertEqual(cache.ValueCache.ENTRY_OVERHEAD + 8, self.target.size)
+
+    def test_too_large(self):
+        self.target.put("key", 1, "x" * 10000)
+        self.assertEqual(0, len(self.target))
+        self.assertEqual(0, self.target.size)
+
+    def test_stale(self):
+        now = [100.0]
+        self.target.clock = lambda: now[0]
+        self.target.put("key", 1, "value", '"etag"', 10)
+        self.assertEqual("value", self.target.get("key", 1))
+        now[0] = 110.0
+        self.assertEqual(None, self.target.get("key", 1))
+        self.assertEqual('"etag"', self.target.etag("key", 1))
+        self.assertEqual((1, 1), (self.target.hits, self.target.misses))
+
+    def test_revalidate(self):
+        now = [100.0]
+        self.target.clock = lambda: now[0]
+        self.target.put("key", 1, "value", '"etag"', 10)
+        now[0] = 110.0
+        self.assertEqual("value", self.target.revalidate("key", 1))
+        now[0] = 119.0
+        self.assertEqual("value", self.target.get("key", 1))
+        self.assertEqual(1, self.target.revalidated)
+
+    def test_default_max_age(self):
+        now = [0]
+        target = cache.ValueCache(1024, clock=lambda: now[0], max_age=10)
+        target.put("a", 1, "value")
+        target.put("b", 1, "value", max_age=20)
+        now[0] = 10
+        self.assertEqual(None, target.get("a", 1))
+        self.assertEqual("value", target.get("b", 1))
+
+    def test_revalidate_absent(self):
+        self.assertEqual(None, self.target.revalidate("key", 1))
+        self.assertEqual(None, self.target.etag("key", 1))
+
+    def test_max_age(self):
+        now = [0]
+        target = cache.ValueCache(1024, clock=lambda: now[0], max_age=10)
+        target.put("key", 1, "value")
+        now[0] = 9
+        self.assertEqual("value", target.get("key", 1))
+        now[0] = 10
+        self.assertEqual(None, target.get("key", 1))
+
+    def test_clear(self):
+        self.target.put("key", 1, "value")
+        self.target.clear()
+        self.assertEqual(None, self.target.get("key", 1))
+        self.assertEqual(0, self.target.size)
+
+
+if __name__ == "__main__":
+    unittest.main()
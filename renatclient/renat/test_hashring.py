@@ -0,0 +1,57 @@
+import unittest
+import collections
+
+from renat import hashring
+
+
+KEYS = ["%040x" % (i * 7919) for i in range(10000)]
+
+
+class TestHashRing(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertRaises(LookupError, hashring.HashRing().get, "key")
+
+    def test_single(self):
+        target = hashring.HashRing(["a"])
+        self.assertEqual(set(["a"]), set(target.get(key) for key in KEYS))
+
+    def test_len(self):
+        target = hashring.HashRing(["a", "b", "b"])
+        self.assertEqual(2, len(target))
+        self.assertEqual(["a", "b"], target.nodes())
+
+    def test_order_independent(self):
+        target1 = hashring.HashRing(["a", "b", "c"])
+        target2 = hashring.HashRing(["c", "a", "b"])
+        self.assertEqual([target1.get(key) for key in KEYS], [target2.get(key) for key in KEYS])
+
+    def test_balanced(self):
+        target = hashring.HashRing(["http://server%s:8888" % i for i in range(4)])
+        counts = collections.Counter(target.get(key) for key in KEYS)
+        for count in counts.values():
+            self.assertTrue(0.75 * 2500 < count < 1.25 * 2500, counts)
+
+    def test_add_moves_few(self):
+        target = hashring.HashRing(["a", "b", "c", "d"])
+        before = [target.get(key) for key in KEYS]
+        target.add("e")
+        after = [target.get(key) for key in KEYS]
+        moved = [(b, a) for b, a in zip(before, after) if b != a]
+        self.assertTrue(all(a == "e" for _, a in moved))
+        self.assertLess(len(moved), 0.3 * len(KEYS))
+
+    def test_remove_moves_own(self):
+        target = hashring.HashRing(["a", "b", "c", "d"])
+        before = [target.get(key) for key in KEYS]
+        target.remove("b")
+        after = [target.get(key) for key in KEYS]
+        self.assertTrue(all(b == a for b, a in zip(before, after) if b != "b"))
+        self.assertNotIn("b", after)
+
+    def test_remove_unknown(self):
+        self.assertRaises(KeyError, hashring.HashRing(["a"]).remove, "b")
+
+
+if __name__ == "__main__":
+    unittest.main()
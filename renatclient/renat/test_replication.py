@@ -0,0 +1,136 @@
+import unittest
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib
+import urllib2
+import json
+from Crypto import Random
+from renat import webclient
+from utwist import with_reactor
+from twisted.internet import defer
+from twisted.web.error import Error
+
+#: Directory from which the servers are started.
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "renatserver")
+
+PRIMARY = "http://localhost:8891"
+FOLLOWER = "http://localhost:8892"
+TOKEN = "replication-test"
+
+
+def start_server(port, *args):
+    with open(os.devnull, "w") as output:
+        process = subprocess.Popen([sys.executable, "-m", "renatserver.server", "--port=%s" % port,
+                                    "--admin_token=%s" % TOKEN] + list(args),
+                                   cwd=SERVER_DIR, preexec_fn=os.setsid, stdout=output, stderr=subprocess.STDOUT)
+    wait_until(lambda: socket.create_connection(("localhost", port), timeout=1).close() or True)
+    return process
+
+
+def stop_server(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except OSError:
+        pass
+    process.wait()
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            if condition():
+                return
+        except (socket.error, urllib2.URLError):
+            pass
+        if time.time() > deadline:
+            raise AssertionError("Timeout")
+        time.sleep(0.1)
+
+
+def synced():
+    stats = urllib2.urlopen(FOLLOWER + "/stats").read()
+    return "renat_replication_synced 1" in stats
+
+
+class TestReplication(unittest.TestCase):
+    """
+    Runs a primary and a follower server as separate processes.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.primary = start_server(8891)
+        try:
+            # stored before the follower connects, it gets it with the snapshot.
+            urllib2.urlopen(PRIMARY + "/rec/snapshotted/JUNGEST", urllib.urlencode({"data": "before", "idepo": "1"}))
+            cls.follower = start_server(8892, "--replicate_from=%s" % PRIMARY)
+            wait_until(synced)
+        except:
+            stop_server(cls.primary)
+            raise
+
+    @classmethod
+    def tearDownClass(cls):
+        stop_server(cls.follower)
+        stop_server(cls.primary)
+
+    def setUp(self):
+        secret = Random.get_random_bytes(64)
+        self.primary_client = webclient.WebClient(PRIMARY, secret, proxy="")
+        self.follower_client = webclient.WebClient(FOLLOWER, secret, proxy="")
+
+    @defer.inlineCallbacks
+    def twisted_teardown(self):
+        yield self.primary_client.close()
+        yield self.follower_client.close()
+
+    def test_snapshot(self):
+        response = json.loads(urllib2.urlopen(FOLLOWER + "/rec/snapshotted/1").read())
+        self.assertEqual("before", response["value"])
+
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_get(self):
+        version = yield self.primary_client.put("mykey", "myvalue")
+        actual = yield self.follower_client.get("mykey", version, wait=True)
+        self.assertEqual("myvalue", actual)
+
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_wait(self):
+        d = self.follower_client.get("mykey", 1, wait=True)
+        yield self.primary_client.put("mykey", "myvalue")
+        actual = yield d
+        self.assertEqual("myvalue", actual)
+
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_same_versions(self):
+        for i in range(3):
+            yield self.primary_client.put("mykey", "myvalue%s" % i)
+        yield self.follower_client.get("mykey", 3, wait=True)
+        actual = yield self.follower_client.info("mykey")
+        self.assertEqual((1, 3, 3), actual)
+
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_put_rejected(self):
+        try:
+            yield self.follower_client.put("mykey", "myvalue")
+            self.fail("Expected error")
+        except Error as e:
+            self.assertEqual("403", e.status)
+
+    def test_lag_header(self):
+        response = urllib2.urlopen(FOLLOWER + "/rec/snapshotted/1")
+        self.assertEqual(PRIMARY, response.info()["X-Renat-Primary"])
+        self.assertLess(float(response.info()["X-Replication-Lag"]), 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
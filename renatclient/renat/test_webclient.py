@@ -1,8 +1,14 @@
 import unittest
+import base64
+import bz2
+import urllib2
 from Crypto import Random
-from renat import webclient
+from Crypto.Cipher import AES
+from Crypto.Hash import SHA
+from renat import webclient, httpclient
 from utwist import with_reactor
-from twisted.internet import defer
+from twisted.internet import defer, error, reactor, task
+from twisted.web.error import Error
 
 key = "x"*16
 
@@ -30,6 +36,135 @@ class TestWebClientIntegration(unittest.TestCase):
         actual = yield self.client.get("mykey", version)
         self.assertEqual("myvalue", actual)
 
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_get_crypto_threads(self):
+        client = webclient.WebClient("http://localhost:8888", Random.get_random_bytes(64), inline_size=0)
+        try:
+            versions = yield client.put_many([("mykey", "myvalue1"), ("mykey", "myvalue2")])
+            actual = yield client.get("mykey", versions[0])
+            self.assertEqual("myvalue1", actual)
+            actual = yield client.get_many([("mykey", "JUNGEST")])
+            self.assertEqual([(2, "myvalue2")], actual)
+        finally:
+            yield client.close()
+
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_get_cached(self):
+        client = webclient.WebClient("http://localhost:8888", Random.get_random_bytes(64), cache_bytes=1024*1024)
+        try:
+            version = yield client.put("mykey", "myvalue1")
+            yield self.client.put("mykey", "unrelated")
+            actual = yield client.get("mykey", version)
+            self.assertEqual("myvalue1", actual)
+            self.assertEqual((1, 0), (client.cache.hits, client.cache.misses))
+        finally:
+            yield client.close()
+
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_get_jungest_fills_cache(self):
+        secret = Random.get_random_bytes(64)
+        client = webclient.WebClient("http://localhost:8888", secret, cache_bytes=1024*1024)
+        other = webclient.WebClient("http://localhost:8888", secret)
+        try:
+            yield other.put("mykey", "myvalue1")
+            version, _ = yield client.get_jungest("mykey")
+            actual = yield client.get("mykey", version)
+            self.assertEqual("myvalue1", actual)
+            self.assertEqual((1, 0), (client.cache.hits, client.cache.misses))
+        finally:
+            yield client.close()
+            yield other.close()
+
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_binary_detected(self):
+        self.assertEqual(None, self.client.binary)
+        yield self.client.put("mykey", "myvalue")
+        self.assertEqual(True, self.client.binary)
+        version = yield self.client.put("mykey", "myvalue2")
+        actual = yield self.client.get("mykey", version)
+        self.assertEqual("myvalue2", actual)
+
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_binary_interoperates(self):
+        secret = Random.get_random_bytes(64)
+        binary = webclient.WebClient("http://localhost:8888", secret, binary=True)
+        text = webclient.WebClient("http://localhost:8888", secret, binary=False)
+        try:
+            version1 = yield binary.put("mykey", "myvalue1")
+            version2 = yield text.put("mykey", "myvalue2")
+            actual = yield text.get("mykey", version1)
+            self.assertEqual("myvalue1", actual)
+            actual = yield binary.get("mykey", version2)
+            self.assertEqual("myvalue2", actual)
+            actual = yield text.get_many([("mykey", version1)])
+            self.assertEqual([(version1, "myvalue1")], actual)
+        finally:
+            yield binary.close()
+            yield text.close()
+
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_cache_headers(self):
+        version = yield self.client.put("mykey", "myvalue")
+        url = self.client._url(webclient._encrypt_key(self.client.encryption_key, "mykey"), version, "http://localhost:8888")
+        headers = yield httpclient.request("GET", url, return_headers=True, pool=self.client.pools["http://localhost:8888"])
+        self.assertEqual(["public, max-age=150, immutable"], headers["Cache-Control"])
+        self.assertTrue(headers["ETag"][0].startswith('"'))
+
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_head(self):
+        version = yield self.client.put("mykey", "myvalue")
+        record_id = webclient._encrypt_key(self.client.encryption_key, "mykey")
+        def head(record_version):
+            url = self.client._url(record_id, record_version, "http://localhost:8888")
+            return httpclient.request(httpclient.HEAD, url, return_both=True)
+        headers, body = yield head(version)
+        self.assertEqual("", body)
+        self.assertEqual([str(version)], headers["X-Record-Version"])
+        self.assertEqual(["1"], headers["X-Record-Count"])
+        headers, _ = yield head("JUNGEST")
+        self.assertEqual([str(version)], headers["X-Record-Version"])
+        try:
+            yield head(version + 1)
+            self.fail("Expected error")
+        except Error as e:
+            self.assertEqual("404", e.status)
+
+    def test_next_invalid_after(self):
+        url = self.client._url("key", "NEXT", "http://localhost:8888") + "?after=x"
+        try:
+            urllib2.urlopen(url)
+            self.fail("Expected error")
+        except urllib2.HTTPError as e:
+            self.assertEqual(400, e.code)
+
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_get_revalidated(self):
+        secret = Random.get_random_bytes(64)
+        client = webclient.WebClient("http://localhost:8888", secret, cache_bytes=1024*1024)
+        other = webclient.WebClient("http://localhost:8888", secret)
+        now = [0]
+        client.cache.clock = lambda: now[0]
+        try:
+            version = yield other.put("mykey", "myvalue")
+            actual = yield client.get("mykey", version)
+            now[0] = 1000
+            actual = yield client.get("mykey", version)
+            self.assertEqual("myvalue", actual)
+            self.assertEqual(1, client.cache.revalidated)
+            actual = yield client.get("mykey", version)
+            self.assertEqual((1, 2), (client.cache.hits, client.cache.misses))
+        finally:
+            yield client.close()
+            yield other.close()
+
     @with_reactor
     @defer.inlineCallbacks
     def test_get_jungest(self):
@@ -46,6 +181,96 @@ class TestWebClientIntegration(unittest.TestCase):
         actual = yield self.client.get_oldest("mykey")
         self.assertEqual((1,"myvalue1"), actual)
         
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_get_next(self):
+        yield self.client.put("mykey", "myvalue1")
+        yield self.client.put("mykey", "myvalue2")
+        actual = yield self.client.get_next("mykey", 0)
+        self.assertEqual((1,"myvalue1"), actual)
+        actual = yield self.client.get_next("mykey", 1)
+        self.assertEqual((2,"myvalue2"), actual)
+        
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_get_next_none(self):
+        yield self.client.put("mykey", "myvalue1")
+        try:
+            yield self.client.get_next("mykey", 1)
+            self.fail("Expected error")
+        except Error as e:
+            self.assertEqual("404", e.status)
+        
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_wait_get_next(self):
+        yield self.client.put("key", "value1")
+        d = self.client.get_next("key", 1, wait=True)
+        yield self.client.put("key", "value2")
+        actual = yield d
+        self.assertEqual((2, "value2"), actual)
+        
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_multi_server(self):
+        # two urls of the same server, the keys are spread across both anyway.
+        client = webclient.WebClient(["http://localhost:8888", "http://127.0.0.1:8888"], Random.get_random_bytes(64))
+        try:
+            keys = ["mykey%s" % i for i in range(20)]
+            self.assertEqual(2, len(set(client.ring.get(webclient._encrypt_key(client.encryption_key, key))
+                                        for key in keys)))
+            versions = yield client.put_many([(key, "myvalue" + key) for key in keys])
+            self.assertEqual([1] * len(keys), versions)
+            actual = yield client.get_many([(key, 1) for key in keys])
+            self.assertEqual([(1, "myvalue" + key) for key in keys], actual)
+            actual = yield client.get("mykey3", 1)
+            self.assertEqual("myvalue" + "mykey3", actual)
+        finally:
+            yield client.close()
+        
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_multi_server_wait_any(self):
+        client = webclient.WebClient(["http://localhost:8888", "http://127.0.0.1:8888"], Random.get_random_bytes(64))
+        try:
+            keys = ["mykey%s" % i for i in range(20)]
+            d = client.wait_any(dict((key, 0) for key in keys))
+            yield client.put("mykey7", "myvalue")
+            actual = yield d
+            self.assertEqual({"mykey7": 1}, actual)
+        finally:
+            yield client.close()
+        
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_info(self):
+        for i in range(3):
+            yield self.client.put("mykey", "myvalue%s" % i)
+        actual = yield self.client.info("mykey")
+        self.assertEqual((1, 3, 3), actual)
+        
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_info_none(self):
+        actual = yield self.client.info("mykey")
+        self.assertEqual(None, actual)
+        
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_get_range(self):
+        for i in range(5):
+            yield self.client.put("mykey", "myvalue%s" % i)
+        actual = yield self.client.get_range("mykey", 2, 4)
+        self.assertEqual(([(2, "myvalue1"), (3, "myvalue2"), (4, "myvalue3")], None), actual)
+        actual = yield self.client.get_range("mykey", 4)
+        self.assertEqual(([(4, "myvalue3"), (5, "myvalue4")], None), actual)
+        
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_get_range_empty(self):
+        actual = yield self.client.get_range("mykey", 1)
+        self.assertEqual(([], None), actual)
+        
     @with_reactor
     @defer.inlineCallbacks
     def test_wait_get(self):
@@ -54,6 +279,16 @@ class TestWebClientIntegration(unittest.TestCase):
         actual = yield d
         self.assertEqual("value", actual)
         
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_wait_get_repolled(self):
+        self.client.WAIT_TIMEOUT = 1
+        d = self.client.get("key", 1, wait=True)
+        yield task.deferLater(reactor, 1.5, lambda: None)
+        yield self.client.put("key", "value")
+        actual = yield d
+        self.assertEqual("value", actual)
+        
     @with_reactor
     @defer.inlineCallbacks
     def test_wait_get_jungest(self):
@@ -103,6 +338,95 @@ class TestWebClientIntegration(unittest.TestCase):
         actual = yield d
         self.assertEqual("ok", actual)
         
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_put_many(self):
+        versions = yield self.client.put_many([("key1", "value1"), ("key2", "value2"), ("key1", "value3")])
+        self.assertEqual([1, 1, 2], versions)
+        
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_get_many(self):
+        yield self.client.put_many([("key1", "value1"), ("key2", "value2"), ("key1", "value3")])
+        actual = yield self.client.get_many([("key1", 1), ("key1", "JUNGEST"), ("key2", "OLDEST"), ("key3", 1)])
+        self.assertEqual([(1, "value1"), (2, "value3"), (1, "value2"), None], actual)
+        
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_put_many_too_large(self):
+        versions = yield self.client.put_many([("key1", Random.get_random_bytes(2048))])
+        self.assertTrue(isinstance(versions[0], ValueError))
+        
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_subscribe(self):
+        yield self.client.put("key", "value1")
+        yield self.client.put("key", "value2")
+        subscription = self.client.subscribe("key", 1)
+        try:
+            first = yield subscription.get()
+            second = yield subscription.get()
+            yield self.client.put("key", "value3")
+            third = yield subscription.get()
+        finally:
+            yield subscription.close()
+        self.assertEqual([(1, "value1"), (2, "value2"), (3, "value3")], [first, second, third])
+        
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_subscribe_new(self):
+        yield self.client.put("key", "value1")
+        subscription = self.client.subscribe("key")
+        try:
+            from_version = yield subscription.ready
+            self.assertEqual(2, from_version)
+            d = subscription.get()
+            yield self.client.put("key", "value2")
+            actual = yield d
+        finally:
+            yield subscription.close()
+        self.assertEqual((2, "value2"), actual)
+        
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_subscribe_close_twice(self):
+        subscription = self.client.subscribe("key")
+        yield subscription.ready
+        yield subscription.close()
+        yield subscription.close()
+        try:
+            yield subscription.get()
+            self.fail("Expected error")
+        except error.ConnectionDone:
+            pass
+        
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_wait_any_stored(self):
+        yield self.client.put("key2", "value")
+        actual = yield self.client.wait_any({"key1":0, "key2":0})
+        self.assertEqual({"key2":1}, actual)
+        
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_wait_any(self):
+        yield self.client.put("key1", "value")
+        d = self.client.wait_any({"key1":1, "key2":0})
+        yield self.client.put("key2", "value")
+        actual = yield d
+        self.assertEqual({"key2":1}, actual)
+        
+    @with_reactor
+    @defer.inlineCallbacks
+    def test_waitcancel_wait_any(self):
+        d = self.client.wait_any({"key1":0})
+        d.cancel()
+        def eb(e):
+            return "ok"
+        d.addErrback(eb)
+        actual = yield d
+        self.assertEqual("ok", actual)
+        
     @with_reactor
     @defer.inlineCallbacks
     def test_publicip(self):
@@ -135,6 +459,42 @@ class TestWebClient(unittest.TestCase):
         cipher = cipher[:pos] + replace_by + cipher[pos+1:]
         self.assertRaises(ValueError, webclient._decrypt_value, key, cipher)
         
+    def test_codecs(self):
+        plain = "Hello World! " * 100
+        codecs = ["auto", "none", "zlib", "bz2"]
+        if webclient.lzma is not None:
+            codecs.append("lzma")
+        for codec in codecs:
+            cipher = webclient._encrypt_value(key, plain, codec)
+            self.assertEqual(plain, webclient._decrypt_value(key, cipher))
+            
+    def test_auto_small_uncompressed(self):
+        self.assertEqual("\x00abc", webclient._compress("abc", "auto"))
+        
+    def test_auto_incompressible(self):
+        plain = Random.get_random_bytes(1024)
+        self.assertEqual("\x00" + plain, webclient._compress(plain, "auto"))
+        
+    def test_decrypt_legacy(self):
+        # Format from before there were codecs: always bz2, no codec byte.
+        plain = "Hello World!"
+        compressed = bz2.compress(plain)
+        unpadded = compressed + SHA.new(compressed).digest()
+        padded = unpadded + webclient._make_padding(unpadded, AES.block_size)
+        iv = Random.get_random_bytes(AES.block_size)
+        cipher = base64.b64encode(iv + AES.new(key, AES.MODE_CBC, iv).encrypt(padded))
+        self.assertEqual(plain, webclient._decrypt_value(key, cipher))
+        
+    def test_default_legacy(self):
+        # readable by clients from before there were codecs.
+        plain = "Hello World!"
+        self.assertEqual(bz2.compress(plain), webclient._compress(plain, "bz2"))
+        client = webclient.WebClient("http://localhost:8888", "secret")
+        self.assertEqual("bz2", client.codec)
+        
+    def test_unknown_codec(self):
+        self.assertRaises(ValueError, webclient._encrypt_value, key, "Hello World!", "snappy")
+        
     def test_random(self):
         plain = "Hello World!"
         cipher1 = webclient._encrypt_value(key, plain)
@@ -146,4 +506,17 @@ class TestWebClient(unittest.TestCase):
         cipher1 = webclient._encrypt_key(key, plain)
         cipher2 = webclient._encrypt_key(key, plain)
         self.assertEqual(cipher1, cipher2)
-        
\ No newline at end of file
+                
+    def test_retry_delay_backoff(self):
+        error = Error("429")
+        error.headers = {}
+        for attempt in range(3):
+            delay = webclient._retry_delay(error, attempt)
+            expected = webclient.RETRY_DELAY * 2 ** attempt
+            self.assertTrue(expected <= delay <= expected * (1 + webclient.RETRY_JITTER))
+        
+    def test_retry_delay_retry_after(self):
+        error = Error("429")
+        error.headers = {"Retry-After": ["2"]}
+        delay = webclient._retry_delay(error, 0)
+        self.assertTrue(2 <= delay <= 2 * (1 + webclient.RETRY_JITTER))
@@ -1,54 +1,161 @@
-from twisted.internet import reactor
+from twisted.internet import reactor, defer, threads, task
+from twisted.python.threadpool import ThreadPool
 from twisted.web.client import HTTPConnectionPool
 from twisted.web.error import Error
 from Crypto.Hash import SHA
 from Crypto.Cipher import AES
 from Crypto import Random
 import bz2
+import zlib
 import base64
 import hmac
 import hashlib
 import urllib
 import httplib
 import json
-from renat import httpclient
+import random
+from renat import httpclient, cache, hashring
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+#: Content type of values in binary mode.
+BINARY_TYPE = "application/octet-stream"
+
+#: Status of a request rejected by the admission control of the server.
+TOO_MANY_REQUESTS = 429
+
+#: Seconds before the first retry of a rejected request, doubled for each further one.
+#: The `Retry-After` of the server is used if it is longer.
+RETRY_DELAY = 0.1
+
+#: Each retry is delayed by up to this fraction more, at random, so that the clients
+#: rejected at the same time do not all come back at the same time.
+RETRY_JITTER = 0.5
 
 class WebClient(object):
     """
     Client to communicate with the webservice.
     
-    Manages a connection pool, supports using a proxy.
+    Manages a connection pool per server, supports using a proxy.
     """
     
-    def __init__(self, server, secret, proxy = None):
+    #: Seconds a long-poll waits on the server. A wait that times out
+    #: is repeated until the awaited version is there.
+    WAIT_TIMEOUT = 60
+    
+    def __init__(self, server, secret, proxy = None, codec = "bz2", crypto_threads = 4, inline_size = 512, cache_bytes = 0, cache_max_age = 150, binary = None, max_retries = 5):
         """
-        :param server: Url of the server.
+        :param server: Url of the server, or a list of urls of independent servers.
+          Each key is then stored on one of them, picked by consistent hashing
+          of the encrypted key (see :class:`hashring.HashRing`). All clients
+          sharing keys must use the same servers, in any order.
         :param secret: Passpharse. Only clients with the same secret can interact, 
           even when using the same server.
         :param proxy: URL to the proxy. An empty string or no proxy. `None` to check
           the environment variable `http_proxy`.
+        :param codec: Compression of the values before encryption. One of
+          `"none"`, `"zlib"`, `"bz2"` and `"lzma"`, or `"auto"` to pick one
+          by size. Values are readable regardless of the codec they were written with,
+          but clients from before codecs were introduced can only read `"bz2"`.
+          That is why it is the default. Only pick another codec once all
+          clients that read the values are upgraded.
+        :param crypto_threads: Maximal number of threads that compress and
+          encrypt values, so that the reactor stays responsive while large values are 
+          processed. `0` to do all of it on the reactor thread.
+        :param inline_size: Values smaller than this (in bytes) are processed on the 
+          reactor thread. For them, handing over to a thread costs more than it saves.
+        :param cache_bytes: Size of a cache of the values by key and version. 
+          `get` with a version number returns cached values without asking the server. 
+          `0` for no cache.
+        :param cache_max_age: Seconds a cached value stays fresh, unless the server
+          sent a max-age with it, as it does for a get of a version number.
+          The server may store another value under a version number once all
+          versions of the key were evicted, so this has to be shorter than its
+          eviction time. The default is half of the server's default eviction time.
+        :param binary: Transfer values as raw bytes instead of base64 encoded in
+          form fields and JSON. `None` to do so once the server reported that it
+          supports it.
+        :param max_retries: How often a request the server rejected with 429 is
+          retried, after the delay the server asked for. Then the error is returned.
         """
-        self.server = server
+        if codec != "auto" and codec not in _CODECS:
+            raise ValueError("Unknown codec %s" % repr(codec))
         self.encryption_key = _make_key(secret)
         self.proxy = proxy
-        self.pool = HTTPConnectionPool(reactor, persistent=True)
-        self.pool.maxPersistentPerHost = 1024
+        self.codec = codec
+        self.binary = binary
+        self.crypto_threads = crypto_threads
+        self.inline_size = inline_size
+        self.max_retries = max_retries
+        
+        #: :class:`cache.ValueCache` with the values by key and version, or `None`.
+        #: Has the hit and miss counters.
+        self.cache = cache.ValueCache(cache_bytes, max_age=cache_max_age) if cache_bytes else None
+        
+        #: :class:`hashring.HashRing` of the server urls.
+        self.ring = hashring.HashRing()
+        
+        #: dict that maps the url of each server to its connection pool.
+        self.pools = {}
+        
+        for url in ([server] if isinstance(server, basestring) else server):
+            self.add_server(url)
+        if not self.pools:
+            raise ValueError("No server given.")
+        
+        #: started on first use.
+        self._crypto_pool = None
+        self._crypto_pool_trigger = None
     
     
     def close(self):
         """
-        Closes the connection pool.
+        Closes the connection pools and stops the crypto threads.
         """
-        return self.pool.closeCachedConnections()
+        if self._crypto_pool:
+            reactor.removeSystemEventTrigger(self._crypto_pool_trigger)
+            self._crypto_pool.stop()
+            self._crypto_pool = None
+        return _gather([pool.closeCachedConnections() for pool in self.pools.values()])
+    
+    
+    def add_server(self, server):
+        """
+        Adds a server. It takes over about `1 / (number of servers)` of the keys,
+        the versions stored for them so far are not visible anymore.
+        """
+        if server in self.pools:
+            return
+        pool = HTTPConnectionPool(reactor, persistent=True)
+        pool.maxPersistentPerHost = 1024
+        self.pools[server] = pool
+        self.ring.add(server)
+        
+        
+    def remove_server(self, server):
+        """
+        Removes a server. Its keys are spread across the remaining servers.
+        @return deferred that fires once its connections are closed.
+        """
+        self.ring.remove(server)
+        return self.pools.pop(server).closeCachedConnections()
+    
     
     def public_ip(self):
         """
-        Returns our IP as it is seen from the server.
+        Returns our IP as it is seen from the server (the first one, sorted by url).
         """
         def cb(headers):
             return headers["X-Request-From"]
-        url = self._url(0, 0)
-        d = httpclient.request("GET", url, return_headers=True, pool=self.pool, proxy=self.proxy)
+        server = self.ring.nodes()[0]
+        url = self._url(0, 0, server)
+        d = self._request(server, "GET", url, return_headers=True)
         
         d.addCallback(lambda headers:headers["X-Request-From"][0])
         #d.addCallback(cb)
@@ -59,10 +166,16 @@ class WebClient(object):
         Store new key-value pair.
         @return deferred new version
         """
-        key = _encrypt_key(self.encryption_key, key)
-        value = _encrypt_value(self.encryption_key, value)
-        d = self._post_request(key, "JUNGEST", value)
-        d.addCallback(lambda r:r["record_version"])
+        def stored(response):
+            if self.cache is not None:
+                self.cache.put(key, response["record_version"], value)
+            return response["record_version"]
+        
+        record_id = _encrypt_key(self.encryption_key, key)
+        binary = bool(self.binary)
+        d = self._encrypt(value, binary)
+        d.addCallback(lambda encrypted: self._post_request(record_id, "JUNGEST", encrypted, binary))
+        d.addCallback(stored)
         return d
     
     
@@ -71,8 +184,18 @@ class WebClient(object):
         Returns the value for the given key and version.
         If `wait` is `True` then we wait for the key & version
         to be stored. The deferred can be canceled.
+        
+        Values found in the cache are returned without asking the server.
+        Such a get does not reset the eviction timer on the server. Once the
+        cached value is stale, the server is asked whether it changed.
         """
-        d = self._get(key, version, wait)
+        etag = None
+        if self.cache is not None and not isinstance(version, basestring):
+            value = self.cache.get(key, version)
+            if value is not None:
+                return defer.succeed(value)
+            etag = self.cache.etag(key, version)
+        d = self._get(key, version, wait, etag)
         d.addCallback(lambda r:r["value"])
         return d
                     
@@ -94,63 +217,433 @@ class WebClient(object):
         d.addCallback(lambda r:(r["record_version"], r["value"]))
         return d
     
-    def _url(self, record_id, record_version):
+    def get_next(self, key, version, wait=False):
+        """
+        Returns a tuple with the oldest version newer than `version` and its value.
+        Versions that were evicted are skipped, so a consumer that reads
+        all versions in order needs one request per version, even if it fell behind.
+        If `wait` is `True` then we wait for such a version to be stored.
+        """
+        d = self._get(key, "NEXT", wait, query={"after": str(version)})
+        d.addCallback(lambda r:(r["record_version"], r["value"]))
+        return d
+    
+    def put_many(self, items):
+        """
+        Stores several key-value pairs with one request.
+        
+        :param items: List of `(key, value)` tuples.
+        
+        @return deferred list with the new version of each item, in the same
+          order. If the server rejected an item, its entry is a `ValueError`.
+        """
+        def encrypted(values):
+            puts = [{"record_id": _encrypt_key(self.encryption_key, key),
+                     "idepo": _get_random_string(),
+                     "data": value} for (key, _), value in zip(items, values)]
+            return self._batch_request(puts, [])
+        
+        def got_response(response):
+            puts, _ = response
+            return [r["record_version"] if "record_version" in r else ValueError(r["error"])
+                    for r in puts]
+        
+        d = _gather([self._encrypt(value) for _, value in items])
+        d.addCallback(encrypted)
+        d.addCallback(got_response)
+        return d
+    
+    
+    def get_many(self, requests):
+        """
+        Reads several values with one request.
+        
+        :param requests: List of `(key, version)` tuples. The version is 
+          either a number or one of `"JUNGEST"` and `"OLDEST"`.
+        
+        @return deferred list with a `(version, value)` tuple for each request,
+          in the same order. `None` if there is no such record.
+        """
+        gets = [{"record_id": _encrypt_key(self.encryption_key, key),
+                 "record_version": version} for key, version in requests]
+        
+        def got_response(response):
+            _, responses = response
+            d = _gather([self._decrypt(r["value"]) if "value" in r else defer.succeed(None)
+                         for r in responses])
+            d.addCallback(got_values, responses)
+            return d
+        
+        def got_values(values, responses):
+            results = []
+            for (key, _), r, value in zip(requests, responses, values):
+                if "value" in r:
+                    if self.cache is not None:
+                        self.cache.put(key, r["record_version"], value)
+                    results.append((r["record_version"], value))
+                else:
+                    results.append(None)
+            return results
+        
+        d = self._batch_request([], gets)
+        d.addCallback(got_response)
+        return d
+    
+    
+    def info(self, key):
+        """
+        Returns the version numbers of a key without any values, e.g. to
+        learn how far behind a reader is.
+        
+        @return deferred tuple with the oldest and the jungest version and the number
+          of stored versions. `None` if the key has no versions.
+        """
+        record_id = _encrypt_key(self.encryption_key, key)
+        server = self.ring.get(record_id)
+        url = "{base}/rec/{id}/INFO".format(base=server, id=urllib.quote(record_id, ''))
+        
+        def got_response(response):
+            return response["oldest"], response["jungest"], response["count"]
+        
+        def got_failure(failure):
+            if failure.check(Error) and int(failure.value.status) == httplib.NOT_FOUND:
+                return None
+            return failure
+        
+        d = self._request(server, "GET", url)
+        d.addCallback(json.loads)
+        d.addCallbacks(got_response, got_failure)
+        return d
+    
+    
+    def get_range(self, key, first, last=None):
+        """
+        Reads the stored versions of a key from `first` to `last`, both
+        included, with one request. Versions that are not stored (anymore)
+        are skipped. The values are decrypted together.
+        
+        The server limits the number and size of the versions in one response.
+        
+        @return deferred tuple with a list of `(version, value)` tuples, oldest first,
+          and the version to pass as `first` to read the rest of the range.
+          `None` if nothing is left.
+        """
+        record_id = _encrypt_key(self.encryption_key, key)
+        server = self.ring.get(record_id)
+        url = "{base}/rec/{id}/RANGE".format(base=server, id=urllib.quote(record_id, ''))
+        values = {"first": str(first)}
+        if last is not None:
+            values["last"] = str(last)
+        
+        def got_response(response):
+            versions = response["versions"]
+            data = [r["value"] for r in versions]
+            d = self._run_crypto(sum(len(value) for value in data), _decrypt_values, self.encryption_key, data)
+            d.addCallback(got_values, versions, response["next"])
+            return d
+        
+        def got_values(values, versions, next_version):
+            results = []
+            for r, value in zip(versions, values):
+                if self.cache is not None:
+                    self.cache.put(key, r["record_version"], value)
+                results.append((r["record_version"], value))
+            return results, next_version
+        
+        d = self._request(server, "GET", url, values)
+        d.addCallback(json.loads)
+        d.addCallback(got_response)
+        return d
+    
+    
+    def wait_any(self, versions):
+        """
+        Waits until any of several keys has a version newer than the given one.
+        One request per server watches all keys. The deferred can be canceled.
+        
+        :param versions: dict that maps keys to the version that is already known, 
+          `0` if none.
+        
+        @return deferred dict that maps the keys with newer versions to 
+          their jungest version.
+        """
+        keys = dict((_encrypt_key(self.encryption_key, key), key) for key in versions)
+        by_server = {}
+        for record_id, key in keys.items():
+            by_server.setdefault(self.ring.get(record_id), {})[record_id] = versions[key]
+        
+        def make_request(server, records):
+            url = "{base}/wait".format(base=server)
+            body = json.dumps({"records": records, "timeout": self.WAIT_TIMEOUT})
+            d = self._request(server, "POST", url, header={"Content-Type":["application/json"]}, body=body)
+            d.addCallback(json.loads)
+            d.addCallback(got_response, server, records)
+            return d
+        
+        def got_response(response, server, records):
+            if not response["records"]:
+                return make_request(server, records)
+            return dict((keys[record_id], version) for record_id, version in response["records"].items())
+        
+        if len(by_server) == 1:
+            server, records = by_server.popitem()
+            return make_request(server, records)
+        
+        def cancel_others():
+            for request in requests:
+                request.cancel()
+        
+        def got_first(result):
+            cancel_others()
+            newer, _ = result
+            return newer
+        
+        def got_failure(failure):
+            cancel_others()
+            failure.trap(defer.FirstError)
+            return failure.value.subFailure
+        
+        requests = [make_request(server, records) for server, records in by_server.items()]
+        d = defer.DeferredList(requests, fireOnOneCallback=True, fireOnOneErrback=True, consumeErrors=True)
+        d.addCallbacks(got_first, got_failure)
+        return d
+    
+    
+    def subscribe(self, key, from_version=None):
+        """
+        Follows the versions of a key over a persistent connection.
+        
+        :param from_version: First version to receive. Stored versions from
+          there on are received first. `None` to receive only new versions.
+        
+        @return :class:`Subscription`. Its `get()` returns a deferred with the
+          next `(version, value)` tuple.
+        """
+        from renat import subscription
+        record_id = _encrypt_key(self.encryption_key, key)
+        url = "ws{rest}/sub".format(rest=self.ring.get(record_id)[len("http"):])
+        return subscription.Subscription(url, record_id, from_version, 
+                                         lambda value: _decrypt_value(self.encryption_key, value))
+    
+    
+    def _encrypt(self, value, binary=False):
+        """
+        Returns a deferred with the encrypted value, as raw bytes if `binary`,
+        base64 encoded otherwise.
+        """
+        encrypt = _encrypt_bytes if binary else _encrypt_value
+        return self._run_crypto(len(value), encrypt, self.encryption_key, value, self.codec)
+    
+    
+    def _decrypt(self, data, binary=False):
+        """
+        Returns a deferred with the decrypted value.
+        """
+        decrypt = _decrypt_bytes if binary else _decrypt_value
+        return self._run_crypto(len(data), decrypt, self.encryption_key, data)
+    
+    
+    def _run_crypto(self, size, f, *args):
+        if size < self.inline_size or not self.crypto_threads:
+            return defer.maybeDeferred(f, *args)
+        if self._crypto_pool is None:
+            self._crypto_pool = ThreadPool(0, self.crypto_threads, name="renat-crypto")
+            self._crypto_pool.start()
+            self._crypto_pool_trigger = reactor.addSystemEventTrigger("during", "shutdown", self._crypto_pool.stop)
+        return threads.deferToThreadPool(reactor, self._crypto_pool, f, *args)
+    
+    
+    def _url(self, record_id, record_version, server):
         record_version = str(record_version)
         url = "{base}/rec/{id}/{version}".format(
-                    base=self.server,
+                    base=server,
                     id=urllib.quote(record_id, ''), 
                     version=urllib.quote(record_version, ''))
         return url
 
 
-    def _get(self, key, version, wait=False):
+    def _get(self, key, version, wait=False, etag=None, query=None):
+        """
+        :param etag: ETag of the cached value for this version. If the server 
+          replies that it did not change, the cached value is returned.
+        :param query: Dict with additional query parameters.
+        """
         
-        def make_request():
-            d = self._get_request(record_id, version, timeout = timeout)
+        def make_request(etag=None):
+            d = self._get_request(record_id, version, timeout = timeout, etag = etag, query = query)
             d.addCallbacks(got_response, got_failure)
             return d
         
         def got_response(response):
-            if "value" in response:
-                response["value"] = _decrypt_value(self.encryption_key, response["value"])
-            return response
+            if "binary_value" in response:
+                d = self._decrypt(response.pop("binary_value"), True)
+            elif "value" in response:
+                d = self._decrypt(response["value"])
+            else:
+                return response
+            def decrypted(value):
+                if self.cache is not None:
+                    self.cache.put(key, response["record_version"], value, 
+                                   response.get("etag"), response.get("max_age"))
+                response["value"] = value
+                return response
+            d.addCallback(decrypted)
+            return d
         
         def got_failure(failure):
-            if failure.check(Error) and wait and failure.value.status == httplib.NOT_FOUND:
+            status = int(failure.value.status) if failure.check(Error) else None
+            if wait and status == httplib.NOT_FOUND:
                 return make_request()
+            elif status == httplib.NOT_MODIFIED:
+                value = self.cache.revalidate(key, version)
+                if value is None:
+                    # dropped from the cache in the meantime.
+                    return make_request()
+                return {"record_version": version, "value": value}
             else:
                 return failure
         
         record_id = _encrypt_key(self.encryption_key, key)
-        timeout = 60 if wait else None
-        return make_request()
+        timeout = self.WAIT_TIMEOUT if wait else None
+        return make_request(etag)
 
 
-    def _get_request(self, record_id, record_version, timeout=None): 
-        url = self._url(record_id, record_version)
+    def _get_request(self, record_id, record_version, timeout=None, etag=None, query=None): 
+        server = self.ring.get(record_id)
+        url = self._url(record_id, record_version, server)
+        values = dict(query or {})
         if timeout:
-            values = {'timeout': str(timeout)}
-        else:
-            values = {}
-        d = httpclient.request("GET", url, values, pool=self.pool, proxy=self.proxy)
-        def gotit(v):
-            try:
-                return json.loads(v)
-            except BaseException as e:
-                print e
-        d.addCallback(gotit)
+            values['timeout'] = str(timeout)
+        header = {"Accept":[BINARY_TYPE]} if self.binary is not False else {}
+        if etag:
+            header["If-None-Match"] = [etag]
+        d = self._request(server, "GET", url, values, header, return_both=True)
+        d.addCallback(self._parse_response)
         return d
         
 
-    def _post_request(self, record_id, record_version, value):
+    def _post_request(self, record_id, record_version, value, binary=False):
         idepo = _get_random_string()
-        url = self._url(record_id, record_version)
-        d = httpclient.request("POST", url, {"idepo":idepo, "data":value}, {"Content-Type":["application/x-www-form-urlencoded"]},
-                    pool=self.pool, proxy=self.proxy)
-        d.addCallback(json.loads)
+        server = self.ring.get(record_id)
+        url = self._url(record_id, record_version, server)
+        if binary:
+            url += "?" + urllib.urlencode({"idepo":idepo})
+            d = self._request(server, "POST", url, header={"Content-Type":[BINARY_TYPE]}, body=value, return_both=True)
+        else:
+            d = self._request(server, "POST", url, {"idepo":idepo, "data":value}, {"Content-Type":["application/x-www-form-urlencoded"]},
+                        return_both=True)
+        d.addCallback(self._parse_response)
+        return d
+    
+    
+    def _request(self, server, method, url, *args, **kwargs):
+        """
+        `httpclient.request` to one of the servers, with its connection pool. 
+        If the server rejects the request with 429, it is sent again after 
+        :func:`_retry_delay`, up to `max_retries` times. The deferred can be canceled
+        while waiting.
+        """
+        def make_request(attempt):
+            d = httpclient.request(method, url, *args, pool=self.pools[server], proxy=self.proxy, **kwargs)
+            d.addErrback(got_failure, attempt)
+            return d
+        
+        def got_failure(failure, attempt):
+            if (not failure.check(Error) or int(failure.value.status) != TOO_MANY_REQUESTS 
+                    or attempt >= self.max_retries or server not in self.pools):
+                return failure
+            return task.deferLater(reactor, _retry_delay(failure.value, attempt), make_request, attempt + 1)
+        
+        return make_request(0)
+    
+    
+    def _parse_response(self, response):
+        """
+        Returns the response to a GET or POST of a single record as a dict, 
+        as the server sends it in JSON. Raw values of binary mode are in 
+        `binary_value` instead of `value`. The ETag and the seconds the response 
+        may be cached are added as `etag` and `max_age`, if the server sent them.
+        """
+        headers, body = response
+        if self.binary is None and "X-Renat-Binary" in headers:
+            self.binary = True
+        
+        if "X-Record-Version" not in headers:
+            result = json.loads(body)
+        else:
+            result = {"record_id": headers["X-Record-Id"][0],
+                      "record_version": int(headers["X-Record-Version"][0])}
+            content_type = headers.get("Content-Type", [""])[0]
+            if content_type.startswith(BINARY_TYPE):
+                result["binary_value"] = body
+            elif content_type.startswith("text/plain"):
+                # stored by a client that did not use binary mode.
+                result["value"] = body.decode("utf-8")
+        
+        if "ETag" in headers:
+            result["etag"] = headers["ETag"][0]
+        for directive in headers.get("Cache-Control", [""])[0].split(","):
+            name, _, value = directive.strip().partition("=")
+            if name == "max-age" and value.isdigit():
+                result["max_age"] = int(value)
+        return result
+
+
+    def _batch_request(self, puts, gets):
+        """
+        Sends one batch request to each server that owns some of the records.
+        
+        @return deferred tuple with the put and the get results, in the order of `puts` and `gets`.
+        """
+        by_server = {}
+        for kind, items in (("puts", puts), ("gets", gets)):
+            for position, item in enumerate(items):
+                batch = by_server.setdefault(self.ring.get(item["record_id"]), {"puts": [], "gets": []})
+                batch[kind].append((position, item))
+        
+        def request(server, batch):
+            url = "{base}/batch".format(base=server)
+            body = json.dumps({"puts": [item for _, item in batch["puts"]], 
+                               "gets": [item for _, item in batch["gets"]]})
+            d = self._request(server, "POST", url, header={"Content-Type":["application/json"]}, body=body)
+            d.addCallback(json.loads)
+            return d
+        
+        def got_responses(responses):
+            results = {"puts": [None] * len(puts), "gets": [None] * len(gets)}
+            for (_, batch), response in zip(batches, responses):
+                for kind in ("puts", "gets"):
+                    for (position, _), result in zip(batch[kind], response[kind]):
+                        results[kind][position] = result
+            return results["puts"], results["gets"]
+        
+        batches = list(by_server.items())
+        d = _gather([request(server, batch) for server, batch in batches])
+        d.addCallback(got_responses)
         return d
 
 
+def _retry_delay(error, attempt):
+    """
+    Seconds to wait before retrying a request that was rejected with `error`.
+    At least the `Retry-After` of the server, and doubling with each attempt, plus jitter.
+    """
+    delay = RETRY_DELAY * 2 ** attempt
+    try:
+        delay = max(delay, float(error.headers["Retry-After"][0]))
+    except (AttributeError, KeyError, ValueError):
+        pass
+    return delay * (1 + random.random() * RETRY_JITTER)
+
+
+def _gather(deferreds):
+    """
+    Returns a deferred with the list of the results, or the first failure.
+    """
+    d = defer.gatherResults(deferreds, consumeErrors=True)
+    d.addErrback(lambda failure: failure.value.subFailure)
+    return d
+
 def _encrypt_key(key, plaintext):
     return hmac.new(key, plaintext, hashlib.sha1).hexdigest()
 
@@ -158,8 +651,59 @@ def _get_random_string():
     binary = Random.get_random_bytes(8)
     return base64.b64encode(binary)
 
-def _encrypt_value(key, plaintext):
-    compressed = bz2.compress(plaintext)
+#: Values shorter than this are not compressed by the `"auto"` codec.
+#: Compressing them costs more time than it could save in bytes.
+AUTO_MIN_SIZE = 128
+
+#: Name of each codec, mapped to the byte that precedes the compressed data.
+#: `bz2` has no such byte, its data starts with `BZh`. That is the format 
+#: from before there were codecs.
+_CODECS = {"none": "\x00", "zlib": "\x01", "bz2": "", "lzma": "\x03"}
+
+_DECOMPRESS_ERRORS = (IOError, EOFError, ValueError, zlib.error) + ((lzma.LZMAError,) if lzma else ())
+
+def _compress(plaintext, codec):
+    if codec == "auto":
+        if len(plaintext) < AUTO_MIN_SIZE:
+            return _CODECS["none"] + plaintext
+        compressed = zlib.compress(plaintext)
+        if len(compressed) < len(plaintext):
+            return _CODECS["zlib"] + compressed
+        else:
+            return _CODECS["none"] + plaintext
+    elif codec == "none":
+        return _CODECS["none"] + plaintext
+    elif codec == "zlib":
+        return _CODECS["zlib"] + zlib.compress(plaintext)
+    elif codec == "bz2":
+        return bz2.compress(plaintext)
+    elif codec == "lzma":
+        if lzma is None:
+            raise ValueError("lzma codec not available.")
+        return _CODECS["lzma"] + lzma.compress(plaintext)
+    else:
+        raise ValueError("Unknown codec %s" % repr(codec))
+
+def _decompress(compressed):
+    marker = compressed[:1]
+    try:
+        if marker == _CODECS["none"]:
+            return compressed[1:]
+        elif marker == _CODECS["zlib"]:
+            return zlib.decompress(compressed[1:])
+        elif marker == _CODECS["lzma"] and lzma is not None:
+            return lzma.decompress(compressed[1:])
+        elif compressed.startswith("BZh"):
+            return bz2.decompress(compressed)
+    except _DECOMPRESS_ERRORS:
+        pass
+    raise ValueError("decryption failed, unsupported codec or corrupted data.")
+
+def _encrypt_value(key, plaintext, codec="bz2"):
+    return base64.b64encode(_encrypt_bytes(key, plaintext, codec))
+
+def _encrypt_bytes(key, plaintext, codec="bz2"):
+    compressed = _compress(plaintext, codec)
     
     digest = SHA.new(compressed).digest()
     
@@ -171,13 +715,15 @@ def _encrypt_value(key, plaintext):
     cipher = AES.new(key, AES.MODE_CBC, iv)
     
     ciphertext = cipher.encrypt(padded)
-    binary = iv + ciphertext
-    return base64.b64encode(binary)
+    return iv + ciphertext
+
+def _decrypt_values(key, data):
+    return [_decrypt_value(key, value) for value in data]
 
 def _decrypt_value(key, data):
-    
-    binary = base64.b64decode(data)
-    
+    return _decrypt_bytes(key, base64.b64decode(data))
+
+def _decrypt_bytes(key, binary):
     if len(binary) < AES.block_size:
         raise ValueError("decryption failed, Invalid format.")
     iv = binary[:AES.block_size]
@@ -205,7 +751,7 @@ def _decrypt_value(key, data):
     if digest_msg != digest_real:
         raise ValueError("decryption failed, Invalid password or corrupted data.")
     
-    plaintext = bz2.decompress(compressed)
+    plaintext = _decompress(compressed)
     return plaintext
 
 def _make_key(secret):
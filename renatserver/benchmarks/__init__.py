@@ -0,0 +1,7 @@
+# Copyright (C) 2014 Stefan C. Mueller
+"""
+Benchmarks for the server. They are not run as part of the tests.
+Run them from the `renatserver` directory, e.g.::
+
+    python -m benchmarks.bench_ddlist --records 1000000
+"""
@@ -0,0 +1,187 @@
+# Copyright (C) 2014 Stefan C. Mueller
+"""
+Per-operation cost and garbage collector pause time of :class:`ddlist.LinkedList`
+compared to the previous implementation that stored the links as attributes
+on the items.
+
+The items are :class:`InMemoryRecordDatabase._Record` instances that are
+in two lists at the same time, just like in the database. Each implementation
+is run with millions of records. Reported are the pauses of the collections
+the garbage collector started by itself while the records were created and
+linked (Python 3 only, Python 2 has no `gc.callbacks`), and the pause of a
+full collection with all records alive, the worst case for a server.
+"""
+from __future__ import print_function
+
+import argparse
+import datetime
+import gc
+import timeit
+
+from renatserver import ddlist, db
+
+
+class AttributeLinkedList(object):
+    """
+    The previous implementation, reduced to the operations used by the database.
+    Links are stored with `setattr` under per-list attribute names.
+    """
+
+    _next_name = 0
+
+    def __init__(self):
+        self.name = str(AttributeLinkedList._next_name)
+        AttributeLinkedList._next_name += 1
+        self._sentinel = self._Sentinel()
+        self._setleft(self._sentinel, self._sentinel)
+        self._setright(self._sentinel, self._sentinel)
+
+    def append_right(self, item):
+        if hasattr(item, "_%s_left" % self.name):
+            raise ValueError("already in the list")
+        neighbor = self._getleft(self._sentinel)
+        self._setleft(item, neighbor)
+        self._setright(item, self._sentinel)
+        self._setleft(self._sentinel, item)
+        self._setright(neighbor, item)
+
+    def remove(self, item):
+        if not hasattr(item, "_%s_left" % self.name):
+            raise ValueError("item not in the list")
+        leftitem = self._getleft(item)
+        rightitem = self._getright(item)
+        self._setright(leftitem, rightitem)
+        self._setleft(rightitem, leftitem)
+        delattr(item, "_%s_left" % self.name)
+        delattr(item, "_%s_right" % self.name)
+
+    def _getleft(self, item):
+        return getattr(item, "_%s_left" % self.name)
+
+    def _setleft(self, item, value):
+        setattr(item, "_%s_left" % self.name, value)
+
+    def _getright(self, item):
+        return getattr(item, "_%s_right" % self.name)
+
+    def _setright(self, item, value):
+        setattr(item, "_%s_right" % self.name, value)
+
+    class _Sentinel(object):
+        pass
+
+
+class AttributeRecord(object):
+    """
+    The previous record class, with an instance `__dict__`.
+    """
+
+    def __init__(self, record_id, record_version, idepo_nr, time, data):
+        self.record_id = record_id
+        self.record_version = record_version
+        self.idepo_nr = idepo_nr
+        self.time = time
+        self.data = data
+
+
+class PauseTimer(object):
+    """
+    Measures the pauses of the collections started by the garbage collector
+    itself, using `gc.callbacks`.
+    """
+
+    def __init__(self):
+        #: duration of each collection in seconds.
+        self.pauses = []
+        self._start = None
+
+    @staticmethod
+    def supported():
+        return hasattr(gc, "callbacks")
+
+    def __enter__(self):
+        if self.supported():
+            gc.callbacks.append(self._callback)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.supported():
+            gc.callbacks.remove(self._callback)
+
+    def _callback(self, phase, info):
+        if phase == "start":
+            self._start = timeit.default_timer()
+        elif self._start is not None:
+            self.pauses.append(timeit.default_timer() - self._start)
+            self._start = None
+
+    def summary(self):
+        if not self.supported():
+            return "gc pauses n/a"
+        return "%5d gc pauses, %7.1f ms total, %6.1f ms max" % (
+            len(self.pauses), sum(self.pauses) * 1e3, max(self.pauses or [0]) * 1e3)
+
+
+def run(name, list_factory, record_factory, count, repeat):
+    now = datetime.datetime.now()
+    pauses = PauseTimer()
+    with pauses:
+        records = [record_factory("id%s" % i, 1, str(i), now, "x") for i in range(count)]
+        evict_list = list_factory()
+        version_lists = [list_factory() for _ in range(count // 4 + 1)]
+        append_time, touch_time = _append_and_touch(records, evict_list, version_lists)
+
+    full_gc_times = []
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        gc.collect()
+        full_gc_times.append(timeit.default_timer() - start)
+
+    start = timeit.default_timer()
+    for i, record in enumerate(records):
+        evict_list.remove(record)
+        version_lists[i // 4].remove(record)
+    remove_time = timeit.default_timer() - start
+
+    print("%-10s append %6.0f ns/op   touch %6.0f ns/op   remove %6.0f ns/op" % (
+          name,
+          append_time / count / 2 * 1e9,
+          touch_time / count * 1e9,
+          remove_time / count / 2 * 1e9))
+    print("%-10s %s   full gc %7.1f ms (max of %s)" % (
+          "", pauses.summary(), max(full_gc_times) * 1e3, repeat))
+
+
+def _append_and_touch(records, evict_list, version_lists):
+    start = timeit.default_timer()
+    for i, record in enumerate(records):
+        evict_list.append_right(record)
+        version_lists[i // 4].append_right(record)
+    append_time = timeit.default_timer() - start
+
+    start = timeit.default_timer()
+    for record in records:
+        evict_list.remove(record)
+        evict_list.append_right(record)
+    touch_time = timeit.default_timer() - start
+    return append_time, touch_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--records", type=int, nargs="+", default=[1000000, 2000000, 4000000],
+                        help="number of records, one run per number")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="number of full collections to time")
+    args = parser.parse_args()
+
+    for count in args.records:
+        print("%s records, each in the evict list and in a version list" % count)
+        run("attribute", AttributeLinkedList, AttributeRecord, count, args.repeat)
+        gc.collect()
+        run("slots", ddlist.LinkedList, db.InMemoryRecordDatabase._Record, count, args.repeat)
+        gc.collect()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+# Copyright (C) 2014 Stefan C. Mueller
+"""
+Memory use and put/get throughput of the record store backends.
+
+Every backend is measured in a fresh interpreter, so that memory
+released by one does not distort the numbers of the other.
+Records look like the ones `WebClient` stores: 40 character ids,
+12 character idepos and base64 encoded payloads.
+"""
+from __future__ import print_function
+
+import argparse
+import base64
+import datetime
+import json
+import os
+import random
+import subprocess
+import sys
+import timeit
+
+from renatserver import db, arenadb
+
+BACKENDS = {"memory": db.InMemoryRecordDatabase,
+            "arena": arenadb.ArenaRecordDatabase}
+
+
+def rss_bytes():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def measure(backend, records, versions, payload_size):
+    rng = random.Random(42)
+    now = datetime.datetime.now()
+    ids = ["%040x" % rng.getrandbits(160) for _ in range(records // versions)]
+    payloads = [base64.b64encode(os.urandom(payload_size)).decode("ascii") for _ in range(256)]
+
+    before = rss_bytes()
+    database = BACKENDS[backend](max_records=records + 1, max_size=4 * payload_size + 64)
+
+    start = timeit.default_timer()
+    for i in range(records):
+        database.put(ids[i % len(ids)], "%012x" % i, payloads[i % len(payloads)], now)
+    put_time = timeit.default_timer() - start
+
+    start = timeit.default_timer()
+    for i in range(records):
+        database.get(ids[i % len(ids)], i // len(ids) + 1, now)
+    get_time = timeit.default_timer() - start
+
+    after = rss_bytes()
+    return {"backend": backend,
+            "records": records,
+            "rss_bytes": after - before,
+            "bytes_per_record": float(after - before) / records,
+            "payload_bytes_per_record": len(payloads[0]),
+            "put_ns": put_time / records * 1e9,
+            "get_ns": get_time / records * 1e9}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--records", type=int, default=1000000)
+    parser.add_argument("--versions", type=int, default=4, help="versions per record id")
+    parser.add_argument("--payload", type=int, default=128, help="payload size before base64 encoding")
+    parser.add_argument("--backend", choices=sorted(BACKENDS.keys()), help="measure only this backend in this process")
+    args = parser.parse_args()
+
+    if args.backend:
+        result = measure(args.backend, args.records, args.versions, args.payload)
+        print(json.dumps(result))
+        return
+
+    print("%s records, %s versions per id, %s byte payload (base64)" % (args.records, args.versions, args.payload))
+    for backend in ("memory", "arena"):
+        output = subprocess.check_output([sys.executable, "-m", "benchmarks.bench_memory",
+                                          "--records", str(args.records),
+                                          "--versions", str(args.versions),
+                                          "--payload", str(args.payload),
+                                          "--backend", backend])
+        result = json.loads(output.decode("utf-8"))
+        print("%-8s %7.1f MB   %5.0f bytes/record (payload %s)   put %5.0f ns   get %5.0f ns" % (
+              backend, result["rss_bytes"] / 1e6, result["bytes_per_record"],
+              result["payload_bytes_per_record"], result["put_ns"], result["get_ns"]))
+
+
+if __name__ == '__main__':
+    main()
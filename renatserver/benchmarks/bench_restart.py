@@ -0,0 +1,91 @@
+# Copyright (C) 2014 Stefan C. Mueller
+"""
+Startup time of a record store restored from its write log.
+
+Fills a store with a write log, then measures how long a fresh store
+needs to replay it: once from the segments as written, once after a
+compaction into a snapshot, and once with a part of the records expired.
+Records look like the ones `WebClient` stores: 40 character ids,
+12 character idepos and base64 encoded payloads.
+"""
+from __future__ import print_function
+
+import argparse
+import base64
+import datetime
+import os
+import random
+import shutil
+import tempfile
+import timeit
+
+from renatserver import db, wal
+
+
+def directory_size(directory):
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+
+def fill(directory, records, versions, payload_size, now):
+    rng = random.Random(42)
+    ids = ["%040x" % rng.getrandbits(160) for _ in range(records // versions)]
+    payloads = [base64.b64encode(os.urandom(payload_size)).decode("ascii") for _ in range(256)]
+
+    log = wal.WriteLog(directory)
+    database = db.InMemoryRecordDatabase(max_records=records + 1, max_size=4 * payload_size + 64, log=log)
+    start = timeit.default_timer()
+    for i in range(records):
+        database.put(ids[i % len(ids)], "%012x" % i, payloads[i % len(payloads)], now)
+        if i % 10000 == 0:
+            log.commit()
+    log.commit()
+    put_time = timeit.default_timer() - start
+    return database, put_time
+
+
+def replay(directory, records, payload_size, now):
+    database = db.InMemoryRecordDatabase(max_records=records + 1, max_size=4 * payload_size + 64,
+                                         log=wal.WriteLog(directory))
+    start = timeit.default_timer()
+    count = database.replay(now)
+    return count, timeit.default_timer() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--records", type=int, default=1000000)
+    parser.add_argument("--versions", type=int, default=4, help="versions per record id")
+    parser.add_argument("--payload", type=int, default=128, help="payload size before base64 encoding")
+    args = parser.parse_args()
+
+    now = datetime.datetime.now()
+    directory = tempfile.mkdtemp(prefix="renat-bench-")
+    try:
+        print("%s records, %s versions per id, %s byte payload (base64)" % (args.records, args.versions, args.payload))
+        database, put_time = fill(directory, args.records, args.versions, args.payload, now)
+        print("put with log:        %8.0f ns/op, log %6.1f MB" % (put_time / args.records * 1e9, directory_size(directory) / 1e6))
+
+        count, seconds = replay(directory, args.records, args.payload, now)
+        print("replay segments:     %8.2f s, %s versions" % (seconds, count))
+
+        start = timeit.default_timer()
+        for _ in database.log.compact(database.snapshot()):
+            pass
+        compact_time = timeit.default_timer() - start
+        print("compact:             %8.2f s, log %6.1f MB" % (compact_time, directory_size(directory) / 1e6))
+
+        count, seconds = replay(directory, args.records, args.payload, now)
+        print("replay snapshot:     %8.2f s, %s versions" % (seconds, count))
+
+        # Half of the versions were accessed after `eviction_time`, the rest expired.
+        for record in database.snapshot()[::2]:
+            database.touch(record.record_id, record.record_version, now + database.eviction_time)
+        database.log.commit()
+        count, seconds = replay(directory, args.records, args.payload, now + database.eviction_time * 3 // 2)
+        print("replay half expired: %8.2f s, %s versions" % (seconds, count))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+# Copyright (C) 2014 Stefan C. Mueller
+"""
+Micro-benchmarks of the hot paths of :class:`db.InMemoryRecordDatabase` and
+:class:`ddlist.LinkedList`, at several store sizes, with regression gating.
+
+    list_append    `LinkedList.append_right` of all records.
+    list_remove    `LinkedList.remove` of all records, in random order.
+    put            puts into an empty store until it holds all records.
+    churn          puts into a full store, each evicts the least recently accessed version.
+    touch_uniform  gets of random stored versions, each resets the eviction timer.
+    touch_hot      like `touch_uniform`, but 90% of the gets go to 1% of the versions.
+    expiry_burst   `evict` of a store in which all versions expired at once.
+
+Each benchmark is run `--repeat` times, the fastest run counts. The garbage
+collector is disabled while timing, as in `timeit`. `--save` stores the
+results as a baseline, `--compare` exits with status 1 if an operation
+got slower than its baseline by more than `--threshold`::
+
+    python -m benchmarks.bench_suite --save baseline.json
+    python -m benchmarks.bench_suite --compare baseline.json --threshold 0.1
+"""
+from __future__ import print_function
+
+import argparse
+import base64
+import datetime
+import gc
+import json
+import random
+import sys
+import timeit
+
+from renatserver import ddlist, db
+
+NOW = datetime.datetime(2014, 1, 1)
+
+#: Versions per record id.
+VERSIONS = 4
+
+#: Payload like the ones `WebClient` stores.
+DATA = base64.b64encode(b"x" * 128).decode("ascii")
+
+
+class Timer(object):
+    """
+    Context manager that measures the wall time with the garbage collector disabled.
+    """
+
+    def __enter__(self):
+        self.gc_enabled = gc.isenabled()
+        gc.disable()
+        self.start = timeit.default_timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = timeit.default_timer() - self.start
+        if self.gc_enabled:
+            gc.enable()
+
+
+def record_ids(size):
+    return ["%040x" % i for i in range(size // VERSIONS + 1)]
+
+
+def fill(size, **kwargs):
+    """
+    Returns a store with `size` versions, all put at `NOW`, and the list of their `(id, version)`.
+    """
+    database = db.InMemoryRecordDatabase(max_records=size, max_size=len(DATA), **kwargs)
+    ids = record_ids(size)
+    keys = []
+    for i in range(size):
+        record_id = ids[i // VERSIONS]
+        keys.append((record_id, database.put(record_id, "%012x" % i, DATA, NOW)))
+    return database, keys
+
+
+def list_append(size, ops):
+    items = [db.InMemoryRecordDatabase._Record("%040x" % i, 1, "%012x" % i, NOW, DATA) for i in range(size)]
+    target = ddlist.LinkedList()
+    with Timer() as timer:
+        for item in items:
+            target.append_right(item)
+    return timer.seconds, size
+
+
+def list_remove(size, ops):
+    items = [db.InMemoryRecordDatabase._Record("%040x" % i, 1, "%012x" % i, NOW, DATA) for i in range(size)]
+    target = ddlist.LinkedList(items)
+    random.Random(42).shuffle(items)
+    with Timer() as timer:
+        for item in items:
+            target.remove(item)
+    return timer.seconds, size
+
+
+def put(size, ops):
+    database = db.InMemoryRecordDatabase(max_records=size, max_size=len(DATA))
+    ids = record_ids(size)
+    with Timer() as timer:
+        for i in range(size):
+            database.put(ids[i // VERSIONS], "%012x" % i, DATA, NOW)
+    return timer.seconds, size
+
+
+def churn(size, ops):
+    database, _ = fill(size)
+    ids = record_ids(size)
+    rng = random.Random(42)
+    puts = [(rng.choice(ids), "%012x" % (size + i)) for i in range(ops)]
+    with Timer() as timer:
+        for record_id, idepo in puts:
+            database.put(record_id, idepo, DATA, NOW)
+    return timer.seconds, ops
+
+
+def touch_uniform(size, ops):
+    database, keys = fill(size)
+    rng = random.Random(42)
+    gets = [rng.choice(keys) for _ in range(ops)]
+    with Timer() as timer:
+        for record_id, record_version in gets:
+            database.get(record_id, record_version, NOW)
+    return timer.seconds, ops
+
+
+def touch_hot(size, ops):
+    database, keys = fill(size)
+    rng = random.Random(42)
+    hot = keys[:max(1, size // 100)]
+    gets = [rng.choice(hot) if rng.random() < 0.9 else rng.choice(keys) for _ in range(ops)]
+    with Timer() as timer:
+        for record_id, record_version in gets:
+            database.get(record_id, record_version, NOW)
+    return timer.seconds, ops
+
+
+def expiry_burst(size, ops):
+    database, _ = fill(size)
+    later = NOW + database.eviction_time * 2
+    with Timer() as timer:
+        count = database.evict(later)
+    return timer.seconds, count
+
+
+BENCHMARKS = (list_append, list_remove, put, churn, touch_uniform, touch_hot, expiry_burst)
+
+
+def run(benchmarks, sizes, ops, repeat):
+    """
+    Returns a dict that maps `"name@size"` to the nanoseconds per operation.
+    """
+    results = {}
+    for size in sizes:
+        for benchmark in benchmarks:
+            best = None
+            for _ in range(repeat):
+                seconds, count = benchmark(size, ops)
+                gc.collect()
+                best = min(best, seconds / count) if best is not None else seconds / count
+            name = "%s@%s" % (benchmark.__name__, size)
+            results[name] = best * 1e9
+            print("%-24s %10.0f ns/op" % (name, results[name]))
+            sys.stdout.flush()
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints the change relative to the baseline and returns the names of
+    the operations that got slower by more than `threshold`.
+    """
+    regressions = []
+    print()
+    print("%-24s %10s %10s %8s" % ("", "baseline", "now", "change"))
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        change = results[name] / baseline[name] - 1
+        regressed = change > threshold
+        if regressed:
+            regressions.append(name)
+        print("%-24s %10.0f %10.0f %+7.1f%%%s" % (name, baseline[name], results[name], change * 100,
+                                                 "  REGRESSION" if regressed else ""))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="comma separated store sizes")
+    parser.add_argument("--ops", type=int, default=100000, help="operations per run for churn and touch benchmarks")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", default=None, help="comma separated benchmark names")
+    parser.add_argument("--save", default=None, help="file to store the results as baseline")
+    parser.add_argument("--compare", default=None, help="baseline file to compare with")
+    parser.add_argument("--threshold", type=float, default=0.15, help="tolerated slowdown, 0.15 for 15%%")
+    args = parser.parse_args()
+
+    benchmarks = BENCHMARKS
+    if args.only:
+        names = args.only.split(",")
+        benchmarks = [benchmark for benchmark in BENCHMARKS if benchmark.__name__ in names]
+        if len(benchmarks) != len(names):
+            parser.error("Unknown benchmark in %s" % repr(args.only))
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    results = run(benchmarks, sizes, args.ops, args.repeat)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"python": sys.version.split()[0], "results": results}, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline["python"] != sys.version.split()[0]:
+            print("Baseline was measured with Python %s." % baseline["python"])
+        regressions = compare(results, baseline["results"], args.threshold)
+        if regressions:
+            print("%s operations slower than the baseline by more than %.0f%%." % (len(regressions), args.threshold * 100))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# Copyright (C) 2014 Stefan C. Mueller
+"""
+IOLoop cost of parked long-polls with `tornado.gen.with_timeout`, one
+timer per request, compared to :class:`timeouts.TimeoutWheel`, one timer
+per deadline slot.
+
+For each number of waiters it measures the CPU time to park them, the CPU
+used by the otherwise idle loop while they wait (with a 10 ms callback standing
+in for other traffic), to resolve all of them as `put` does, and to let a
+second batch with timeouts spread over a few seconds expire.
+"""
+from __future__ import print_function
+
+import argparse
+import datetime
+import os
+import random
+import resource
+
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+
+from renatserver import timeouts
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def tornado_timeout(timeout, future):
+    return tornado.gen.with_timeout(datetime.timedelta(seconds=timeout), future)
+
+
+@tornado.gen.coroutine
+def measure(with_timeout, count, idle, spread):
+    rng = random.Random(42)
+    ticker = tornado.ioloop.PeriodicCallback(lambda: None, 10)
+    ticker.start()
+
+    futures = [tornado.concurrent.Future() for _ in range(count)]
+    start = cpu_time()
+    results = [with_timeout(60, future) for future in futures]
+    park = cpu_time() - start
+
+    start = cpu_time()
+    yield tornado.gen.sleep(idle)
+    idle_cpu = (cpu_time() - start) / idle
+
+    start = cpu_time()
+    for future in futures:
+        future.set_result(None)
+    yield results
+    resolve = cpu_time() - start
+
+    results = [with_timeout(0.5 + rng.random() * spread, tornado.concurrent.Future()) for _ in range(count)]
+    start = cpu_time()
+    for result in results:
+        try:
+            yield result
+        except tornado.gen.TimeoutError:
+            pass
+    # includes the idle cost of the loop while they expire.
+    expire = cpu_time() - start
+    ticker.stop()
+
+    raise tornado.gen.Return((park, idle_cpu, resolve, expire))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--counts", default="1000,10000,100000", help="comma separated numbers of waiters")
+    parser.add_argument("--idle", type=float, default=2.0, help="seconds of idle time measured")
+    parser.add_argument("--spread", type=float, default=3.0, help="seconds over which the timeouts of the expiry batch are spread")
+    args = parser.parse_args()
+
+    print("pid %s, CPU per waiter in microseconds, idle loop CPU in percent" % os.getpid())
+    print("%-12s %8s %8s %8s %8s %8s" % ("", "waiters", "park", "idle %", "resolve", "expire"))
+    for count in [int(count) for count in args.counts.split(",")]:
+        for name, with_timeout in (("with_timeout", tornado_timeout),
+                                   ("wheel", timeouts.TimeoutWheel().with_timeout)):
+            io_loop = tornado.ioloop.IOLoop()
+            io_loop.make_current()
+            park, idle_cpu, resolve, expire = io_loop.run_sync(lambda: measure(with_timeout, count, args.idle, args.spread))
+            io_loop.clear_current()
+            io_loop.close()
+            print("%-12s %8d %8.2f %8.1f %8.2f %8.2f" % (
+                name, count, park / count * 1e6, idle_cpu * 100, resolve / count * 1e6, expire / count * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+# Copyright (C) 2014 Stefan C. Mueller
+
+import time
+
+
+class AdmissionControl(object):
+    """
+    Limits what a single client, identified by its IP address (as in the
+    `X-Request-From` header), can ask of the server, so that one misbehaving
+    client cannot slow down everyone else.
+
+    Each IP has a token bucket that refills with `rate` tokens per second up
+    to `burst`. A request takes one token, a batch one per item. Long-polls
+    also count against `max_waiters_per_ip` and `max_waiters` while they wait.
+    Rejected requests are answered with 429 and the seconds after which
+    they would be admitted, see `renatserver.handler`.
+
+    All limits are off if set to 0.
+    """
+
+    #: Seconds a client is asked to wait if there are too many long-polls,
+    #: it cannot be known when one of them returns.
+    WAITERS_RETRY_AFTER = 1.0
+
+    #: Seconds between two calls of :meth:`prune` from :meth:`admit`.
+    PRUNE_INTERVAL = 60.0
+
+    def __init__(self, rate=0, burst=0, max_waiters_per_ip=0, max_waiters=0):
+        """
+        :param rate: Requests per second per IP, on average.
+
+        :param burst: Requests an IP can make at once after it was idle.
+          Defaults to one second worth of `rate`.
+
+        :param max_waiters_per_ip: Maximal number of concurrent long-polls per IP.
+
+        :param max_waiters: Maximal number of concurrent long-polls of all clients.
+        """
+        self.rate = rate
+        self.burst = burst or rate
+        self.max_waiters_per_ip = max_waiters_per_ip
+        self.max_waiters = max_waiters
+
+        #: number of long-polls admitted and not yet finished.
+        self.waiters = 0
+
+        #: number of requests rejected because of the rate limit.
+        self.rejected_rate = 0
+
+        #: number of long-polls rejected because of `max_waiters_per_ip` or `max_waiters`.
+        self.rejected_waiters = 0
+
+        #: dict maps IP to its `_Bucket`. Buckets that are full again are dropped by :meth:`prune`.
+        self._buckets = {}
+
+        #: dict maps IP to its number of long-polls.
+        self._waiters = {}
+
+        #: time of the last :meth:`prune`.
+        self._pruned = None
+
+    def admit(self, ip, cost=1, now=None):
+        """
+        Takes `cost` tokens from the bucket of `ip`. A cost above `burst`
+        takes the full bucket.
+
+        :returns: `0` if the request is admitted, otherwise the seconds
+          after which it would be.
+        """
+        if not self.rate:
+            return 0
+        if now is None:
+            now = time.time()
+        if self._pruned is None or now - self._pruned >= self.PRUNE_INTERVAL:
+            self.prune(now)
+        cost = min(cost, self.burst)
+
+        bucket = self._buckets.get(ip, None)
+        if bucket is None:
+            bucket = _Bucket(self.burst, now)
+            self._buckets[ip] = bucket
+        else:
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.time) * self.rate)
+            bucket.time = now
+
+        if bucket.tokens >= cost:
+            bucket.tokens -= cost
+            return 0
+        self.rejected_rate += 1
+        return (cost - bucket.tokens) / float(self.rate)
+
+    def enter_waiter(self, ip):
+        """
+        Counts a long-poll of `ip`, which has to be reported to
+        :meth:`leave_waiter` once it returns.
+
+        :returns: `False` if there are too many long-polls already,
+          the long-poll is not counted then.
+        """
+        count = self._waiters.get(ip, 0)
+        if ((self.max_waiters and self.waiters >= self.max_waiters) or
+                (self.max_waiters_per_ip and count >= self.max_waiters_per_ip)):
+            self.rejected_waiters += 1
+            return False
+        self._waiters[ip] = count + 1
+        self.waiters += 1
+        return True
+
+    def leave_waiter(self, ip):
+        count = self._waiters[ip] - 1
+        if count:
+            self._waiters[ip] = count
+        else:
+            del self._waiters[ip]
+        self.waiters -= 1
+
+    def prune(self, now=None):
+        """
+        Drops the buckets that are full again, a new bucket behaves the same.
+        Keeps the memory bounded by the number of recently active IPs.
+        Called by :meth:`admit` every :attr:`PRUNE_INTERVAL` seconds.
+
+        :returns: Number of dropped buckets.
+        """
+        if now is None:
+            now = time.time()
+        self._pruned = now
+        full = [ip for ip, bucket in self._buckets.items()
+                if bucket.tokens + (now - bucket.time) * self.rate >= self.burst]
+        for ip in full:
+            del self._buckets[ip]
+        return len(full)
+
+
+class _Bucket(object):
+
+    __slots__ = ("tokens", "time")
+
+    def __init__(self, tokens, time):
+        #: tokens at `time`.
+        self.tokens = tokens
+        self.time = time
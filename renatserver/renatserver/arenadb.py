@@ -0,0 +1,552 @@
+# Copyright (C) 2014 Stefan C. Mueller
+
+import array
+import bisect
+import datetime
+
+#: Slot index of the sentinel of the evict list.
+_SENTINEL = 0
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+class ArenaRecordDatabase(object):
+    """
+    In-memory key-value store with the same interface as :class:`InMemoryRecordDatabase`,
+    but without a Python object per record version.
+
+    Each stored version occupies a slot. The metadata of all versions is
+    kept in parallel typed arrays indexed by slot, the payloads in large
+    byte arenas. Per record id there is only an array with the slots of
+    its versions, ordered by version, and per version a single entry in
+    the idepo dict.
+    """
+
+    #: Size in bytes of each chunk allocated for an arena.
+    CHUNK_SIZE = 1024*1024
+
+    #: Ratio between the block sizes of two consecutive arenas.
+    #: Smaller values waste less memory per payload but create more arenas.
+    SIZE_CLASS_GROWTH = 1.25
+
+    def __init__(self, max_records=1024*1024, max_size=1024, max_id_size=64, eviction_time=None, max_bytes=None):
+        """
+        See :class:`InMemoryRecordDatabase`.
+        """
+        if not eviction_time:
+            eviction_time = datetime.timedelta(seconds=300)
+        self.eviction_time = eviction_time
+        self._eviction_seconds = eviction_time.total_seconds()
+
+        self.max_records = max_records
+
+        self.max_size = max_size
+
+        self.max_id_size = max_id_size
+
+        self.max_bytes = max_bytes
+
+        #: total size of the stored data (UTF-8 encoded if text), ids and idepos.
+        self.stored_bytes = 0
+
+        #: number of record versions evicted because they were not accessed for `eviction_time`.
+        self.evicted_expired = 0
+
+        #: number of record versions evicted early to stay within `max_records` and `max_bytes`.
+        self.evicted_pressure = 0
+
+        #: number of puts answered with the version of an earlier put with the same idepo.
+        self.idepo_repeats = 0
+
+        # Per slot columns. Slot 0 is the sentinel of the evict list.
+
+        #: record id of each slot. References the same string for all versions.
+        self._record_id = [None]
+
+        #: key of the slot in `_idepo`.
+        self._idepo_key = [None]
+
+        self._version = array.array('l', [0])
+
+        #: time of last access, in seconds since the epoch.
+        self._time = array.array('d', [0.0])
+
+        #: arena and block within the arena holding the payload.
+        self._arena = array.array('B', [0])
+        self._block = array.array('i', [0])
+
+        #: length of the payload in bytes.
+        self._length = array.array('i', [0])
+
+        #: 1 if the data was text and is stored UTF-8 encoded.
+        self._text = array.array('B', [0])
+
+        #: evict list. Least recently accessed slots are on the left.
+        self._left = array.array('i', [_SENTINEL])
+        self._right = array.array('i', [_SENTINEL])
+
+        #: slots that can be reused.
+        self._free = array.array('i')
+
+        #: dict that maps `id` to an array with the slots of its versions, oldest first.
+        self._versions = {}
+
+        #: dict that maps `id + "\0" + idepo` to the slot.
+        self._idepo = {}
+
+        self._arenas = []
+        self._block_sizes = []
+        block_size = 16
+        while True:
+            self._arenas.append(_Arena(block_size, self.CHUNK_SIZE))
+            self._block_sizes.append(block_size)
+            if block_size >= 4 * max_size:
+                break
+            block_size = int(block_size * self.SIZE_CLASS_GROWTH + 7) // 8 * 8
+
+
+    def __len__(self):
+        """
+        Number of stored record versions, including expired ones not evicted yet.
+        """
+        return len(self._idepo)
+
+
+    def get(self, record_id, record_version, now):
+        """
+        Returns the data of the requested record or `None`, if no such record is stored.
+        Resets the eviction timer.
+        """
+        slot = self._find(record_id, record_version)
+        now = _seconds(now)
+        if slot and not self._expire(slot, now):
+            self._touch(slot, now)
+            return self._read(slot)
+        else:
+            return None
+
+
+    def contains(self, record_id, record_version, now):
+        """
+        Returns `True` if the requested record is stored.
+        Unlike :meth:`get` it does not read the data or reset the eviction timer.
+        """
+        slot = self._find(record_id, record_version)
+        return bool(slot) and not self._expire(slot, _seconds(now))
+
+
+    def oldest_version(self, record_id, now):
+        """
+        Returns the oldest version of the given record id, or `None` if there is none.
+        Resets the eviction timer of that version.
+        """
+        now = _seconds(now)
+        while True:
+            slots = self._versions.get(record_id, None)
+            if not slots:
+                return None
+            slot = slots[0]
+            if not self._expire(slot, now):
+                self._touch(slot, now)
+                return self._version[slot]
+
+
+    def jungest_version(self, record_id, now, touch=True):
+        """
+        Returns the jungest version of the given record, or `None` if there is none.
+        Resets the eviction timer of that version.
+        """
+        now = _seconds(now)
+        while True:
+            slots = self._versions.get(record_id, None)
+            if not slots:
+                return None
+            slot = slots[-1]
+            if not self._expire(slot, now):
+                if touch:
+                    self._touch(slot, now)
+                return self._version[slot]
+
+
+    def info(self, record_id, now):
+        """
+        Returns a tuple with the oldest and jungest version of the given record
+        and the number of stored versions, or `None` if there is none.
+        Does not reset the eviction timers.
+        """
+        jungest_version = self.jungest_version(record_id, now, touch=False)
+        if jungest_version is None:
+            return None
+        slots = self._versions[record_id]
+        now = _seconds(now)
+        while self._expire(slots[0], now):
+            pass
+        return self._version[slots[0]], jungest_version, len(slots)
+
+
+    def next_version(self, record_id, record_version, now):
+        """
+        Returns the oldest version of the given record that is newer than
+        `record_version`, or `None` if there is none.
+        Resets the eviction timer of that version.
+        """
+        now = _seconds(now)
+        while True:
+            slots = self._versions.get(record_id, None)
+            if not slots:
+                return None
+            index = self._bisect(slots, record_version + 1)
+            if index == len(slots):
+                return None
+            slot = slots[index]
+            if not self._expire(slot, now):
+                self._touch(slot, now)
+                return self._version[slot]
+
+
+    def get_range(self, record_id, first_version, last_version, now, max_count, max_bytes):
+        """
+        Returns the stored versions of the given record from `first_version` to
+        `last_version`. See :meth:`InMemoryRecordDatabase.get_range`.
+        """
+        slots = self._versions.get(record_id, None)
+        if not slots:
+            return [], None
+        now = _seconds(now)
+        candidates = []
+        for index in range(self._bisect(slots, first_version), len(slots)):
+            if self._version[slots[index]] > last_version:
+                break
+            candidates.append(slots[index])
+
+        results = []
+        size = 0
+        for slot in candidates:
+            if self._expire(slot, now):
+                continue
+            if len(results) >= max_count or (results and size + self._length[slot] > max_bytes):
+                return results, self._version[slot]
+            self._touch(slot, now)
+            results.append((self._version[slot], self._read(slot)))
+            size += self._length[slot]
+        return results, None
+
+
+    def put(self, record_id, idepo, data, now):
+        """
+        Adds a new version to the given record. Returns the version number.
+        See :meth:`InMemoryRecordDatabase.put`.
+        """
+        self._check_put(record_id, idepo, data)
+
+        now_seconds = _seconds(now)
+
+        idepo_key = record_id + "\0" + idepo
+        slot = self._idepo.get(idepo_key, None)
+        if slot is not None and not self._expire(slot, now_seconds):
+            self.idepo_repeats += 1
+            return self._version[slot]
+
+        payload, text, size = self._encode(record_id, idepo, data)
+
+        jungest_version = self.jungest_version(record_id, now, touch=False)
+        if not jungest_version:
+            jungest_version = 0
+
+        record_version = jungest_version + 1
+
+        self._insert(record_id, record_version, idepo_key, payload, text, size, now_seconds)
+        return record_version
+
+
+    def put_version(self, record_id, record_version, idepo, data, now):
+        """
+        Stores a version under the number it got on another server.
+        See :meth:`InMemoryRecordDatabase.put_version`.
+        """
+        self._check_put(record_id, idepo, data)
+
+        payload, text, size = self._encode(record_id, idepo, data)
+
+        jungest_version = self.jungest_version(record_id, now, touch=False)
+        if jungest_version is not None and record_version <= jungest_version:
+            for slot in list(self._versions[record_id]):
+                self._remove(slot)
+
+        idepo_key = record_id + "\0" + idepo
+        slot = self._idepo.get(idepo_key, None)
+        if slot is not None:
+            # The version with the same idepo expired on the other server.
+            self._remove(slot)
+
+        self._insert(record_id, record_version, idepo_key, payload, text, size, _seconds(now))
+
+
+    def _check_put(self, record_id, idepo, data):
+        if record_id is None:
+            raise ValueError("record_id is none")
+        if len(record_id) >= self.max_id_size:
+            raise ValueError("record id too large.")
+
+        if idepo is None:
+            raise ValueError("idepo is none")
+        if len(idepo) >= self.max_id_size:
+            raise ValueError("data is none")
+
+        if data is None:
+            raise ValueError("data is none")
+        if len(data) > self.max_size:
+            raise ValueError("record too large.")
+
+
+    def _encode(self, record_id, idepo, data):
+        """
+        Returns the payload, whether it is text and the size counted towards `max_bytes`.
+        """
+        if isinstance(data, bytes):
+            payload = data
+            text = 0
+        else:
+            payload = data.encode("utf-8")
+            text = 1
+        if len(payload) > self._block_sizes[-1]:
+            raise ValueError("record too large.")
+
+        size = len(record_id) + len(idepo) + len(payload)
+        if self.max_bytes is not None and size > self.max_bytes:
+            raise ValueError("record too large.")
+        return payload, text, size
+
+
+    def _insert(self, record_id, record_version, idepo_key, payload, text, size, now_seconds):
+        self._make_room(size, now_seconds)
+
+        arena = bisect.bisect_left(self._block_sizes, len(payload))
+        block = self._arenas[arena].allocate()
+        self._arenas[arena].write(block, payload)
+
+        if self._free:
+            slot = self._free.pop()
+            self._record_id[slot] = record_id
+            self._idepo_key[slot] = idepo_key
+            self._version[slot] = record_version
+            self._arena[slot] = arena
+            self._block[slot] = block
+            self._length[slot] = len(payload)
+            self._text[slot] = text
+        else:
+            slot = len(self._record_id)
+            self._record_id.append(record_id)
+            self._idepo_key.append(idepo_key)
+            self._version.append(record_version)
+            self._time.append(0.0)
+            self._arena.append(arena)
+            self._block.append(block)
+            self._length.append(len(payload))
+            self._text.append(text)
+            self._left.append(_SENTINEL)
+            self._right.append(_SENTINEL)
+        self._link(slot, now_seconds)
+
+        self.stored_bytes += size
+        self._idepo[idepo_key] = slot
+        slots = self._versions.get(record_id, None)
+        if slots is None:
+            slots = array.array('i')
+            self._versions[record_id] = slots
+        slots.append(slot)
+
+
+    def touch(self, record_id, record_version, now):
+        """
+        Resets the eviction timer.
+        """
+        slot = self._find(record_id, record_version)
+        now = _seconds(now)
+        if slot and not self._expire(slot, now):
+            self._touch(slot, now)
+
+
+    def dump(self, now):
+        """
+        Returns all stored versions that did not expire.
+        See :meth:`InMemoryRecordDatabase.dump`.
+        """
+        expire_older_than = _seconds(now) - self._eviction_seconds
+        return [(record_id, self._version[slot], self._idepo_key[slot][len(record_id) + 1:], self._read(slot))
+                for record_id, slots in self._versions.items()
+                for slot in slots
+                if self._time[slot] >= expire_older_than]
+
+
+    def evict(self, now, max_count=None):
+        """
+        Evict record versions that were not accessed for `self.eviction_time`.
+        See :meth:`InMemoryRecordDatabase.evict`.
+        """
+        evict_older_than = _seconds(now) - self._eviction_seconds
+
+        count = 0
+        while max_count is None or count < max_count:
+            slot = self._right[_SENTINEL]
+            if slot == _SENTINEL or self._time[slot] >= evict_older_than:
+                break
+            self._remove(slot)
+            count += 1
+        self.evicted_expired += count
+        return count
+
+
+    def _find(self, record_id, record_version):
+        """
+        Returns the slot of the given version or `None`.
+        """
+        slots = self._versions.get(record_id, None)
+        if not slots:
+            return None
+        index = self._bisect(slots, record_version)
+        if index < len(slots) and self._version[slots[index]] == record_version:
+            return slots[index]
+        return None
+
+
+    def _bisect(self, slots, record_version):
+        """
+        Returns the index of the first slot with a version not older than the given one.
+        """
+        low = 0
+        high = len(slots)
+        while low < high:
+            middle = (low + high) // 2
+            if self._version[slots[middle]] < record_version:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+    def _read(self, slot):
+        payload = self._arenas[self._arena[slot]].read(self._block[slot], self._length[slot])
+        if self._text[slot]:
+            return payload.decode("utf-8")
+        else:
+            return payload
+
+
+    def _link(self, slot, now):
+        """
+        Appends the slot to the right of the evict list.
+        """
+        self._time[slot] = now
+        neighbor = self._left[_SENTINEL]
+        self._left[slot] = neighbor
+        self._right[slot] = _SENTINEL
+        self._left[_SENTINEL] = slot
+        self._right[neighbor] = slot
+
+
+    def _unlink(self, slot):
+        left = self._left[slot]
+        right = self._right[slot]
+        self._right[left] = right
+        self._left[right] = left
+
+
+    def _touch(self, slot, now):
+        """
+        Resets the eviction timer.
+        """
+        self._unlink(slot)
+        self._link(slot, now)
+
+
+    def _expire(self, slot, now):
+        """
+        Returns `True` and removes the slot if it was not accessed
+        for `self.eviction_time`.
+        """
+        if self._time[slot] < now - self._eviction_seconds:
+            self._remove(slot)
+            self.evicted_expired += 1
+            return True
+        else:
+            return False
+
+
+    def _make_room(self, size, now):
+        """
+        Evicts the least recently accessed record versions until a record of
+        the given size fits within `max_records` and `max_bytes`.
+        """
+        while (len(self._idepo) >= self.max_records or
+               (self.max_bytes is not None and self.stored_bytes + size > self.max_bytes)):
+            slot = self._right[_SENTINEL]
+            if not self._expire(slot, now):
+                self._remove(slot)
+                self.evicted_pressure += 1
+
+
+    def _remove(self, slot):
+        """
+        Delete the record version in the slot.
+        """
+        record_id = self._record_id[slot]
+        idepo_key = self._idepo_key[slot]
+        del self._idepo[idepo_key]
+        self.stored_bytes -= len(idepo_key) - 1 + self._length[slot]
+
+        slots = self._versions[record_id]
+        slots.remove(slot)
+        if not slots:
+            del self._versions[record_id]
+
+        self._unlink(slot)
+        self._arenas[self._arena[slot]].release(self._block[slot])
+        self._record_id[slot] = None
+        self._idepo_key[slot] = None
+        self._free.append(slot)
+
+
+class _Arena(object):
+    """
+    Fixed size blocks in large, contiguous chunks.
+    """
+
+    def __init__(self, block_size, chunk_size):
+        self.block_size = block_size
+        self.blocks_per_chunk = max(1, chunk_size // block_size)
+        self.chunks = []
+
+        #: released blocks that can be reused.
+        self.free = array.array('i')
+
+        #: number of blocks that were ever allocated.
+        self.allocated = 0
+
+    def allocate(self):
+        if self.free:
+            return self.free.pop()
+        block = self.allocated
+        if block // self.blocks_per_chunk >= len(self.chunks):
+            self.chunks.append(bytearray(self.blocks_per_chunk * self.block_size))
+        self.allocated += 1
+        return block
+
+    def release(self, block):
+        self.free.append(block)
+
+    def write(self, block, payload):
+        chunk, position = self._locate(block)
+        chunk[position:position + len(payload)] = payload
+
+    def read(self, block, length):
+        chunk, position = self._locate(block)
+        return bytes(chunk[position:position + length])
+
+    def _locate(self, block):
+        chunk = self.chunks[block // self.blocks_per_chunk]
+        position = (block % self.blocks_per_chunk) * self.block_size
+        return chunk, position
+
+
+def _seconds(now):
+    return (now - _EPOCH).total_seconds()
@@ -9,13 +9,17 @@ class ASyncRecordDatabase(object):
     """
     Wrapper around a :class:`InMemoryRecordDatabase` (or a compatible object)
     that has the additional method :meth:`get_future`.
-    This will only work if all put operations go through this wrapper instance;
-    This will typically not work in a distributed system setup.
+    This will only work if all put operations go through this wrapper instance,
+    or if puts made elsewhere are reported with :meth:`notify`
+    (see :class:`renatserver.shard.ShardedRecordDatabase`).
     """
     
     def __init__(self, db):
         self.db = db
         
+        #: time after which a version that was not accessed is evicted.
+        self.eviction_time = db.eviction_time
+        
         #: dict maps `(id, version)` to future (for get operations)
         #: we use a weakref here so that the entry is deleted
         #: when nobody has interest in the future anymore.
@@ -26,6 +30,30 @@ class ASyncRecordDatabase(object):
         #: when nobody has interest in the future anymore.
         self._limit_futures =  weakref.WeakValueDictionary()
         
+        #: dict maps `(id, version)` to future (for next_version)
+        #: that callbacks with the version once it is stored.
+        #: we use a weakref here so that the entry is deleted
+        #: when nobody has interest in the future anymore.
+        self._next_futures = weakref.WeakValueDictionary()
+        
+        #: dict maps `id` to the set of `_AnyWaiter` instances that
+        #: wait for a new version of that record (for wait_any).
+        self._any_waiters = {}
+        
+        #: dict maps `id` to list of callbacks that are invoked
+        #: as `callback(record_id, record_version, data)` on each put.
+        self._subscribers = {}
+        
+        #: list of callbacks that are invoked as
+        #: `callback(record_id, record_version, idepo, data)` on each put.
+        self._replicas = []
+        
+        #: number of `_AnyWaiter` instances, each can be in several sets of `_any_waiters`.
+        self._any_waiter_count = 0
+        
+        #: number of waiting futures that were resolved by :meth:`notify`.
+        self.woken_waiters = 0
+        
         
     def get_future(self, record_id, record_version, now=None):
         """
@@ -42,15 +70,117 @@ class ASyncRecordDatabase(object):
             future.set_result(data)
         else:
             self.db.touch(record_id, record_version - 1, now)
-            
-            future = self._get_futures.get((record_id, record_version), None)
-            if not future:
-                future = tornado.concurrent.Future()
-                self._get_futures[(record_id, record_version)] = future
+            future = self.wait_for_version(record_id, record_version)
 
         return future
     
     
+    def wait_for_version(self, record_id, record_version):
+        """
+        Returns a future that will callback with the data once
+        the given version is reported to :meth:`notify`.
+        Does not check if the version is already stored.
+        """
+        future = self._get_futures.get((record_id, record_version), None)
+        if not future:
+            future = tornado.concurrent.Future()
+            self._get_futures[(record_id, record_version)] = future
+        return future
+    
+    
+    def wait_for_limit(self, record_id):
+        """
+        Returns a future that will callback with the version number once
+        any version of the record is reported to :meth:`notify`.
+        Does not check if a version is already stored.
+        """
+        future = self._limit_futures.get(record_id, None)
+        if not future:
+            future = tornado.concurrent.Future()
+            self._limit_futures[record_id] = future
+        return future
+    
+    
+    def wait_for_next(self, record_id, record_version):
+        """
+        Returns a future that will callback with the version number once
+        a version newer than the given one is reported to :meth:`notify`.
+        Does not check if such a version is already stored.
+        """
+        # Versions are numbered consecutively from the jungest stored one,
+        # so the first newer version to be put is always `record_version + 1`.
+        key = (record_id, record_version + 1)
+        future = self._next_futures.get(key, None)
+        if not future:
+            future = tornado.concurrent.Future()
+            self._next_futures[key] = future
+        return future
+    
+    
+    def wait_any_future(self, versions, now=None):
+        """
+        Returns a future that will callback as soon as one of the records has
+        a version newer than the given one (which might be immediately).
+        
+        :param versions: dict that maps record ids to version numbers.
+        
+        :returns: Future with a dict that maps the ids of the records that
+          have newer versions to their jungest version.
+          If the future is no longer needed, :meth:`cancel_wait_any` should be
+          called to release it.
+        """
+        if not now:
+            now = datetime.datetime.now()
+        future = self.wait_for_any(versions)
+        newer = self.newer_versions(versions, now)
+        if newer:
+            future.set_result(newer)
+        return future
+    
+    
+    def newer_versions(self, versions, now=None):
+        """
+        Returns a dict that maps the ids of the records in `versions`
+        that have a newer version than the given one to their jungest version.
+        Does not reset the eviction timers.
+        """
+        if not now:
+            now = datetime.datetime.now()
+        newer = {}
+        for record_id, record_version in versions.items():
+            jungest = self.db.jungest_version(record_id, now, touch=False)
+            if jungest is not None and jungest > record_version:
+                newer[record_id] = jungest
+        return newer
+    
+    
+    def wait_for_any(self, versions):
+        """
+        Returns a future that will callback with a dict `{record_id: record_version}`
+        once a version newer than the one given in `versions` is
+        reported to :meth:`notify` for any of the records.
+        Does not check if such a version is already stored.
+        
+        All records share a single waiter, which is released once the
+        future is done.
+        """
+        waiter = _AnyWaiter(tornado.concurrent.Future(), dict(versions))
+        for record_id in waiter.versions:
+            self._any_waiters.setdefault(record_id, set()).add(waiter)
+        self._any_waiter_count += 1
+        waiter.future.add_done_callback(lambda future: self._remove_any_waiter(waiter))
+        return waiter.future
+    
+    
+    def cancel_wait_any(self, future):
+        """
+        Releases a future returned by :meth:`wait_any_future` that is no longer needed.
+        It callbacks with an empty dict.
+        """
+        if not future.done():
+            future.set_result({})
+    
+    
     def oldest_version_future(self, record_id, now=None):
         if not now:
             now = datetime.datetime.now()
@@ -63,51 +193,268 @@ class ASyncRecordDatabase(object):
             now = datetime.datetime.now()
         record_version = self.db.jungest_version(record_id, now)
         return self._limit_future(record_id, record_version)
+    
+    
+    def next_version_future(self, record_id, record_version, now=None):
+        """
+        Returns a future that will callback with the oldest stored version
+        newer than `record_version` as soon as there is one (which might be immediately).
+        """
+        if not now:
+            now = datetime.datetime.now()
+        next_version = self.db.next_version(record_id, record_version, now)
+        if next_version is not None:
+            future = tornado.concurrent.Future()
+            future.set_result(next_version)
+        else:
+            future = self.wait_for_next(record_id, record_version)
+        return future
 
 
     def put(self, record_id, idepo, data, now=None):
         if not now:
             now = datetime.datetime.now()
             
+        idepo_repeats = self.db.idepo_repeats
         record_version = self.db.put(record_id, idepo, data, now)
+        self.notify(record_id, record_version, data)
+        if self.db.idepo_repeats == idepo_repeats:
+            for callback in list(self._replicas):
+                callback(record_id, record_version, idepo, data)
+        return record_version
+    
+    
+    def put_version(self, record_id, record_version, idepo, data, now=None):
+        """
+        Stores a version put on the primary server and wakes up the
+        futures waiting for it. See :class:`renatserver.replication.Follower`.
+        """
+        if not now:
+            now = datetime.datetime.now()
         
-        get_future = self._get_futures.get((record_id, record_version), None)
-        if get_future:
+        self.db.put_version(record_id, record_version, idepo, data, now)
+        self.notify(record_id, record_version, data)
+        for callback in list(self._replicas):
+            callback(record_id, record_version, idepo, data)
+    
+    
+    def notify(self, record_id, record_version, data):
+        """
+        Wakes up the futures waiting for the given version.
+        Called by :meth:`put`.
+        """
+        get_future = self._get_futures.pop((record_id, record_version), None)
+        if get_future and not get_future.done():
             get_future.set_result(data)
-            del self._get_futures[(record_id, record_version)]
+            self.woken_waiters += 1
             
-        limit_future = self._limit_futures.get(record_id, None)
-        if limit_future:
+        limit_future = self._limit_futures.pop(record_id, None)
+        if limit_future and not limit_future.done():
             limit_future.set_result(record_version)
-            del self._limit_futures[record_id]
+            self.woken_waiters += 1
             
-        return record_version
+        next_future = self._next_futures.pop((record_id, record_version), None)
+        if next_future and not next_future.done():
+            next_future.set_result(record_version)
+            self.woken_waiters += 1
+            
+        for waiter in list(self._any_waiters.get(record_id, ())):
+            if record_version > waiter.versions[record_id] and not waiter.future.done():
+                waiter.future.set_result({record_id: record_version})
+                self.woken_waiters += 1
+            
+        for callback in list(self._subscribers.get(record_id, ())):
+            callback(record_id, record_version, data)
+    
+    
+    def subscribe(self, record_id, callback):
+        """
+        Invokes `callback(record_id, record_version, data)` for every
+        version of the record reported to :meth:`notify` from now on.
+        """
+        self._subscribers.setdefault(record_id, []).append(callback)
+        
+        
+    def unsubscribe(self, record_id, callback):
+        """
+        Removes a callback added with :meth:`subscribe`.
+        """
+        callbacks = self._subscribers.get(record_id, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+        if not callbacks:
+            self._subscribers.pop(record_id, None)
+    
+    
+    def add_replica(self, callback):
+        """
+        Invokes `callback(record_id, record_version, idepo, data)` for every
+        new version from now on. Puts repeated with the same idepo are left out.
+        """
+        self._replicas.append(callback)
+        
+        
+    def remove_replica(self, callback):
+        """
+        Removes a callback added with :meth:`add_replica`.
+        """
+        if callback in self._replicas:
+            self._replicas.remove(callback)
+    
+    
+    def put_many(self, puts, now=None):
+        """
+        Performs several puts at the same time `now`.
+        
+        :param puts: List of `(record_id, idepo, data)` tuples.
+        
+        :returns: List with the version number for each put, or the
+          `ValueError` if that put was rejected.
+        """
+        if not now:
+            now = datetime.datetime.now()
+        
+        results = []
+        for record_id, idepo, data in puts:
+            try:
+                results.append(self.put(record_id, idepo, data, now))
+            except ValueError as e:
+                results.append(e)
+        return results
+    
+    
+    def get_many(self, gets, now=None):
+        """
+        Performs several gets at the same time `now`.
+        
+        :param gets: List of `(record_id, record_version)` tuples. The version
+          is either a number or one of `"OLDEST"` and `"JUNGEST"`.
+          
+        :returns: List with a `(record_version, data)` tuple for each get,
+          or `None` if there is no such record.
+        """
+        if not now:
+            now = datetime.datetime.now()
+        
+        results = []
+        for record_id, record_version in gets:
+            if record_version == "OLDEST":
+                record_version = self.db.oldest_version(record_id, now)
+            elif record_version == "JUNGEST":
+                record_version = self.db.jungest_version(record_id, now)
+                
+            if record_version is None:
+                data = None
+            else:
+                data = self.db.get(record_id, int(record_version), now)
+                
+            if data is None:
+                results.append(None)
+            else:
+                results.append((int(record_version), data))
+        return results
+    
+    
+    def stats(self):
+        """
+        Returns a dict with the size of the store, the evictions so far
+        and the number of waiting futures. See :class:`renatserver.metrics.ServerMetrics`.
+        """
+        return {"records": len(self.db),
+                "max_records": self.db.max_records,
+                "stored_bytes": self.db.stored_bytes,
+                "max_bytes": self.db.max_bytes or 0,
+                "evicted_expired": self.db.evicted_expired,
+                "evicted_pressure": self.db.evicted_pressure,
+                "idepo_repeats": self.db.idepo_repeats,
+                "get_waiters": len(self._get_futures),
+                "limit_waiters": len(self._limit_futures),
+                "next_waiters": len(self._next_futures),
+                "any_waiters": self._any_waiter_count,
+                "subscribers": sum(len(callbacks) for callbacks in self._subscribers.values()),
+                "woken_waiters": self.woken_waiters,
+                "replicas": len(self._replicas)}
     
     
     def get(self, record_id, record_version, now=None):
         return self.db.get(record_id, record_version, now)
 
     
+    def contains(self, record_id, record_version, now=None):
+        if not now:
+            now = datetime.datetime.now()
+        return self.db.contains(record_id, record_version, now)
+
+    
     def oldest_version(self, record_id, now=None):
         return self.db.oldest_version(record_id, now)
 
     
     def jungest_version(self, record_id, now=None):
         return self.db.jungest_version(record_id, now)
+
+    
+    def next_version(self, record_id, record_version, now=None):
+        return self.db.next_version(record_id, record_version, now)
+
+    
+    def info(self, record_id, now=None):
+        if not now:
+            now = datetime.datetime.now()
+        return self.db.info(record_id, now)
+
+    
+    def get_range(self, record_id, first_version, last_version, max_count, max_bytes, now=None):
+        if not now:
+            now = datetime.datetime.now()
+        return self.db.get_range(record_id, first_version, last_version, now, max_count, max_bytes)
+    
+    
+    def dump(self, now=None):
+        if not now:
+            now = datetime.datetime.now()
+        return self.db.dump(now)
     
     
     def touch(self, record_id, record_version, now=None):
         self.db.touch(record_id, record_version, now)
         
+        
+    def evict(self, now=None, max_count=None):
+        if not now:
+            now = datetime.datetime.now()
+        return self.db.evict(now, max_count)
+        
 
     def _limit_future(self, record_id, record_version):
         if record_version is not None:
             future = tornado.concurrent.Future()
             future.set_result(record_version)
         else:
-            future = self._limit_futures.get(record_id, None)
-            if not future:
-                future = tornado.concurrent.Future()
-                self._limit_futures[record_id] = future
+            future = self.wait_for_limit(record_id)
         return future
-                
\ No newline at end of file
+    
+    
+    def _remove_any_waiter(self, waiter):
+        self._any_waiter_count -= 1
+        for record_id in waiter.versions:
+            waiters = self._any_waiters.get(record_id, None)
+            if waiters is not None:
+                waiters.discard(waiter)
+                if not waiters:
+                    del self._any_waiters[record_id]
+    
+    
+class _AnyWaiter(object):
+    """
+    Waits for a new version of any of several records.
+    """
+    
+    __slots__ = ("future", "versions")
+    
+    def __init__(self, future, versions):
+        #: future of the waiter
+        self.future = future
+        
+        #: dict maps `id` to the version that is not new enough.
+        self.versions = versions
@@ -1,22 +1,31 @@
 # Copyright (C) 2014 Stefan C. Mueller
 
 import datetime
-from renatserver import ddlist
+from renatserver import ddlist, wal
 
 class InMemoryRecordDatabase(object):
     """
     A very simple in-memory key-value store.
     """
     
-    def __init__(self, max_records=1024*1024, max_size=1024, max_id_size=64, eviction_time=None):
+    def __init__(self, max_records=1024*1024, max_size=1024, max_id_size=64, eviction_time=None, max_bytes=None, log=None):
         """
         :param max_records: Maximal number of records that can be stored. 
-          After that, the put operation will throw an exception.
+          After that, a put evicts the least recently accessed record versions
+          to make room.
           
         :param max_size: Maximal size of a single record.
           
         :param eviction_time: datetime.timedelta after which a record version is deleted
           if not accessed. Defaults to 5 minutes.
+          
+        :param max_bytes: Maximal total size of the stored data, ids and idepos.
+          Like `max_records`, a put evicts the least recently accessed record versions
+          if the budget would be exceeded. `None` for no limit.
+          
+        :param log: :class:`renatserver.wal.WriteLog` to which puts and touches
+          are appended, or `None`. Committing and compacting the log is up to
+          the caller, see :meth:`replay` for restoring the state.
         """
         if not eviction_time:
             eviction_time = datetime.timedelta(seconds=300)
@@ -28,6 +37,26 @@ class InMemoryRecordDatabase(object):
         
         self.max_id_size = max_id_size
         
+        self.max_bytes = max_bytes
+        
+        self.log = log
+        
+        #: a touch is only logged if the last logged access of the version is older than this.
+        #: On replay, versions may therefore expire up to this much too early.
+        self.log_touch_interval = eviction_time // 10
+        
+        #: total size of the stored data, ids and idepos.
+        self.stored_bytes = 0
+        
+        #: number of record versions evicted because they were not accessed for `eviction_time`.
+        self.evicted_expired = 0
+        
+        #: number of record versions evicted early to stay within `max_records` and `max_bytes`.
+        self.evicted_pressure = 0
+        
+        #: number of puts answered with the version of an earlier put with the same idepo.
+        self.idepo_repeats = 0
+        
         #: dict that maps `(id,version)` to _Record
         self._records = {}
         
@@ -41,34 +70,49 @@ class InMemoryRecordDatabase(object):
         self._evict_list = ddlist.LinkedList()
         
 
+    def __len__(self):
+        """
+        Number of stored record versions, including expired ones not evicted yet.
+        """
+        return len(self._records)
+        
+        
     def get(self, record_id, record_version, now):
         """
         Returns the data of the requested record or `None`, if no such record is stored.
         Resets the eviction timer.
         """
-        self._evict(now)
         key = (record_id, record_version)
         record = self._records.get(key, None)
-        if record:
+        if record and not self._expire(record, now):
             self._touch(record, now)
             return record.data
         else:
             return None
         
     
+    def contains(self, record_id, record_version, now):
+        """
+        Returns `True` if the requested record is stored.
+        Unlike :meth:`get` it does not reset the eviction timer.
+        """
+        record = self._records.get((record_id, record_version), None)
+        return record is not None and not self._expire(record, now)
+        
+    
     def oldest_version(self, record_id, now):
         """
         Returns the oldest version of the given record id, or `None` if there is none.
         Resets the eviction timer of that version.
         """
-        self._evict(now)
-        versions = self._versions.get(record_id, None)
-        if versions:
+        while True:
+            versions = self._versions.get(record_id, None)
+            if not versions:
+                return None
             record = versions.get_leftmost()
-            self._touch(record, now)
-            return record.record_version
-        else:
-            return None
+            if not self._expire(record, now):
+                self._touch(record, now)
+                return record.record_version
     
     
     def jungest_version(self, record_id, now, touch=True):
@@ -76,16 +120,91 @@ class InMemoryRecordDatabase(object):
         Returns the jungest version of the given record, or `None` if there is none.
         Resets the eviction timer of that version.
         """
-        self._evict(now)
-        
-        versions = self._versions.get(record_id, None)
-        if versions:
+        while True:
+            versions = self._versions.get(record_id, None)
+            if not versions:
+                return None
             record = versions.get_rightmost()
-            if touch:
-                self._touch(record, now)
-            return record.record_version
-        else:
+            if not self._expire(record, now):
+                if touch:
+                    self._touch(record, now)
+                return record.record_version
+    
+    
+    def info(self, record_id, now):
+        """
+        Returns a tuple with the oldest and jungest version of the given record
+        and the number of stored versions, or `None` if there is none.
+        Does not reset the eviction timers.
+        """
+        jungest_version = self.jungest_version(record_id, now, touch=False)
+        if jungest_version is None:
             return None
+        versions = self._versions[record_id]
+        while self._expire(versions.get_leftmost(), now):
+            pass
+        return versions.get_leftmost().record_version, jungest_version, len(versions)
+    
+    
+    def next_version(self, record_id, record_version, now):
+        """
+        Returns the oldest version of the given record that is newer than
+        `record_version`, or `None` if there is none.
+        Resets the eviction timer of that version.
+        """
+        while True:
+            versions = self._versions.get(record_id, None)
+            if not versions:
+                return None
+            record = self._records.get((record_id, record_version + 1), None)
+            if record is None:
+                record = versions.get_leftmost()
+                if record.record_version <= record_version:
+                    # Versions were evicted in between, or there is no newer one.
+                    record = None
+                    for candidate in reversed(versions):
+                        if candidate.record_version <= record_version:
+                            break
+                        record = candidate
+                    if record is None:
+                        return None
+            if not self._expire(record, now):
+                self._touch(record, now)
+                return record.record_version
+    
+    
+    def get_range(self, record_id, first_version, last_version, now, max_count, max_bytes):
+        """
+        Returns the stored versions of the given record from `first_version` to
+        `last_version`, both included, oldest first. Resets their eviction timers.
+        
+        Stops after `max_count` versions, or before the data would exceed 
+        `max_bytes`. At least one version is returned, even if it is larger.
+        
+        :returns: Tuple with a list of `(version, data)` tuples and the version
+          to continue with, `None` if all versions in the range were returned.
+        """
+        versions = self._versions.get(record_id, None)
+        if not versions:
+            return [], None
+        candidates = []
+        for record in versions:
+            if record.record_version > last_version:
+                break
+            if record.record_version >= first_version:
+                candidates.append(record)
+        
+        results = []
+        size = 0
+        for record in candidates:
+            if self._expire(record, now):
+                continue
+            if len(results) >= max_count or (results and size + len(record.data) > max_bytes):
+                return results, record.record_version
+            self._touch(record, now)
+            results.append((record.record_version, record.data))
+            size += len(record.data)
+        return results, None
     
     
     def put(self, record_id, idepo, data, now):
@@ -98,8 +217,65 @@ class InMemoryRecordDatabase(object):
         multiple times with the exact same arguments and the behaviour is the
         same as if it was called only once.
         """
-        self._evict(now)
+        self._check_put(record_id, idepo, data)
+        
+        idepo_version = self._idepo.get((record_id, idepo), None)
+        if idepo_version is not None:
+            record = self._records[(record_id, idepo_version)]
+            if not self._expire(record, now):
+                self.idepo_repeats += 1
+                return idepo_version
+        
+        size = self._size(record_id, idepo, data)
+        if self.max_bytes is not None and size > self.max_bytes:
+            raise ValueError("record too large.")
+        
+        jungest_version = self.jungest_version(record_id, now, touch=False)
+        if not jungest_version:
+            jungest_version = 0
+        
+        record_version = jungest_version + 1
         
+        self._make_room(size, now)
+        self._insert(record_id, record_version, idepo, now, data, size)
+        if self.log is not None:
+            self.log.append_put(record_id, record_version, idepo, now, data)
+        return record_version
+    
+    
+    def put_version(self, record_id, record_version, idepo, data, now):
+        """
+        Stores a version under the number it got on another server, see
+        :class:`renatserver.replication.Follower`.
+        
+        Versions have to arrive in order. If the record already has this or
+        a newer version, the other server numbered the versions from 1 again,
+        after all of them were evicted there. The stored versions are then
+        dropped, they were replaced.
+        """
+        self._check_put(record_id, idepo, data)
+        
+        size = self._size(record_id, idepo, data)
+        if self.max_bytes is not None and size > self.max_bytes:
+            raise ValueError("record too large.")
+        
+        jungest_version = self.jungest_version(record_id, now, touch=False)
+        if jungest_version is not None and record_version <= jungest_version:
+            for record in list(self._versions[record_id]):
+                self._remove(record)
+        
+        idepo_version = self._idepo.get((record_id, idepo), None)
+        if idepo_version is not None:
+            # The version with the same idepo expired on the other server.
+            self._remove(self._records[(record_id, idepo_version)])
+        
+        self._make_room(size, now)
+        self._insert(record_id, record_version, idepo, now, data, size)
+        if self.log is not None:
+            self.log.append_put(record_id, record_version, idepo, now, data)
+    
+    
+    def _check_put(self, record_id, idepo, data):
         if record_id is None:
             raise ValueError("record_id is none")
         if len(record_id) >= self.max_id_size:
@@ -114,20 +290,11 @@ class InMemoryRecordDatabase(object):
             raise ValueError("data is none")
         if len(data) > self.max_size:
             raise ValueError("record too large.")
-        
-        if (record_id, idepo) in self._idepo:
-            return self._idepo[(record_id, idepo)]
-        
-        if len(self._records) >= self.max_records:
-            raise ValueError("Too many records stored. Please wait until some get evicted.")
-        
-        jungest_version = self.jungest_version(record_id, now, touch=False)
-        if not jungest_version:
-            jungest_version = 0
-        
-        record_version = jungest_version + 1
-        
+    
+    
+    def _insert(self, record_id, record_version, idepo, now, data, size):
         record = self._Record(record_id, record_version, idepo, now, data)
+        self.stored_bytes += size
         self._records[(record_id, record_version)] = record
         self._idepo[(record_id, idepo)] = record_version
         self._evict_list.append_right(record)
@@ -137,18 +304,14 @@ class InMemoryRecordDatabase(object):
             version_list = ddlist.LinkedList()
             self._versions[record_id] = version_list
         version_list.append_right(record)
-       
-        return record_version
         
         
     def touch(self, record_id, record_version, now):
         """
         Resets the eviction timer.
         """
-        self._evict(now)
-            
         record = self._records.get((record_id, record_version), None)
-        if record:
+        if record and not self._expire(record, now):
             self._touch(record, now)
         else:
             return
@@ -161,24 +324,121 @@ class InMemoryRecordDatabase(object):
         record.time = now
         self._evict_list.remove(record)
         self._evict_list.append_right(record)
+        if self.log is not None and now - record.logged >= self.log_touch_interval:
+            record.logged = now
+            self.log.append_touch(record.record_id, record.record_version, now)
+    
+    
+    def replay(self, now):
+        """
+        Restores the record versions from `self.log`, which must be done
+        before any other method is called. Versions that expired are dropped.
+        
+        A put cannot be skipped just because it is old, a touch later in the
+        log might have kept the version alive. Expired versions are evicted
+        at the end instead, or earlier if they are in the way of `max_records`
+        or `max_bytes`.
+        
+        :returns: Number of restored versions.
+        """
+        for entry in self.log.replay():
+            record = self._records.get((entry.record_id, entry.record_version), None)
+            if entry.type == wal.PUT:
+                if record is None:
+                    idepo_version = self._idepo.get((entry.record_id, entry.idepo), None)
+                    if idepo_version is not None:
+                        # The version with the same idepo expired before this put.
+                        self._remove(self._records[(entry.record_id, idepo_version)])
+                    size = self._size(entry.record_id, entry.idepo, entry.data)
+                    self._make_room(size, now)
+                    self._insert(entry.record_id, entry.record_version, entry.idepo, entry.time, entry.data, size)
+            elif record is not None and entry.time >= record.time:
+                # equal for the touches of a snapshot, which restore the access order.
+                record.time = entry.time
+                record.logged = entry.time
+                self._evict_list.remove(record)
+                self._evict_list.append_right(record)
+        self.evict(now)
+        return len(self._records)
+    
+    
+    def snapshot(self):
+        """
+        Returns a list of all stored record versions, least recently accessed first,
+        to be passed to :meth:`renatserver.wal.WriteLog.compact`.
+        """
+        return list(self._evict_list)
     
     
-    def _evict(self, now):
+    def dump(self, now):
+        """
+        Returns a list of `(record_id, record_version, idepo, data)` tuples
+        of all stored versions that did not expire, the versions of a record 
+        oldest first. Does not reset the eviction timers.
         """
-        Evict all record versions that are older than `self.eviction_time`
+        expire_older_than = now - self.eviction_time
+        return [(record.record_id, record.record_version, record.idepo_nr, record.data)
+                for versions in self._versions.values()
+                for record in versions
+                if record.time >= expire_older_than]
+    
+    
+    def evict(self, now, max_count=None):
+        """
+        Evict record versions that were not accessed for `self.eviction_time`,
+        least recently accessed first.
+        
+        This is not required for correctness, expired versions are treated
+        as absent by all other methods. It frees the memory and is meant
+        to be called periodically with a bounded `max_count`, so that the
+        cost of an expiring traffic spike is spread over many calls.
+        
+        :param max_count: Maximal number of versions to evict in this call.
+          `None` evicts all expired versions.
+        
+        :returns: Number of evicted versions.
         """
         evict_older_than = now - self.eviction_time
-
-        scheduled_for_eviction = []
         
-        for record in self._evict_list:
-            if record.time < evict_older_than:
-                scheduled_for_eviction.append(record)
-            else:
+        count = 0
+        while max_count is None or count < max_count:
+            record = self._evict_list.get_leftmost(None)
+            if record is None or record.time >= evict_older_than:
                 break
-
-        for record in scheduled_for_eviction:
             self._remove(record)
+            count += 1
+        self.evicted_expired += count
+        return count
+    
+    
+    def _expire(self, record, now):
+        """
+        Returns `True` and removes the record if it was not accessed
+        for `self.eviction_time`.
+        """
+        if record.time < now - self.eviction_time:
+            self._remove(record)
+            self.evicted_expired += 1
+            return True
+        else:
+            return False
+    
+    
+    def _make_room(self, size, now):
+        """
+        Evicts the least recently accessed record versions until a record of
+        the given size fits within `max_records` and `max_bytes`.
+        """
+        while (len(self._records) >= self.max_records or 
+               (self.max_bytes is not None and self.stored_bytes + size > self.max_bytes)):
+            record = self._evict_list.get_leftmost()
+            if not self._expire(record, now):
+                self._remove(record)
+                self.evicted_pressure += 1
+                
+                
+    def _size(self, record_id, idepo, data):
+        return len(record_id) + len(idepo) + len(data)
 
     def _remove(self, record):
         """
@@ -186,6 +446,7 @@ class InMemoryRecordDatabase(object):
         """
         del self._records[(record.record_id, record.record_version)]
         del self._idepo[(record.record_id, record.idepo_nr)]
+        self.stored_bytes -= self._size(record.record_id, record.idepo_nr, record.data)
         
         self._evict_list.remove(record)
         
@@ -197,11 +458,14 @@ class InMemoryRecordDatabase(object):
 
     class _Record(object):
         
+        __slots__ = ("record_id", "record_version", "idepo_nr", "time", "logged", "data")
+        
         def __init__(self, record_id, record_version, idepo_nr, time, data):
             self.record_id = record_id
             self.record_version = record_version
             self.idepo_nr = idepo_nr
             self.time = time
+            self.logged = time
             self.data = data
         def __repr__(self):
             return "Record(%s, %s, %s, %s, %s)" % (repr(self.record_id), repr(self.record_version),repr(self.idepo_nr), str(self.time), repr(self.data))
@@ -1,105 +1,116 @@
+import array
 
 _NO_DEFAULT = object()
 
+#: Slot index of the sentinel. The sentinel is both the left neighbor of the
+#: leftmost item and the right neighbor of the rightmost item.
+_SENTINEL = 0
+
 class LinkedList(object):
+    """
+    Doubly linked list with O(1) removal of arbitrary items.
+    
+    Items are compared by identity. An item can be in several lists at the same
+    time, but only once in each list.
     
-    _next_name = 0
+    The links are not stored on the items but in index-backed arrays:
+    Each item occupies a slot, `_left[slot]` and `_right[slot]` are the slots
+    of its neighbors. The links are plain machine integers, so appending and
+    removing does not allocate per-item objects, and there are no reference
+    cycles between items for the garbage collector to walk.
+    """
     
     def __init__(self, iterable=None):
-        self.name = str(LinkedList._next_name)
-        LinkedList._next_name += 1
-   
         self._generation = 0
-        self._len = 0
-        self._sentinel = self._Sentinel()
-        self._setleft(self._sentinel, self._sentinel)
-        self._setright(self._sentinel, self._sentinel)
+        
+        #: item stored in each slot. `None` for the sentinel and for free slots.
+        self._items = [None]
+        
+        #: slot of the left and right neighbor of each slot.
+        self._left = array.array('l', [_SENTINEL])
+        self._right = array.array('l', [_SENTINEL])
+        
+        #: slots that can be reused.
+        self._free = array.array('l')
+        
+        #: dict that maps `id(item)` to the slot of the item.
+        self._slots = {}
         
         if iterable:
             for item in iterable:
                 self.append_right(item)
         
     def append_left(self, item):
-        if self._hasattr(item):
-            raise ValueError("already in the list")
-        
-        self._generation += 1
-        neighbor = self._getright(self._sentinel)
-        self._setleft(item, self._sentinel)
-        self._setright(item, neighbor)
-        self._setright(self._sentinel, item)
-        self._setleft(neighbor, item)
-        self._len += 1
+        slot = self._allocate(item)
+        neighbor = self._right[_SENTINEL]
+        self._left[slot] = _SENTINEL
+        self._right[slot] = neighbor
+        self._right[_SENTINEL] = slot
+        self._left[neighbor] = slot
     
     def append_right(self, item):
-        if self._hasattr(item):
-            raise ValueError("already in the list")
-        
-        self._generation += 1
-        neighbor = self._getleft(self._sentinel)
-        self._setleft(item, neighbor)
-        self._setright(item, self._sentinel)
-        self._setleft(self._sentinel, item)
-        self._setright(neighbor, item)
-        self._len += 1
+        slot = self._allocate(item)
+        neighbor = self._left[_SENTINEL]
+        self._left[slot] = neighbor
+        self._right[slot] = _SENTINEL
+        self._left[_SENTINEL] = slot
+        self._right[neighbor] = slot
         
     def remove(self, item):
-        if not self._hasattr(item):
+        slot = self._slots.pop(id(item), None)
+        if slot is None:
             raise ValueError("item not in the list")
     
         self._generation += 1
-        leftitem = self._getleft(item)
-        rightitem = self._getright(item)
-        self._setright(leftitem, rightitem)
-        self._setleft(rightitem, leftitem)
-        self._len -= 1
-        self._removeattr(item)
+        leftslot = self._left[slot]
+        rightslot = self._right[slot]
+        self._right[leftslot] = rightslot
+        self._left[rightslot] = leftslot
+        self._items[slot] = None
+        self._free.append(slot)
         
     def get_leftmost(self, default=_NO_DEFAULT):
-        item = self._getright(self._sentinel)
-        if item is self._sentinel:
-            if default == _NO_DEFAULT:
+        slot = self._right[_SENTINEL]
+        if slot == _SENTINEL:
+            if default is _NO_DEFAULT:
                 raise ValueError("empty list")
             else:
                 return default
-        return item
+        return self._items[slot]
     
     def get_rightmost(self, default=_NO_DEFAULT):
-        item = self._getleft(self._sentinel)
-        if item is self._sentinel:
-            if default == _NO_DEFAULT:
+        slot = self._left[_SENTINEL]
+        if slot == _SENTINEL:
+            if default is _NO_DEFAULT:
                 raise ValueError("empty list")
             else:
                 return default
-        return item
+        return self._items[slot]
     
-    def __iter__(self):
-        return self._iter(self._generation)
+    def __contains__(self, item):
+        return id(item) in self._slots
     
-    def _iter(self, generation):
-        item = self._getright(self._sentinel)
-        while item is not self._sentinel:
-            if generation != self._generation:
-                raise ValueError("concurrent modification")
-            yield item
-            item = self._getright(item)
+    def __iter__(self):
+        return self._iter(self._right, self._generation)
     
     def __reversed__(self):
-        return self._reversed(self._generation)
+        return self._iter(self._left, self._generation)
     
-    def _reversed(self, generation):
-        item = self._getleft(self._sentinel)
-        while item is not self._sentinel:
+    def _iter(self, links, generation):
+        slot = links[_SENTINEL]
+        while slot != _SENTINEL:
             if generation != self._generation:
                 raise ValueError("concurrent modification")
-            yield item
-            item = self._getleft(item)
+            yield self._items[slot]
+            slot = links[slot]
     
     def __len__(self):
-        return self._len
+        return len(self._slots)
     
     def __nonzero__(self):
-        return self._len > 0
+        return len(self._slots) > 0
+    
+    __bool__ = __nonzero__
     
     def __eq__(self, other):
         if not isinstance(other, LinkedList):
@@ -121,28 +132,23 @@ class LinkedList(object):
     def __str__(self):
         return str(list(self))
     
-    def _next(self, item):
-        pass
-    
-    def _hasattr(self, item):
-        return hasattr(item, "_%s_left" % self.name) and hasattr(item, "_%s_right" % self.name)
-    
-    def _removeattr(self, item):
-        delattr(item, "_%s_left" % self.name)
-        delattr(item, "_%s_right" % self.name)
-    
-    def _getleft(self, item):
-        return getattr(item, "_%s_left" % self.name)
-    
-    def _setleft(self, item, value):
-        setattr(item, "_%s_left" % self.name, value)
-        
-    def _getright(self, item):
-        return getattr(item, "_%s_right" % self.name)
-    
-    def _setright(self, item, value):
-        setattr(item, "_%s_right" % self.name, value)
+    def _allocate(self, item):
+        """
+        Assigns a slot to the item. The links of the slot are not initialized.
+        """
+        key = id(item)
+        if key in self._slots:
+            raise ValueError("already in the list")
     
-    class _Sentinel(object):
-        pass
+        self._generation += 1
+        if self._free:
+            slot = self._free.pop()
+            self._items[slot] = item
+        else:
+            slot = len(self._items)
+            self._items.append(item)
+            self._left.append(_SENTINEL)
+            self._right.append(_SENTINEL)
+        self._slots[key] = slot
+        return slot
     
@@ -1,10 +1,28 @@
 # Copyright (C) 2014 Stefan C. Mueller
 
+import base64
 import datetime
+import hmac
 import json
+import logging
+import math
+import re
+import time
 
 import tornado.web
 import tornado.gen
+import tornado.escape
+import tornado.ioloop
+import tornado.websocket
+from tornado.util import unicode_type
+
+from renatserver import asyncdb, profiling, replication
+
+#: Valid record ids, same as in the URL patterns.
+_RECORD_ID = re.compile(r"^[0-9a-zA-Z_\-]+$")
+
+#: Content type of raw values, see :class:`RecordHandler`.
+BINARY_TYPE = "application/octet-stream"
 
 class RecordIdHandler(tornado.web.RequestHandler):
     
@@ -12,13 +30,60 @@ class RecordIdHandler(tornado.web.RequestHandler):
         self.render("put.html", record_id=record_id)
 
 class RecordHandler(tornado.web.RequestHandler):
+    """
+    Reads and writes single record versions.
+    
+    The version is a number, `OLDEST`, `JUNGEST` or `NEXT`. `NEXT` gets the
+    oldest stored version newer than the one given as `after` in the query,
+    so that a consumer that fell behind skips evicted versions.
+    With a `timeout` in the query, a GET waits for the version to be put.
+    
+    By default the value is posted form encoded and returned in a JSON object.
+    In binary mode the value is the raw body: A POST with the content type 
+    `application/octet-stream` stores the body, the idepo is passed in the query.
+    A GET that accepts `application/octet-stream` gets the value as body. 
+    In both cases the id and version are in the `X-Record-Id` and `X-Record-Version` 
+    headers. Values that were posted as text are returned UTF-8 encoded as `text/plain`.
+    
+    Values stored in binary mode are base64 encoded in JSON responses.
+    All responses have the header `X-Renat-Binary` to tell clients that binary mode
+    is supported.
+    
+    A stored version never changes, so responses for a version number may be 
+    cached by clients and proxies, for half the eviction time. Until then the
+    version is not evicted even if the cached copies are read instead.
+    Like all GET responses, they have an ETag and conditional requests get a 304.
+    
+    A follower of another server (see :class:`renatserver.replication.Follower`) 
+    rejects puts with 403. Its responses name the primary in the `X-Renat-Primary`
+    header, and have the lag in seconds in `X-Replication-Lag`.
+    
+    Clients that exceed their rate limit or have too many long-polls waiting
+    get a 429 with a `Retry-After` header, see :func:`_admit`.
+    """
     
     MAX_TIMEOUT = 60
     
+    def initialize(self):
+        #: operation and outcome of the request for the metrics.
+        self._op = None
+        self._outcome = None
+        
+        #: `True` while the request counts as a long-poll for the admission control.
+        self._waiter = False
+    
+    def set_default_headers(self):
+        self.set_header("X-Renat-Binary", "1")
+        _set_replication_headers(self)
+        
+    def prepare(self):
+        _admit(self)
+    
     @tornado.gen.coroutine
     def get(self, record_id, record_version):
         
         db = self.application.settings["db"]
+        timeouts = self.application.settings["timeouts"]
         now = datetime.datetime.now()
         self.set_header("X-Request-From", self.request.remote_ip)
     
@@ -27,11 +92,26 @@ class RecordHandler(tornado.web.RequestHandler):
         timeout = max(timeout, 0)
         timeout = min(timeout, self.MAX_TIMEOUT)
         
+        concrete = record_version not in ("OLDEST", "JUNGEST", "NEXT")
+        self._op = "get" if concrete else record_version.lower()
+        waited = False
+        
+        if timeout > 0:
+            if not _enter_waiter(self):
+                return
+        
         if record_version == "OLDEST":
-            record_version = yield _timeout_helper(db.oldest_version, db.oldest_version_future, timeout, [record_id, now])
+            record_version, waited = yield _timeout_helper(timeouts, db.oldest_version, db.oldest_version_future, timeout, [record_id, now])
         
         if record_version == "JUNGEST":
-            record_version = yield _timeout_helper(db.jungest_version, db.jungest_version_future, timeout, [record_id, now])
+            record_version, waited = yield _timeout_helper(timeouts, db.jungest_version, db.jungest_version_future, timeout, [record_id, now])
+        
+        if record_version == "NEXT":
+            try:
+                after = int(self.get_argument("after"))
+            except ValueError:
+                raise tornado.web.HTTPError(400, "Invalid after.")
+            record_version, waited = yield _timeout_helper(timeouts, db.next_version, db.next_version_future, timeout, [record_id, after, now])
         
         if record_version is not None:
             record_version = int(record_version)
@@ -39,51 +119,874 @@ class RecordHandler(tornado.web.RequestHandler):
         if record_version is None:
             data = None
         else:
-            data = yield _timeout_helper(db.get, db.get_future, timeout, [record_id, record_version, now])
+            data, waited_for_data = yield _timeout_helper(timeouts, db.get, db.get_future, timeout, [record_id, record_version, now])
+            waited = waited or waited_for_data
         
+        if data is None:
+            self._outcome = "timeout" if timeout > 0 else "not_found"
+        else:
+            self._outcome = "waited" if waited else "hit"
         
+        if data is not None:
+            # tornado sets the ETag, a hash of the body, and replies 304 if it matches If-None-Match.
+            self.set_header("Vary", "Accept")
+            if concrete:
+                max_age = int(db.eviction_time.total_seconds()) // 2
+                self.set_header("Cache-Control", "public, max-age=%s, immutable" % max_age)
         
         if data is None:
             self.send_error(404)
+        elif BINARY_TYPE in self.request.headers.get("Accept", ""):
+            self._set_record_headers(record_id, record_version)
+            if isinstance(data, unicode_type):
+                self.set_header("Content-Type", "text/plain; charset=UTF-8")
+                data = tornado.escape.utf8(data)
+            else:
+                self.set_header("Content-Type", BINARY_TYPE)
+            self.finish(data)
         else:
             response = {"record_id": record_id,
                          "record_version": record_version,
-                         "value":data}
+                         "value":_json_value(data)}
             self.finish(json.dumps(response, indent=4))
             
             
+    @tornado.gen.coroutine
     def post(self, record_id, record_version):
         db = self.application.settings["db"]
         now = datetime.datetime.now()
+        self._op = "put"
         
+        binary = self.request.headers.get("Content-Type", "").startswith(BINARY_TYPE)
         idepo = self.get_argument("idepo")
-        data = self.get_argument("data")
+        if binary:
+            data = self.request.body
+        else:
+            data = self.get_argument("data")
         
         if record_version != "JUNGEST":
             raise ValueError("Can only post records as jungest.")
+        _check_writable(self)
         
-        record_version = db.put(record_id, idepo, data, now)
-         
-        response = {"record_id": record_id,
-                     "record_version": record_version}
-        self.finish(json.dumps(response, indent=4))
+        record_version = yield tornado.gen.maybe_future(db.put(record_id, idepo, data, now))
+        self._outcome = "ok"
+        
+        if binary:
+            self._set_record_headers(record_id, record_version)
+            self.finish()
+        else:
+            response = {"record_id": record_id,
+                         "record_version": record_version}
+            self.finish(json.dumps(response, indent=4))
+            
+            
+    def on_finish(self):
+        if self._waiter:
+            _leave_waiter(self)
+        _observe_request(self, self._op, self._outcome)
             
             
+    @tornado.gen.coroutine
+    def head(self, record_id, record_version):
+        """
+        Tells if a version is stored without sending its value: 404 if it is 
+        not, otherwise the headers of :class:`InfoHandler` and the id and version 
+        in `X-Record-Id` and `X-Record-Version`. Does not wait and does not 
+        reset the eviction timers. `NEXT` is not supported.
+        """
+        db = self.application.settings["db"]
+        now = datetime.datetime.now()
+        self.set_header("X-Request-From", self.request.remote_ip)
+        self._op = "head"
+        
+        if record_version == "NEXT":
+            raise tornado.web.HTTPError(405)
+        info = yield tornado.gen.maybe_future(db.info(record_id, now))
+        if info is None:
+            record_version = None
+        elif record_version == "OLDEST":
+            record_version = info[0]
+        elif record_version == "JUNGEST":
+            record_version = info[1]
+        else:
+            record_version = int(record_version)
+            stored = yield tornado.gen.maybe_future(db.contains(record_id, record_version, now))
+            if not stored:
+                record_version = None
+        
+        if record_version is None:
+            self._outcome = "not_found"
+            raise tornado.web.HTTPError(404)
+        self._outcome = "hit"
+        _set_info_headers(self, info)
+        self._set_record_headers(record_id, record_version)
+        self.finish()
+            
+            
+    def _set_record_headers(self, record_id, record_version):
+        self.set_header("X-Record-Id", record_id)
+        self.set_header("X-Record-Version", str(record_version))
+            
+            
+    def write_error(self, status_code, **kwargs):
+        self.set_header("X-Request-From", self.request.remote_ip)
+        tornado.web.RequestHandler.write_error(self, status_code, **kwargs)
+
+
+class InfoHandler(tornado.web.RequestHandler):
+    """
+    Version numbers of a record, without any values::
+    
+        {"record_id": ..., "oldest": 3, "jungest": 7, "count": 5}
+    
+    The same numbers are in the headers `X-Record-Oldest`, `X-Record-Jungest` 
+    and `X-Record-Count`, a HEAD request gets only those. 404 if the record
+    has no versions. Does not reset the eviction timers.
+    """
+    
+    def set_default_headers(self):
+        _set_replication_headers(self)
+        
+    def prepare(self):
+        _admit(self)
+    
+    @tornado.gen.coroutine
+    def get(self, record_id):
+        yield _send_info(self, record_id, body=True)
+        
+        
+    @tornado.gen.coroutine
+    def head(self, record_id):
+        yield _send_info(self, record_id, body=False)
+        
+        
+    def on_finish(self):
+        _observe_request(self, "info", "not_found" if self.get_status() == 404 else "ok")
+        
+        
+    def write_error(self, status_code, **kwargs):
+        self.set_header("X-Request-From", self.request.remote_ip)
+        tornado.web.RequestHandler.write_error(self, status_code, **kwargs)
+
+
+class RangeHandler(tornado.web.RequestHandler):
+    """
+    Reads the stored versions of a record from `first` to `last` (both included,
+    `last` defaults to all newer ones) with one request::
+    
+        {"record_id": ..., 
+         "versions": [{"record_version": 4, "value": ...}, ...],
+         "next": 9}
+    
+    At most `count` versions (up to `MAX_COUNT`) and `bytes` of values 
+    (up to `MAX_BYTES`) are returned. `next` is the version to pass as `first`
+    to get the rest, or `null` if there is none. Versions that are not stored are skipped.
+    """
+    
+    #: Maximal number of versions in one response.
+    MAX_COUNT = 1000
+    
+    #: Maximal size of the values in one response. A single larger version is returned anyway.
+    MAX_BYTES = 1024 * 1024
+    
+    def set_default_headers(self):
+        _set_replication_headers(self)
+        
+    def prepare(self):
+        _admit(self)
+    
+    @tornado.gen.coroutine
+    def get(self, record_id):
+        db = self.application.settings["db"]
+        now = datetime.datetime.now()
+        self.set_header("X-Request-From", self.request.remote_ip)
+        
+        try:
+            first_version = int(self.get_argument("first"))
+            last_version = self.get_argument("last", default=None)
+            last_version = int(last_version) if last_version is not None else None
+            max_count = int(self.get_argument("count", default=str(self.MAX_COUNT)))
+            max_bytes = int(self.get_argument("bytes", default=str(self.MAX_BYTES)))
+        except ValueError:
+            raise tornado.web.HTTPError(400, "Invalid range.")
+        if last_version is None:
+            last_version = 2 ** 62
+        max_count = min(max(max_count, 1), self.MAX_COUNT)
+        max_bytes = min(max(max_bytes, 1), self.MAX_BYTES)
+        
+        results, next_version = yield tornado.gen.maybe_future(
+            db.get_range(record_id, first_version, last_version, max_count, max_bytes, now))
+        
+        response = {"record_id": record_id,
+                    "versions": [{"record_version": record_version, "value": _json_value(data)}
+                                 for record_version, data in results],
+                    "next": next_version}
+        self.finish(json.dumps(response, indent=4))
+        
+        
+    def on_finish(self):
+        _observe_request(self, "range", "ok")
+        
+        
+    def write_error(self, status_code, **kwargs):
+        self.set_header("X-Request-From", self.request.remote_ip)
+        tornado.web.RequestHandler.write_error(self, status_code, **kwargs)
+
+
+class BatchHandler(tornado.web.RequestHandler):
+    """
+    Performs many puts and gets in one request.
+    
+    The body is a JSON object with the optional lists `puts` and `gets`::
+    
+        {"puts": [{"record_id": ..., "idepo": ..., "data": ...}, ...],
+         "gets": [{"record_id": ..., "record_version": ...}, ...]}
+    
+    `record_version` is a number, `"OLDEST"` or `"JUNGEST"`. The puts are
+    performed before the gets. The response has a result for each item,
+    in the same order. Failed items have an `error` instead of a version.
+    
+    Each item counts as one request for the rate limit.
+    """
+    
+    #: Maximal number of puts plus gets in one request.
+    MAX_ITEMS = 1000
+    
+    def set_default_headers(self):
+        _set_replication_headers(self)
+    
+    @tornado.gen.coroutine
+    def post(self):
+        db = self.application.settings["db"]
+        now = datetime.datetime.now()
+        self.set_header("X-Request-From", self.request.remote_ip)
+        
+        try:
+            request = json.loads(tornado.escape.to_unicode(self.request.body))
+            puts = [(p["record_id"], p["idepo"], p["data"]) for p in request.get("puts", [])]
+            gets = [(g["record_id"], g["record_version"]) for g in request.get("gets", [])]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            raise tornado.web.HTTPError(400, "Invalid batch request.")
+        
+        if len(puts) + len(gets) > self.MAX_ITEMS:
+            raise tornado.web.HTTPError(400, "Too many items.")
+        if not _admit(self, max(len(puts) + len(gets), 1)):
+            return
+        for record_id, idepo, data in puts:
+            self._check_record_id(record_id)
+            if not isinstance(idepo, unicode_type) or not isinstance(data, unicode_type):
+                raise tornado.web.HTTPError(400, "Invalid put.")
+        if puts:
+            _check_writable(self)
+        for record_id, record_version in gets:
+            self._check_record_id(record_id)
+            if record_version not in ("OLDEST", "JUNGEST") and not isinstance(record_version, int):
+                raise tornado.web.HTTPError(400, "Invalid record version.")
+        
+        put_results = yield tornado.gen.maybe_future(db.put_many(puts, now))
+        get_results = yield tornado.gen.maybe_future(db.get_many(gets, now))
+        
+        response = {"puts": [], "gets": []}
+        for (record_id, _, _), result in zip(puts, put_results):
+            if isinstance(result, ValueError):
+                response["puts"].append({"record_id": record_id,
+                                         "error": str(result)})
+            else:
+                response["puts"].append({"record_id": record_id,
+                                         "record_version": result})
+        for (record_id, record_version), result in zip(gets, get_results):
+            if result is None:
+                response["gets"].append({"record_id": record_id,
+                                         "record_version": record_version,
+                                         "error": 404})
+            else:
+                response["gets"].append({"record_id": record_id,
+                                         "record_version": result[0],
+                                         "value": _json_value(result[1])})
+        self.finish(json.dumps(response, indent=4))
+        
+        
+    def on_finish(self):
+        _observe_request(self, "batch", "ok")
+        
+        
+    def write_error(self, status_code, **kwargs):
+        self.set_header("X-Request-From", self.request.remote_ip)
+        tornado.web.RequestHandler.write_error(self, status_code, **kwargs)
+        
+        
+    def _check_record_id(self, record_id):
+        if not isinstance(record_id, unicode_type) or not _RECORD_ID.match(record_id):
+            raise tornado.web.HTTPError(400, "Invalid record id.")
+        
+        
+class WaitAnyHandler(tornado.web.RequestHandler):
+    """
+    Long-poll on many records at once.
+    
+    The body is a JSON object that maps record ids to version numbers,
+    and an optional timeout in seconds::
+    
+        {"records": {"id1": 3, "id2": 0}, "timeout": 60}
+        
+    Returns as soon as any of the records has a newer version than
+    the given one, with the jungest version of those records::
+    
+        {"records": {"id2": 1}}
+        
+    The records are empty if the timeout expired.
+    
+    With a timeout, the request counts as one long-poll for the admission
+    control, regardless of the number of records.
+    """
+    
+    #: Maximal number of records in one request.
+    MAX_RECORDS = 10000
+    
+    def initialize(self):
+        #: outcome of the request for the metrics.
+        self._outcome = None
+        
+        #: `True` while the request counts as a long-poll for the admission control.
+        self._waiter = False
+    
+    def set_default_headers(self):
+        _set_replication_headers(self)
+        
+    def prepare(self):
+        _admit(self)
+    
+    @tornado.gen.coroutine
+    def post(self):
+        db = self.application.settings["db"]
+        now = datetime.datetime.now()
+        self.set_header("X-Request-From", self.request.remote_ip)
+        
+        try:
+            request = json.loads(tornado.escape.to_unicode(self.request.body))
+            versions = request["records"]
+            timeout = int(request.get("timeout", 0))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            raise tornado.web.HTTPError(400, "Invalid wait request.")
+        
+        if not isinstance(versions, dict) or len(versions) > self.MAX_RECORDS:
+            raise tornado.web.HTTPError(400, "Invalid records.")
+        for record_id, record_version in versions.items():
+            if not _RECORD_ID.match(record_id) or not isinstance(record_version, int):
+                raise tornado.web.HTTPError(400, "Invalid records.")
+        
+        timeout = max(timeout, 0)
+        timeout = min(timeout, RecordHandler.MAX_TIMEOUT)
+        
+        if timeout > 0:
+            if not _enter_waiter(self):
+                return
+            future = db.wait_any_future(versions, now)
+            try:
+                newer = yield self.application.settings["timeouts"].with_timeout(timeout, future)
+            except tornado.gen.TimeoutError:
+                db.cancel_wait_any(future)
+                newer = {}
+        else:
+            newer = yield tornado.gen.maybe_future(db.newer_versions(versions, now))
+        
+        if newer:
+            self._outcome = "changed"
+        else:
+            self._outcome = "timeout" if timeout > 0 else "unchanged"
+        self.finish(json.dumps({"records": newer}, indent=4))
+        
+        
+    def on_finish(self):
+        if self._waiter:
+            _leave_waiter(self)
+        _observe_request(self, "wait", self._outcome)
+        
+        
     def write_error(self, status_code, **kwargs):
         self.set_header("X-Request-From", self.request.remote_ip)
         tornado.web.RequestHandler.write_error(self, status_code, **kwargs)
+        
+        
+class StatsHandler(tornado.web.RequestHandler):
+    """
+    Metrics of this server process in the Prometheus text format.
+    See :class:`renatserver.metrics.ServerMetrics`.
+    """
+    
+    def get(self):
+        metrics = self.application.settings["metrics"]
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.finish(metrics.render())
+        
+        
+class ProfileHandler(tornado.web.RequestHandler):
+    """
+    Profiles this server process while it keeps serving requests, for
+    `seconds` (at most `MAX_SECONDS`) given in the query.
+    Only available if the `admin_token` setting is set, and it has to be
+    passed in the `X-Admin-Token` header.
+    
+    `/debug/cpu` returns a `pstats` table, sorted by `sort` and limited to
+    `limit` functions. With `format=collapsed` it returns sampled call stacks
+    in the collapsed format of flame graph tools instead.
+    
+    `/debug/allocations` returns the `limit` lines (or call stacks with
+    `frames` > 1) that allocated the most memory that is still in use.
+    Python 2 has no `tracemalloc`, there it returns the `limit` types 
+    whose objects grew the most instead, see :class:`profiling.ObjectCounter`.
+    
+    Only one profile runs at a time.
+    """
+    
+    MAX_SECONDS = 60
+    
+    #: `True` while a profile is running in this process.
+    running = False
+    
+    @tornado.gen.coroutine
+    def get(self, mode):
+        _check_admin_token(self)
+        
+        try:
+            seconds = float(self.get_argument("seconds", default="10"))
+            limit = int(self.get_argument("limit", default="30"))
+            if mode == "cpu" and self.get_argument("format", default="pstats") == "collapsed":
+                profiler = profiling.StackSampler()
+            elif mode == "cpu":
+                profiler = profiling.CPUProfiler(self.get_argument("sort", default="cumulative"), limit)
+            elif profiling.tracemalloc is None:
+                profiler = profiling.ObjectCounter(limit)
+            else:
+                profiler = profiling.AllocationTracer(limit, int(self.get_argument("frames", default="1")))
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, str(e))
+        seconds = min(max(seconds, 0), self.MAX_SECONDS)
+        
+        if ProfileHandler.running:
+            raise tornado.web.HTTPError(409, "Another profile is running.")
+        ProfileHandler.running = True
+        try:
+            profiler.start()
+            try:
+                yield tornado.gen.sleep(seconds)
+            finally:
+                report = profiler.stop()
+        finally:
+            ProfileHandler.running = False
+        
+        self.set_header("Content-Type", "text/plain; charset=utf-8")
+        self.finish(report)
+        
+        
+class ReplicationHandler(tornado.websocket.WebSocketHandler):
+    """
+    Streams the puts of this server to a follower server over a WebSocket,
+    see :class:`renatserver.replication.Follower`. Requires a single server
+    process, and the `admin_token` in the `X-Admin-Token` header like :class:`ProfileHandler`.
+    
+    First all stored versions are sent, in several messages. Then the
+    follower is told that it is in sync, and gets every version as it is put.
+    The versions put in one IOLoop iteration are sent in one message::
+    
+        {"versions": [[record_id, record_version, idepo, value, binary], ...]}
+        {"synced": true, "time": ...}
+        {"versions": [...], "time": ...}
+        
+    `time` is the time the message was sent, in seconds since the epoch.
+    Every `HEARTBEAT_INTERVAL` seconds a message with only the time is sent,
+    so that the follower can tell how far it is behind.
+    
+    A follower that does not keep up, with more than `MAX_BACKLOG` messages
+    not yet written to the network, is disconnected. It reconnects and
+    gets a new snapshot.
+    """
+    
+    #: Seconds between two messages if there are no puts.
+    HEARTBEAT_INTERVAL = 1.0
+    
+    #: Maximal number of versions in one message.
+    MAX_VERSIONS = 1000
+    
+    #: Maximal number of messages waiting to be written to the network.
+    MAX_BACKLOG = 1000
+    
+    def prepare(self):
+        _check_admin_token(self)
+        if not isinstance(self.application.settings["db"], asyncdb.ASyncRecordDatabase):
+            raise tornado.web.HTTPError(501, "Replication requires a single server process.")
+        
+    def open(self):
+        db = self.application.settings["db"]
+        
+        #: encoded versions put since the last message.
+        self._pending = []
+        self._catching_up = True
+        self._flush_scheduled = False
+        
+        #: number of messages not yet written to the network.
+        self._backlog = 0
+        self._closed = False
+        
+        # No put can happen in between, so the follower gets every version once.
+        db.add_replica(self._on_put)
+        snapshot = db.dump()
+        self._heartbeat = tornado.ioloop.PeriodicCallback(self._send_heartbeat, self.HEARTBEAT_INTERVAL * 1000)
+        self._heartbeat.start()
+        tornado.ioloop.IOLoop.current().spawn_callback(self._send_snapshot, snapshot)
+        
+    def on_close(self):
+        self._closed = True
+        self._heartbeat.stop()
+        self.application.settings["db"].remove_replica(self._on_put)
+        
+    def _on_put(self, record_id, record_version, idepo, data):
+        self._pending.append(replication.encode_version(record_id, record_version, idepo, data))
+        if not self._catching_up and not self._flush_scheduled:
+            self._flush_scheduled = True
+            tornado.ioloop.IOLoop.current().add_callback(self._flush)
+            
+    @tornado.gen.coroutine
+    def _send_snapshot(self, snapshot):
+        for start in range(0, len(snapshot), self.MAX_VERSIONS):
+            versions = [replication.encode_version(*version) for version in snapshot[start:start + self.MAX_VERSIONS]]
+            # Without a time, the lag of the follower keeps growing until it is in sync.
+            future = self._write({"versions": versions}, with_time=False)
+            if future is None:
+                return
+            yield future
+        self._write({"synced": True})
+        self._catching_up = False
+        self._flush()
+        
+    def _flush(self):
+        self._flush_scheduled = False
+        pending, self._pending = self._pending, []
+        for start in range(0, len(pending), self.MAX_VERSIONS):
+            self._write({"versions": pending[start:start + self.MAX_VERSIONS]})
+            
+    def _send_heartbeat(self):
+        if not self._catching_up:
+            self._write({})
+        
+    def _write(self, message, with_time=True):
+        """
+        Returns a future that is done once the message is written
+        to the network, or `None` if the connection is closed.
+        """
+        if self._closed:
+            return None
+        if with_time:
+            message["time"] = time.time()
+        try:
+            future = self.write_message(json.dumps(message))
+        except tornado.websocket.WebSocketClosedError:
+            self._closed = True
+            return None
+        self._backlog += 1
+        future.add_done_callback(self._written)
+        if self._backlog > self.MAX_BACKLOG:
+            logging.warning("Disconnecting the follower %s, it does not keep up.", self.request.remote_ip)
+            self.close()
+            self._closed = True
+            return None
+        return future
+    
+    def _written(self, future):
+        self._backlog -= 1
+        
+        
+class SubscriptionHandler(tornado.websocket.WebSocketHandler):
+    """
+    Pushes new versions of records over a WebSocket.
+    
+    The client sends JSON messages to change its subscriptions::
+    
+        {"subscribe": record_id, "from_version": 5}
+        {"unsubscribe": record_id}
+        
+    After subscribing, the server confirms with the first version it will send::
+    
+        {"subscribed": record_id, "from_version": 5}
+        
+    Then it sends all stored versions starting with `from_version`
+    (or only new versions if `from_version` is `null`),
+    followed by each new version as it is put, in order::
+    
+        {"record_id": ..., "record_version": ..., "value": ...}
+    """
+    
+    #: Maximal number of records a single connection can subscribe to.
+    MAX_SUBSCRIPTIONS = 1000
+    
+    def prepare(self):
+        _admit(self)
+    
+    def open(self):
+        #: dict maps `id` to the `_Subscription`.
+        self._subscriptions = {}
+        
+    def on_message(self, message):
+        try:
+            message = json.loads(message)
+            if "subscribe" in message:
+                record_id = message["subscribe"]
+                from_version = message.get("from_version", None)
+                if not isinstance(record_id, unicode_type) or not _RECORD_ID.match(record_id):
+                    raise ValueError("Invalid record id.")
+                if from_version is not None and not isinstance(from_version, int):
+                    raise ValueError("Invalid version.")
+                self._subscribe(record_id, from_version)
+            elif "unsubscribe" in message:
+                self._unsubscribe(message["unsubscribe"])
+            else:
+                raise ValueError("Unknown message.")
+        except (ValueError, TypeError, AttributeError) as e:
+            self.write_message(json.dumps({"error": str(e)}))
+        
+    def on_close(self):
+        for record_id in list(self._subscriptions.keys()):
+            self._unsubscribe(record_id)
+            
+    def _subscribe(self, record_id, from_version):
+        if record_id in self._subscriptions:
+            raise ValueError("Already subscribed.")
+        if len(self._subscriptions) >= self.MAX_SUBSCRIPTIONS:
+            raise ValueError("Too many subscriptions.")
+        db = self.application.settings["db"]
+        subscription = _Subscription(self, record_id, from_version)
+        self._subscriptions[record_id] = subscription
+        db.subscribe(record_id, subscription.on_put)
+        tornado.ioloop.IOLoop.current().spawn_callback(subscription.catch_up, db)
+        
+    def _unsubscribe(self, record_id):
+        subscription = self._subscriptions.pop(record_id, None)
+        if subscription:
+            db = self.application.settings["db"]
+            db.unsubscribe(record_id, subscription.on_put)
+            subscription.closed = True
+            
+            
+class _Subscription(object):
+    """
+    Sends the versions of one record to a :class:`SubscriptionHandler` in order.
+    
+    Versions put while the stored versions are still being sent are
+    held back until the stored versions are through.
+    """
+    
+    def __init__(self, handler, record_id, from_version):
+        self.handler = handler
+        self.record_id = record_id
+        
+        #: next version to send. `None` until known.
+        self.next_version = from_version
+        
+        #: dict maps version to data of versions put during `catch_up`.
+        self.pending = {}
+        self.catching_up = True
+        self.closed = False
+        
+    def on_put(self, record_id, record_version, data):
+        if self.catching_up:
+            self.pending[record_version] = data
+        else:
+            self._send(record_version, data)
+            
+    @tornado.gen.coroutine
+    def catch_up(self, db):
+        now = datetime.datetime.now()
+        jungest = yield tornado.gen.maybe_future(db.jungest_version(self.record_id, now))
+        if self.next_version is None:
+            self.next_version = (jungest or 0) + 1
+        elif jungest is not None:
+            oldest = yield tornado.gen.maybe_future(db.oldest_version(self.record_id, now))
+            self.next_version = max(self.next_version, oldest or 0)
+        self._write({"subscribed": self.record_id, "from_version": self.next_version})
+        
+        if jungest is not None:
+            while self.next_version <= jungest and not self.closed:
+                data = yield tornado.gen.maybe_future(db.get(self.record_id, self.next_version, now))
+                if data is not None:
+                    self._send(self.next_version, data)
+                else:
+                    self.next_version += 1
+        
+        self.catching_up = False
+        for record_version in sorted(self.pending.keys()):
+            self._send(record_version, self.pending[record_version])
+        self.pending = {}
+        
+    def _send(self, record_version, data):
+        if self.closed or record_version < self.next_version:
+            return
+        self.next_version = record_version + 1
+        self._write({"record_id": self.record_id,
+                     "record_version": record_version,
+                     "value": _json_value(data)})
+        
+    def _write(self, message):
+        if self.closed:
+            return
+        try:
+            self.handler.write_message(json.dumps(message))
+        except tornado.websocket.WebSocketClosedError:
+            self.closed = True
+        
+        
+def _json_value(data):
+    """
+    Returns the value for a JSON response. Values stored in binary mode are base64 encoded.
+    """
+    if isinstance(data, unicode_type):
+        return data
+    else:
+        return base64.b64encode(data).decode("ascii")
 
 
 @tornado.gen.coroutine   
-def _timeout_helper(regular_func, future_func, timeout, args):
+def _timeout_helper(timeouts, regular_func, future_func, timeout, args):
+    """
+    Returns `(retval, waited)`, `waited` is true if the future was not done
+    right away.
+    
+    :param timeouts: :class:`renatserver.timeouts.TimeoutWheel` of the application.
+    """
+    waited = False
     if timeout > 0:
         future = future_func(*args)
-        future = tornado.gen.with_timeout(datetime.timedelta(seconds=timeout), future)
+        waited = not future.done()
+        future = timeouts.with_timeout(timeout, future)
         try:
             retval = yield future
         except tornado.gen.TimeoutError:
             retval = None
     else:
-        retval = regular_func(*args)
-    raise tornado.gen.Return(retval)
+        retval = yield tornado.gen.maybe_future(regular_func(*args))
+    raise tornado.gen.Return((retval, waited))
+
+
+@tornado.gen.coroutine
+def _send_info(handler, record_id, body):
+    db = handler.application.settings["db"]
+    handler.set_header("X-Request-From", handler.request.remote_ip)
+    info = yield tornado.gen.maybe_future(db.info(record_id, datetime.datetime.now()))
+    if info is None:
+        raise tornado.web.HTTPError(404)
+    _set_info_headers(handler, info)
+    oldest_version, jungest_version, count = info
+    if body:
+        handler.finish(json.dumps({"record_id": record_id,
+                                   "oldest": oldest_version,
+                                   "jungest": jungest_version,
+                                   "count": count}, indent=4))
+    else:
+        handler.finish()
+
+
+def _set_info_headers(handler, info):
+    oldest_version, jungest_version, count = info
+    handler.set_header("X-Record-Oldest", str(oldest_version))
+    handler.set_header("X-Record-Jungest", str(jungest_version))
+    handler.set_header("X-Record-Count", str(count))
+
+
+def _check_writable(handler):
+    """
+    Rejects puts on a follower with 403. The handler should set the headers of
+    :func:`_set_replication_headers`, which name the primary.
+    """
+    if handler.application.settings.get("follower", None) is not None:
+        raise tornado.web.HTTPError(403, "Read-only follower.")
+
+
+def _set_replication_headers(handler):
+    """
+    Tells clients of a follower where the primary is, and how far the follower
+    is behind, see :meth:`renatserver.replication.Follower.lag_seconds`.
+    """
+    follower = handler.application.settings.get("follower", None)
+    if follower is not None:
+        handler.set_header("X-Renat-Primary", follower.primary_url)
+        lag = follower.lag_seconds()
+        if lag is not None:
+            handler.set_header("X-Replication-Lag", "%.3f" % lag)
+
+
+def _check_admin_token(handler):
+    token = handler.application.settings.get("admin_token", None)
+    if not token:
+        raise tornado.web.HTTPError(404)
+    given = handler.request.headers.get("X-Admin-Token", "")
+    if not hmac.compare_digest(tornado.escape.utf8(given), tornado.escape.utf8(token)):
+        raise tornado.web.HTTPError(403)
+
+
+def _admit(handler, cost=1):
+    """
+    Charges `cost` requests to the rate limit of the client's IP, see
+    :class:`renatserver.admission.AdmissionControl`. If the limit is exceeded,
+    the request is finished with 429.
+    
+    :returns: `True` if the request may proceed.
+    """
+    admission = handler.application.settings.get("admission", None)
+    if admission is None:
+        return True
+    retry_after = admission.admit(handler.request.remote_ip, cost)
+    if retry_after:
+        _reject(handler, retry_after)
+        return False
+    return True
+
+
+def _enter_waiter(handler):
+    """
+    Counts the request as a long-poll of the client's IP. If there are too 
+    many, the request is finished with 429.
+    
+    :returns: `True` if the request may wait. If it was counted, its `_waiter`
+      is set and it has to call :func:`_leave_waiter` when it finishes.
+    """
+    admission = handler.application.settings.get("admission", None)
+    if admission is None:
+        return True
+    if not admission.enter_waiter(handler.request.remote_ip):
+        _reject(handler, admission.WAITERS_RETRY_AFTER)
+        return False
+    handler._waiter = True
+    return True
+
+
+def _leave_waiter(handler):
+    handler.application.settings["admission"].leave_waiter(handler.request.remote_ip)
+
+
+def _reject(handler, retry_after):
+    """
+    Finishes the request with 429. Unlike `HTTPError` this keeps the
+    `Retry-After` header, `send_error` would clear it.
+    """
+    handler.set_status(429, "Too Many Requests")
+    handler.set_header("Retry-After", str(int(math.ceil(retry_after))))
+    handler.set_header("X-Request-From", handler.request.remote_ip)
+    handler.finish()
+
+
+def _observe_request(handler, op, outcome):
+    """
+    Adds the time the request took to the metrics of the application.
+    Requests rejected by the admission control count as `"rejected"`.
+    Requests that failed before they had an outcome count as `"error"`, 
+    as do all other failures but 404.
+    """
+    metrics = handler.application.settings.get("metrics", None)
+    if metrics is None or op is None:
+        return
+    status = handler.get_status()
+    if status == 429:
+        outcome = "rejected"
+    elif outcome is None or (status >= 400 and status != 404):
+        outcome = "error"
+    metrics.request_seconds.observe(handler.request.request_time(), (op, outcome))
 
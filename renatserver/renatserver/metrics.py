@@ -0,0 +1,189 @@
+# Copyright (C) 2014 Stefan C. Mueller
+
+import bisect
+
+
+class Callback(object):
+    """
+    Counter or gauge whose value is read from a function when it is rendered.
+    Costs nothing until then.
+    """
+
+    def __init__(self, name, help, type, callback):
+        """
+        :param type: `"counter"` or `"gauge"`.
+        :param callback: Function without arguments that returns the value.
+        """
+        self.name = name
+        self.help = help
+        self.type = type
+        self.callback = callback
+
+    def samples(self):
+        yield self.name, "", self.callback()
+
+
+class Histogram(object):
+    """
+    Distribution of observed values, optionally split by labels.
+    """
+
+    type = "histogram"
+
+    #: Default upper bounds of the buckets, in seconds. Reaches up to the
+    #: longest long-poll.
+    LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                       0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+
+        #: dict that maps a tuple of label values to `[bucket counts..., sum]`.
+        #: The counts are per bucket, not cumulative. The last count is for
+        #: values larger than all bounds.
+        self.values = {}
+
+    def observe(self, value, label_values=()):
+        counts = self.values.get(label_values, None)
+        if counts is None:
+            counts = [0] * (len(self.buckets) + 1) + [0.0]
+            self.values[label_values] = counts
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        for label_values, counts in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                labels = _labels(self.labels + ("le",), label_values + (_format(bound),))
+                yield self.name + "_bucket", labels, cumulative
+            labels = _labels(self.labels, label_values)
+            yield self.name + "_sum", labels, counts[-1]
+            yield self.name + "_count", labels, cumulative
+
+
+class Registry(object):
+    """
+    Collection of metrics that can be rendered in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append("%s%s %s" % (name, labels, _format(value)))
+        return "\n".join(lines) + "\n"
+
+
+class ServerMetrics(Registry):
+    """
+    Metrics of a server process: size of the store, parked waiters, evictions
+    (read from the database when rendered) and request latency.
+    """
+
+    #: Metrics read from `stats()` of the database, as `(name, type, help)`.
+    DATABASE_STATS = (
+        ("records", "gauge", "Stored record versions, including expired ones not evicted yet."),
+        ("max_records", "gauge", "Maximal number of stored record versions."),
+        ("stored_bytes", "gauge", "Size of the stored data, ids and idepos."),
+        ("max_bytes", "gauge", "Maximal size of the stored data, ids and idepos. 0 for no limit."),
+        ("evicted_expired", "counter", "Record versions evicted because they were not accessed for the eviction time."),
+        ("evicted_pressure", "counter", "Record versions evicted early to stay within max_records and max_bytes."),
+        ("idepo_repeats", "counter", "Puts answered with the version of an earlier put with the same idepo."),
+        ("get_waiters", "gauge", "Long-polls waiting for a specific version."),
+        ("limit_waiters", "gauge", "Long-polls waiting for the first version of a record."),
+        ("next_waiters", "gauge", "Long-polls waiting for a version newer than a given one."),
+        ("any_waiters", "gauge", "Long-polls waiting for a new version of any of several records."),
+        ("subscribers", "gauge", "Subscriptions to records over WebSockets."),
+        ("woken_waiters", "counter", "Waiting long-polls that were woken up by a put."),
+        ("replicas", "gauge", "Follower servers that receive the puts of this server."),
+    )
+
+    def __init__(self, database, follower=None, admission=None):
+        """
+        :param database: :class:`ASyncRecordDatabase` or :class:`ShardedRecordDatabase`.
+        
+        :param follower: :class:`replication.Follower` if the server follows a primary.
+        
+        :param admission: :class:`admission.AdmissionControl` of the server.
+        """
+        Registry.__init__(self)
+        self.database = database
+
+        #: result of `database.stats()` while rendering.
+        self._stats = {}
+
+        #: request latency, labeled with the operation and outcome. See `handler`.
+        self.request_seconds = self.register(Histogram(
+            "renat_request_seconds", "Time to handle a request, including long-poll waits.",
+            ("op", "outcome")))
+
+        for name, type, help in self.DATABASE_STATS:
+            self.register(Callback("renat_" + name, help, type, self._stat(name)))
+            
+        if follower is not None:
+            self.register(Callback(
+                "renat_replication_lag_seconds", "Seconds since the primary sent the last message handled. NaN before the first.",
+                "gauge", lambda: _or_nan(follower.lag_seconds())))
+            self.register(Callback(
+                "renat_replication_synced", "1 while connected to the primary, once its snapshot is stored.",
+                "gauge", lambda: int(follower.synced)))
+            self.register(Callback(
+                "renat_replicated_versions", "Versions received from the primary.",
+                "counter", lambda: follower.replicated_versions))
+            
+        if admission is not None:
+            self.register(Callback(
+                "renat_admitted_waiters", "Long-polls counted by the admission control.",
+                "gauge", lambda: admission.waiters))
+            self.register(Callback(
+                "renat_rejected_rate", "Requests rejected with 429 because the client exceeded its rate limit.",
+                "counter", lambda: admission.rejected_rate))
+            self.register(Callback(
+                "renat_rejected_waiters", "Long-polls rejected with 429 because there were too many.",
+                "counter", lambda: admission.rejected_waiters))
+
+    def render(self):
+        self._stats = self.database.stats()
+        return Registry.render(self)
+
+    def _stat(self, name):
+        return lambda: self._stats[name]
+
+
+def _or_nan(value):
+    return float("nan") if value is None else value
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, _escape(value)) for name, value in zip(names, values))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format(value):
+    if value == float("inf"):
+        return "+Inf"
+    elif value != value:
+        return "NaN"
+    elif isinstance(value, float):
+        return repr(value)
+    else:
+        return str(value)
@@ -0,0 +1,208 @@
+# Copyright (C) 2014 Stefan C. Mueller
+
+import collections
+import cProfile
+import gc
+import os.path
+import pstats
+import signal
+import sys
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2 has no tracemalloc.
+    tracemalloc = None
+
+
+class CPUProfiler(object):
+    """
+    Deterministic profile of all functions called while it runs,
+    reported as a `pstats` table.
+
+    Profiles the calling thread only, in the server that is the thread
+    of the IOLoop.
+    """
+
+    #: Valid values for `sort`.
+    SORT_KEYS = tuple(sorted(pstats.Stats.sort_arg_dict_default))
+
+    def __init__(self, sort="cumulative", limit=100):
+        """
+        :param sort: Column by which the table is sorted, see `SORT_KEYS`.
+        :param limit: Maximal number of functions in the table.
+        """
+        if sort not in self.SORT_KEYS:
+            raise ValueError("Invalid sort key %s." % repr(sort))
+        self.sort = sort
+        self.limit = limit
+        self._profile = None
+
+    def start(self):
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def stop(self):
+        """
+        Stops profiling and returns the report.
+        """
+        self._profile.disable()
+        stream = StringIO()
+        stats = pstats.Stats(self._profile, stream=stream)
+        stats.sort_stats(self.sort).print_stats(self.limit)
+        return stream.getvalue()
+
+
+class StackSampler(object):
+    """
+    Statistical profile from the call stacks seen at regular intervals of
+    CPU time, reported as collapsed stacks for flame graph tools::
+
+        main (server.py:185);start (ioloop.py:...);get (handler.py:53) 42
+
+    Idle time in the IOLoop costs no CPU and therefore does not show up.
+    Uses `SIGPROF`, so it must be started from the main thread.
+    """
+
+    def __init__(self, interval=0.001):
+        """
+        :param interval: Seconds of CPU time between two samples.
+        """
+        self.interval = interval
+
+        #: maps the collapsed stack to the number of samples.
+        self.stacks = collections.Counter()
+
+        self._previous_handler = None
+
+    def start(self):
+        self._previous_handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        """
+        Stops sampling and returns the report.
+        """
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._previous_handler or signal.SIG_DFL)
+        lines = ["%s %s" % (stack, count) for stack, count in self.stacks.most_common()]
+        return "".join(line + "\n" for line in lines)
+
+    def _sample(self, signum, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append("%s (%s:%s)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        self.stacks[";".join(reversed(names))] += 1
+
+
+class AllocationTracer(object):
+    """
+    Memory allocated while it runs and not yet freed when it stops,
+    grouped by the line that allocated it. Requires `tracemalloc`,
+    see :class:`ObjectCounter` otherwise.
+    """
+
+    def __init__(self, limit=30, frames=1):
+        """
+        :param limit: Maximal number of allocation sites in the report.
+        :param frames: Number of frames stored per allocation. With more than one
+          the sites are grouped by their call stack instead of their line.
+        """
+        if tracemalloc is None:
+            raise ValueError("tracemalloc is not available.")
+        self.limit = limit
+        self.frames = frames
+
+    def start(self):
+        if tracemalloc.is_tracing():
+            raise ValueError("tracemalloc is already tracing.")
+        tracemalloc.start(self.frames)
+
+    def stop(self):
+        """
+        Stops tracing and returns the report.
+        """
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        key_type = "lineno" if self.frames == 1 else "traceback"
+        statistics = snapshot.statistics(key_type)
+
+        lines = ["%s KiB in %s blocks still allocated, top %s sites:" % (
+            sum(stat.size for stat in statistics) // 1024,
+            sum(stat.count for stat in statistics),
+            self.limit)]
+        for stat in statistics[:self.limit]:
+            lines.append("")
+            lines.append("%s KiB in %s blocks" % (stat.size // 1024, stat.count))
+            lines.extend(stat.traceback.format())
+        return "".join(line + "\n" for line in lines)
+
+
+class ObjectCounter(object):
+    """
+    Growth of the live objects between start and stop, grouped by type.
+    For Python 2, which has no `tracemalloc`.
+
+    Counts the objects tracked by the garbage collector and the untracked
+    ones they refer to directly, such as strings and numbers. An untracked object
+    referred to by several containers is counted once per container. 
+    Each count walks all objects and blocks the process for a while 
+    if there are many of them.
+    """
+
+    def __init__(self, limit=30):
+        """
+        :param limit: Maximal number of types in the report.
+        """
+        self.limit = limit
+        self._start = None
+
+    def start(self):
+        self._start = _count_objects()
+
+    def stop(self):
+        """
+        Returns the report.
+        """
+        end = _count_objects()
+        growth = []
+        for name in set(self._start) | set(end):
+            count_before, size_before = self._start.get(name, (0, 0))
+            count_after, size_after = end.get(name, (0, 0))
+            growth.append((size_after - size_before, count_after - count_before, name))
+        growth.sort(reverse=True)
+        self._start = None
+
+        lines = ["%+d KiB in %+d objects, top %s types:" % (
+            sum(size for size, _, _ in growth) // 1024,
+            sum(count for _, count, _ in growth),
+            self.limit)]
+        for size, count, name in growth[:self.limit]:
+            lines.append("%+10d KiB %+10d objects  %s" % (size // 1024, count, name))
+        return "".join(line + "\n" for line in lines)
+
+
+def _count_objects():
+    """
+    Returns a dict that maps the type names to `(count, bytes)` of the live objects.
+    """
+    counts = {}
+    def add(obj):
+        name = type(obj).__module__ + "." + type(obj).__name__
+        count, size = counts.get(name, (0, 0))
+        counts[name] = (count + 1, size + sys.getsizeof(obj, 0))
+    gc.collect()
+    for obj in gc.get_objects():
+        add(obj)
+        for referent in gc.get_referents(obj):
+            if not gc.is_tracked(referent):
+                add(referent)
+    return counts
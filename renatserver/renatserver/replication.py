@@ -0,0 +1,149 @@
+# Copyright (C) 2014 Stefan C. Mueller
+
+import base64
+import datetime
+import json
+import logging
+import socket
+import time
+
+import tornado.gen
+import tornado.httpclient
+import tornado.ioloop
+import tornado.iostream
+import tornado.websocket
+from tornado.util import unicode_type
+
+logger = logging.getLogger(__name__)
+
+
+def encode_version(record_id, record_version, idepo, data):
+    """
+    Returns a version as sent by :class:`renatserver.handler.ReplicationHandler`:
+    `[record_id, record_version, idepo, value, binary]`. Values stored in
+    binary mode are base64 encoded.
+    """
+    if isinstance(data, unicode_type):
+        return [record_id, record_version, idepo, data, False]
+    else:
+        return [record_id, record_version, idepo, base64.b64encode(data).decode("ascii"), True]
+
+
+def decode_version(version):
+    """
+    Reverses :func:`encode_version`. Returns `(record_id, record_version, idepo, data)`.
+    """
+    record_id, record_version, idepo, value, binary = version
+    if binary:
+        value = base64.b64decode(value)
+    return record_id, record_version, idepo, value
+
+
+class Follower(object):
+    """
+    Keeps the store of a follower server in sync with a primary server.
+
+    Connects to :class:`renatserver.handler.ReplicationHandler` of the primary,
+    stores the versions of its snapshot and then every version put on the primary,
+    with the same version number and idepo. Waiters parked on the follower
+    are woken up as the versions arrive. If the connection is lost, it
+    reconnects and gets a new snapshot.
+
+    Only the puts are replicated. Both servers evict versions on their own,
+    depending on the reads each of them serves.
+    """
+
+    #: Seconds to wait before reconnecting to the primary.
+    RECONNECT_DELAY = 1.0
+
+    #: Seconds without a message after which the connection is considered
+    #: lost. The primary sends a heartbeat every
+    #: :attr:`renatserver.handler.ReplicationHandler.HEARTBEAT_INTERVAL` seconds.
+    PRIMARY_TIMEOUT = 10.0
+
+    def __init__(self, database, primary_url, admin_token):
+        """
+        :param database: :class:`ASyncRecordDatabase` of the follower.
+
+        :param primary_url: URL of the primary server, such as `http://primary:8888`.
+
+        :param admin_token: `admin_token` of the primary.
+        """
+        self.database = database
+        self.primary_url = primary_url.rstrip("/")
+        self.admin_token = admin_token
+
+        #: `True` while connected to the primary, once the snapshot is stored.
+        self.synced = False
+
+        #: number of versions stored that were received from the primary.
+        self.replicated_versions = 0
+
+        #: time of the primary (seconds since the epoch) at which it sent the
+        #: last message that was handled. `None` until the first one.
+        self.primary_time = None
+
+    def start(self):
+        tornado.ioloop.IOLoop.current().spawn_callback(self._run)
+
+    def lag_seconds(self):
+        """
+        Seconds since the primary sent the last message that was handled, `None`
+        before the first one. While in sync this is the network delay plus up to
+        one heartbeat interval, and it grows if the connection stalls or is lost.
+        It includes the difference between the clocks of the two servers.
+        """
+        if self.primary_time is None:
+            return None
+        return max(time.time() - self.primary_time, 0.0)
+
+    @tornado.gen.coroutine
+    def _run(self):
+        url = "ws" + self.primary_url[len("http"):] + "/replicate"
+        while True:
+            request = tornado.httpclient.HTTPRequest(url, headers={"X-Admin-Token": self.admin_token or ""})
+            try:
+                connection = yield tornado.websocket.websocket_connect(request)
+            except (tornado.httpclient.HTTPError, tornado.iostream.StreamClosedError, socket.error) as e:
+                logger.warning("Cannot connect to the primary %s: %s", self.primary_url, e)
+            else:
+                logger.info("Connected to the primary %s.", self.primary_url)
+                try:
+                    yield self._receive(connection)
+                finally:
+                    self.synced = False
+                    connection.close()
+                logger.warning("Lost the connection to the primary %s.", self.primary_url)
+            yield tornado.gen.sleep(self.RECONNECT_DELAY)
+
+    @tornado.gen.coroutine
+    def _receive(self, connection):
+        while True:
+            try:
+                message = yield tornado.gen.with_timeout(datetime.timedelta(seconds=self.PRIMARY_TIMEOUT),
+                                                         connection.read_message())
+            except tornado.gen.TimeoutError:
+                return
+            if message is None:
+                return
+            self.handle_message(json.loads(message))
+
+    def handle_message(self, message):
+        """
+        Stores the versions of a message from the primary.
+        """
+        now = datetime.datetime.now()
+        for version in message.get("versions", ()):
+            record_id, record_version, idepo, data = decode_version(version)
+            try:
+                self.database.put_version(record_id, record_version, idepo, data, now)
+            except ValueError as e:
+                # The primary is configured with larger limits.
+                logger.warning("Cannot store version %s of %s: %s", record_version, record_id, e)
+            else:
+                self.replicated_versions += 1
+        if message.get("synced", False):
+            self.synced = True
+            logger.info("In sync with the primary %s.", self.primary_url)
+        if "time" in message:
+            self.primary_time = message["time"]
@@ -2,11 +2,37 @@
 
 import os.path
 import inspect
+import datetime
+import tempfile
+import shutil
+import atexit
+import logging
 
 import tornado.ioloop
 import tornado.web
+import tornado.gen
+import tornado.httpserver
+import tornado.netutil
+import tornado.process
+from tornado.options import define, options
 
-from renatserver import handler, db, asyncdb
+from renatserver import handler, db, asyncdb, shard, wal, metrics, timeouts, replication, admission
+from renatserver.db import InMemoryRecordDatabase
+from renatserver.arenadb import ArenaRecordDatabase
+
+define("port", default=8888, help="port to listen on")
+define("processes", default=1, help="number of worker processes. Record ids are sharded across them. 0 uses one per CPU.")
+define("backend", default="memory", help="record store: 'memory' for one object per record version, 'arena' for arrays and byte arenas.")
+define("max_bytes", default=None, type=int, help="byte budget for stored data, ids and idepos (per process). Least recently accessed versions are evicted to stay within it.")
+define("log_dir", default=None, help="directory for the write log. If set, the records survive a restart. Requires the 'memory' backend and the same number of processes on every start.")
+define("log_commit_interval", default=50, help="milliseconds between two fsyncs of the write log. Puts of the last interval are lost on a crash.")
+define("log_compact_interval", default=600, help="seconds between two compactions of the write log. Bounds the time needed to replay the log on startup.")
+define("admin_token", default=None, help="token that has to be passed in the X-Admin-Token header to use the /debug/ profiling handlers and /replicate. They are disabled if not set.")
+define("replicate_from", default=None, help="URL of a primary server, such as http://primary:8888. This server then follows it: it gets all versions put on the primary, serves reads and rejects puts. Requires a single process on both servers and the admin_token of the primary.")
+define("rate_limit", default=0, type=float, help="requests per second per client IP (per process), batches count one per item. Clients above it get 429 with a Retry-After header. 0 for no limit.")
+define("rate_burst", default=0, type=int, help="requests a client IP can make at once after it was idle. Defaults to one second worth of rate_limit.")
+define("max_waiters_per_ip", default=0, help="maximal number of concurrent long-polls per client IP (per process). 0 for no limit.")
+define("max_waiters", default=0, help="maximal number of concurrent long-polls of all clients (per process). 0 for no limit.")
 
 
 template_path = os.path.join(
@@ -20,16 +46,147 @@ template_path = os.path.join(
         "templates")
 
 
-db = asyncdb.ASyncRecordDatabase(db.InMemoryRecordDatabase())
+def make_application(database, follower=None):
+    """
+    :param follower: :class:`replication.Follower` if this server follows a primary.
+    """
+    admission_control = admission.AdmissionControl(options.rate_limit, options.rate_burst,
+                                                   options.max_waiters_per_ip, options.max_waiters)
+    return tornado.web.Application([
+        (r"/rec/(?P<record_id>[0-9a-zA-Z_\-]+)/?", handler.RecordIdHandler),
+        (r"/rec/(?P<record_id>[0-9a-zA-Z_\-]+)/RANGE", handler.RangeHandler),
+        (r"/rec/(?P<record_id>[0-9a-zA-Z_\-]+)/INFO", handler.InfoHandler),
+        (r"/rec/(?P<record_id>[0-9a-zA-Z_\-]+)/(?P<record_version>\-?[A-Z0-9]+)", handler.RecordHandler),
+        (r"/batch/?", handler.BatchHandler),
+        (r"/wait/?", handler.WaitAnyHandler),
+        (r"/sub/?", handler.SubscriptionHandler),
+        (r"/stats/?", handler.StatsHandler),
+        (r"/debug/(?P<mode>cpu|allocations)/?", handler.ProfileHandler),
+        (r"/replicate/?", handler.ReplicationHandler)
+    ], template_path=template_path, db=database, metrics=metrics.ServerMetrics(database, follower, admission_control),
+       timeouts=timeouts.TimeoutWheel(), admin_token=options.admin_token, follower=follower,
+       admission=admission_control)
+
+
+def make_database(shard_index=None):
+    """
+    Creates the database as configured by the command line options.
+    If a write log is configured, the records are restored from it.
+    """
+    if options.backend == "memory":
+        backend = InMemoryRecordDatabase
+    elif options.backend == "arena":
+        backend = ArenaRecordDatabase
+    else:
+        raise ValueError("Unknown backend %s" % repr(options.backend))
+    
+    if not options.log_dir:
+        return asyncdb.ASyncRecordDatabase(backend(max_bytes=options.max_bytes))
+    
+    if options.replicate_from:
+        # A follower gets a snapshot from the primary when it starts.
+        raise ValueError("A follower cannot have a write log.")
+    if backend is not InMemoryRecordDatabase:
+        raise ValueError("The write log requires the 'memory' backend.")
+    directory = options.log_dir
+    if shard_index is not None:
+        directory = os.path.join(directory, "shard-%s" % shard_index)
+    store = backend(max_bytes=options.max_bytes, log=wal.WriteLog(directory))
+    count = store.replay(datetime.datetime.now())
+    logging.info("Restored %s record versions from %s.", count, directory)
+    start_log(store)
+    return asyncdb.ASyncRecordDatabase(store)
+
+
+db = asyncdb.ASyncRecordDatabase(InMemoryRecordDatabase())
+
+application = make_application(db)
+
+#: Interval in milliseconds in which expired records are evicted.
+EVICT_INTERVAL = 100
+
+#: Maximal number of records evicted per interval. Keeps the time the
+#: sweeper blocks the IOLoop bounded. Expired records that are not yet
+#: evicted are treated as absent.
+EVICT_BATCH = 10000
+
+def start_sweeper(db):
+    """
+    Periodically evicts expired records from `db` in the background.
+    """
+    def sweep():
+        db.evict(datetime.datetime.now(), EVICT_BATCH)
+    sweeper = tornado.ioloop.PeriodicCallback(sweep, EVICT_INTERVAL)
+    sweeper.start()
+    return sweeper
+
+def start_log(store):
+    """
+    Periodically commits and compacts the write log of `store` in the background.
+    """
+    committer = tornado.ioloop.PeriodicCallback(store.log.commit, options.log_commit_interval)
+    committer.start()
+    
+    compacting = [False]
+    @tornado.gen.coroutine
+    def compact():
+        if compacting[0]:
+            return
+        compacting[0] = True
+        try:
+            for _ in store.log.compact(store.snapshot()):
+                yield tornado.gen.moment
+        finally:
+            compacting[0] = False
+    compactor = tornado.ioloop.PeriodicCallback(compact, options.log_compact_interval * 1000)
+    compactor.start()
+    return committer, compactor
 
-application = tornado.web.Application([
-    (r"/rec/(?P<record_id>[0-9a-zA-Z_\-]+)/?", handler.RecordIdHandler),
-    (r"/rec/(?P<record_id>[0-9a-zA-Z_\-]+)/(?P<record_version>\-?[A-Z0-9]+)", handler.RecordHandler)
-], template_path=template_path, db=db)
+def run_sharded(port, processes):
+    """
+    Forks `processes` worker processes that all accept connections on `port`.
+    Each worker owns a shard of the record ids, see :class:`shard.ShardedRecordDatabase`.
+    Does not return.
+    """
+    shard_count = processes or tornado.process.cpu_count()
+    sockets = tornado.netutil.bind_sockets(port)
+    socket_dir = tempfile.mkdtemp(prefix="renat-")
+    
+    parent_pid = os.getpid()
+    def cleanup():
+        if os.getpid() == parent_pid:
+            shutil.rmtree(socket_dir, ignore_errors=True)
+    atexit.register(cleanup)
+    
+    shard_index = tornado.process.fork_processes(shard_count)
+    
+    database = shard.ShardedRecordDatabase(make_database(shard_index), shard_index, shard_count, socket_dir)
+    server = tornado.httpserver.HTTPServer(make_application(database))
+    
+    @tornado.gen.coroutine
+    def start():
+        yield database.start()
+        server.add_sockets(sockets)
+        
+    start_sweeper(database)
+    tornado.ioloop.IOLoop.current().add_callback(start)
+    tornado.ioloop.IOLoop.current().start()
 
 def main():
-    application.listen(8888)
-    tornado.ioloop.IOLoop.instance().start()
+    options.parse_command_line()
+    if options.processes == 1:
+        database = make_database()
+        follower = None
+        if options.replicate_from:
+            follower = replication.Follower(database, options.replicate_from, options.admin_token)
+            follower.start()
+        make_application(database, follower).listen(options.port)
+        start_sweeper(database)
+        tornado.ioloop.IOLoop.instance().start()
+    elif options.replicate_from:
+        raise ValueError("A follower requires a single process.")
+    else:
+        run_sharded(options.port, options.processes)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
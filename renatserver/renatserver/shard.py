@@ -0,0 +1,554 @@
+# Copyright (C) 2014 Stefan C. Mueller
+
+import base64
+import datetime
+import json
+import logging
+import os.path
+import socket
+import struct
+import zlib
+
+import tornado.concurrent
+import tornado.escape
+import tornado.gen
+import tornado.ioloop
+import tornado.iostream
+import tornado.netutil
+from tornado.util import unicode_type
+
+logger = logging.getLogger(__name__)
+
+def shard_of(record_id, shard_count):
+    """
+    Returns the index of the shard that owns the given record id.
+    Stable across processes.
+    """
+    return (zlib.crc32(tornado.escape.utf8(record_id)) & 0xffffffff) % shard_count
+
+
+class ShardUnavailableError(Exception):
+    """
+    Raised if the process owning a record cannot be reached.
+    """
+    pass
+
+
+class ShardedRecordDatabase(object):
+    """
+    Replacement for :class:`ASyncRecordDatabase` for one process of
+    a multi-process server.
+
+    Each process owns a shard of the record ids and stores only those in `local`.
+    Operations on records owned by another process are forwarded to it over
+    a :class:`ShardBus`. Puts are broadcast over the bus, so that long-polls
+    parked in any process are woken up.
+    All methods (except :meth:`evict`) return futures.
+    """
+
+    #: Methods that other processes may call on the local shard.
+    #: They are called with the arguments from the message and `now`.
+    _REMOTE_METHODS = ("get", "get_or_touch", "contains", "oldest_version", "jungest_version", "next_version",
+                       "info", "touch", "put", "put_many", "get_many", "get_range", "newer_versions")
+
+    def __init__(self, local, shard_index, shard_count, socket_dir):
+        """
+        :param local: :class:`ASyncRecordDatabase` for the records owned by
+          this process. Also used to park waiters for records owned by other processes.
+
+        :param shard_index: Index of this process, `0 <= shard_index < shard_count`.
+
+        :param shard_count: Number of processes.
+
+        :param socket_dir: Directory shared by all processes in which
+          the unix sockets of the bus are created.
+        """
+        self.local = local
+        self.eviction_time = local.eviction_time
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.bus = ShardBus(socket_dir, shard_index, shard_count, self._handle_call, self.local.notify)
+
+    def start(self):
+        """
+        Connects to the other processes.
+        Returns a future that callbacks once all are connected.
+        """
+        return self.bus.start()
+
+    def get_future(self, record_id, record_version, now=None):
+        owner = self._owner(record_id)
+        if owner is None:
+            return self.local.get_future(record_id, record_version, now)
+
+        future = self.local.wait_for_version(record_id, record_version)
+
+        def got_data(data):
+            if data is not None and not future.done():
+                future.set_result(data)
+        self._forward(owner, "get_or_touch", [record_id, record_version], got_data, future)
+        return future
+
+    def wait_any_future(self, versions, now=None):
+        future = self.local.wait_for_any(versions)
+
+        def got_newer(newer):
+            if newer and not future.done():
+                future.set_result(newer)
+        for owner, owned in self._by_owner(versions).items():
+            if owner is None:
+                got_newer(self.local.newer_versions(owned, now))
+            else:
+                self._forward(owner, "newer_versions", [owned], got_newer, future)
+        return future
+
+    @tornado.gen.coroutine
+    def newer_versions(self, versions, now=None):
+        by_owner = self._by_owner(versions)
+        replies = yield [self._call(next(iter(owned)), "newer_versions", [owned], now)
+                         for owned in by_owner.values()]
+        newer = {}
+        for reply in replies:
+            newer.update(reply)
+        raise tornado.gen.Return(newer)
+
+    def cancel_wait_any(self, future):
+        self.local.cancel_wait_any(future)
+
+    def oldest_version_future(self, record_id, now=None):
+        return self._limit_future(record_id, "oldest_version", now)
+
+    def jungest_version_future(self, record_id, now=None):
+        return self._limit_future(record_id, "jungest_version", now)
+
+    def next_version_future(self, record_id, record_version, now=None):
+        owner = self._owner(record_id)
+        if owner is None:
+            return self.local.next_version_future(record_id, record_version, now)
+
+        future = self.local.wait_for_next(record_id, record_version)
+
+        def got_version(next_version):
+            if next_version is not None and not future.done():
+                future.set_result(next_version)
+        self._forward(owner, "next_version", [record_id, record_version], got_version, future)
+        return future
+
+    def put(self, record_id, idepo, data, now=None):
+        return self._call(record_id, "put", [record_id, idepo, data], now)
+
+    def get(self, record_id, record_version, now=None):
+        return self._call(record_id, "get", [record_id, record_version], now)
+
+    def contains(self, record_id, record_version, now=None):
+        return self._call(record_id, "contains", [record_id, record_version], now)
+
+    def oldest_version(self, record_id, now=None):
+        return self._call(record_id, "oldest_version", [record_id], now)
+
+    def jungest_version(self, record_id, now=None):
+        return self._call(record_id, "jungest_version", [record_id], now)
+
+    def next_version(self, record_id, record_version, now=None):
+        return self._call(record_id, "next_version", [record_id, record_version], now)
+
+    @tornado.gen.coroutine
+    def info(self, record_id, now=None):
+        info = yield self._call(record_id, "info", [record_id], now)
+        raise tornado.gen.Return(tuple(info) if info is not None else None)
+
+    @tornado.gen.coroutine
+    def get_range(self, record_id, first_version, last_version, max_count, max_bytes, now=None):
+        results, next_version = yield self._call(record_id, "get_range",
+                                                 [record_id, first_version, last_version, max_count, max_bytes], now)
+        raise tornado.gen.Return(([tuple(r) for r in results], next_version))
+
+    def touch(self, record_id, record_version, now=None):
+        return self._call(record_id, "touch", [record_id, record_version], now)
+
+    @tornado.gen.coroutine
+    def put_many(self, puts, now=None):
+        results = yield self._many("put_many", puts, now)
+        raise tornado.gen.Return([ValueError(r["error"]) if isinstance(r, dict) else r for r in results])
+
+    @tornado.gen.coroutine
+    def get_many(self, gets, now=None):
+        results = yield self._many("get_many", gets, now)
+        raise tornado.gen.Return([tuple(r) if r is not None else None for r in results])
+
+    def subscribe(self, record_id, callback):
+        self.local.subscribe(record_id, callback)
+
+    def unsubscribe(self, record_id, callback):
+        self.local.unsubscribe(record_id, callback)
+
+    def evict(self, now=None, max_count=None):
+        return self.local.evict(now, max_count)
+
+    def stats(self):
+        """
+        Statistics of the local shard, see :meth:`ASyncRecordDatabase.stats`.
+        """
+        return self.local.stats()
+
+    def _owner(self, record_id):
+        """
+        Returns the index of the process owning the record,
+        or `None` if it is this process.
+        """
+        owner = shard_of(record_id, self.shard_count)
+        return None if owner == self.shard_index else owner
+
+    def _by_owner(self, versions):
+        """
+        Splits a dict keyed by record id into one dict per owning process.
+        """
+        by_owner = {}
+        for record_id, record_version in versions.items():
+            by_owner.setdefault(self._owner(record_id), {})[record_id] = record_version
+        return by_owner
+
+    def _limit_future(self, record_id, method, now):
+        owner = self._owner(record_id)
+        if owner is None:
+            return getattr(self.local, method + "_future")(record_id, now)
+
+        future = self.local.wait_for_limit(record_id)
+
+        def got_version(record_version):
+            if record_version is not None and not future.done():
+                future.set_result(record_version)
+        self._forward(owner, method, [record_id], got_version, future)
+        return future
+
+    def _forward(self, owner, method, args, callback, future):
+        """
+        Calls `method` on the owning process and passes the result to `callback`.
+        Failures are reported to `future`.
+        """
+        def done(reply):
+            if reply.exception() is not None:
+                if not future.done():
+                    future.set_exception(reply.exception())
+            else:
+                callback(reply.result())
+        self._remote(owner, method, args).add_done_callback(done)
+
+    def _call(self, record_id, method, args, now):
+        owner = self._owner(record_id)
+        if owner is None:
+            return tornado.gen.maybe_future(self._local_call(method, args, now))
+        else:
+            return self._remote(owner, method, args)
+
+    @tornado.gen.coroutine
+    def _remote(self, owner, method, args):
+        """
+        Calls `method` in the process `owner`. Values are sent as
+        :func:`_encode_data` and decoded again, so binary values stay bytes.
+        """
+        result = yield self.bus.call(owner, method, _encode_args(method, args))
+        raise tornado.gen.Return(_decode_result(method, result))
+
+    @tornado.gen.coroutine
+    def _many(self, method, items, now):
+        """
+        Calls a batch method once per owning process with the items it owns.
+        Returns the results in the order of `items`.
+        """
+        by_owner = {}
+        for position, item in enumerate(items):
+            by_owner.setdefault(self._owner(item[0]), []).append(position)
+
+        owners = list(by_owner.keys())
+        futures = []
+        for owner in owners:
+            owned = [items[position] for position in by_owner[owner]]
+            if owner is None:
+                futures.append(tornado.gen.maybe_future(self._local_call(method, [owned], now)))
+            else:
+                futures.append(self._remote(owner, method, [owned]))
+        replies = yield futures
+
+        results = [None] * len(items)
+        for owner, reply in zip(owners, replies):
+            for position, result in zip(by_owner[owner], reply):
+                results[position] = result
+        raise tornado.gen.Return(results)
+
+    def _handle_call(self, method, args):
+        """
+        Handles a call from another process.
+        """
+        if method not in self._REMOTE_METHODS:
+            raise ValueError("Unknown method %s" % repr(method))
+        result = self._local_call(method, _decode_args(method, args), datetime.datetime.now())
+        if method == "put_many":
+            result = [{"error": str(r)} if isinstance(r, ValueError) else r for r in result]
+        return _encode_result(method, result)
+
+    def _local_call(self, method, args, now):
+        if method == "put":
+            record_id, idepo, data = args
+            record_version = self.local.put(record_id, idepo, data, now)
+            self.bus.notify(record_id, record_version, data)
+            return record_version
+        elif method == "put_many":
+            puts, = args
+            results = self.local.put_many(puts, now)
+            for (record_id, _, data), record_version in zip(puts, results):
+                if not isinstance(record_version, ValueError):
+                    self.bus.notify(record_id, record_version, data)
+            return results
+        elif method == "get_or_touch":
+            record_id, record_version = args
+            data = self.local.get(record_id, record_version, now)
+            if data is None:
+                self.local.touch(record_id, record_version - 1, now)
+            return data
+        else:
+            return getattr(self.local, method)(*(list(args) + [now]))
+
+
+class ShardBus(object):
+    """
+    Message bus between the processes of a multi-process server.
+
+    Every process listens on a unix socket and connects to the socket of
+    every other process. A connection is used by the connecting process
+    to send calls, and by the accepting process to send the replies and
+    all put notifications. Since both travel on the same stream, a process
+    always sees a reply before the notifications of puts made after the call
+    was handled.
+
+    Messages are JSON objects, prefixed by their length. The values in calls
+    and replies are encoded by :class:`ShardedRecordDatabase`, those of
+    notifications by the bus, see :func:`_encode_data`.
+    """
+
+    #: Seconds to wait between attempts to connect to another process.
+    RECONNECT_DELAY = 0.1
+
+    def __init__(self, socket_dir, index, count, call_handler, notify_handler):
+        """
+        :param call_handler: Invoked as `call_handler(method, args)` for
+          calls from other processes. Returns the result.
+
+        :param notify_handler: Invoked as `notify_handler(record_id, record_version, data)`
+          for puts made in other processes.
+        """
+        self.socket_dir = socket_dir
+        self.index = index
+        self.count = count
+        self._call_handler = call_handler
+        self._notify_handler = notify_handler
+
+        #: dict that maps the index of a process to our connection to it.
+        self._outgoing = {}
+
+        #: connections made to us by the other processes.
+        self._incoming = set()
+
+        #: dict that maps call ids to `(index, future)`.
+        self._pending = {}
+        self._next_call_id = 0
+
+    @tornado.gen.coroutine
+    def start(self):
+        path = self._socket_path(self.index)
+        if os.path.exists(path):
+            os.remove(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        sock.bind(path)
+        sock.listen(128)
+        tornado.netutil.add_accept_handler(sock, self._accept)
+
+        yield [self._connect(i) for i in range(self.count) if i != self.index]
+
+    def call(self, index, method, args):
+        """
+        Calls `method` in the process with the given index.
+        Returns a future with the result.
+        """
+        future = tornado.concurrent.Future()
+        stream = self._outgoing.get(index, None)
+        if stream is None:
+            future.set_exception(ShardUnavailableError("Shard %s is not connected." % index))
+            return future
+
+        call_id = self._next_call_id
+        self._next_call_id += 1
+        self._pending[call_id] = (index, future)
+        try:
+            _write_message(stream, {"call": call_id, "method": method, "args": args})
+        except tornado.iostream.StreamClosedError:
+            pass # `_receive` fails the pending calls.
+        except (TypeError, ValueError) as e:
+            # not serializable, nothing was written.
+            del self._pending[call_id]
+            future.set_exception(e)
+        return future
+
+    def notify(self, record_id, record_version, data):
+        """
+        Reports a put to all other processes.
+        """
+        message = {"notify": [record_id, record_version, _encode_data(data)]}
+        for stream in list(self._incoming):
+            try:
+                _write_message(stream, message)
+            except tornado.iostream.StreamClosedError:
+                self._incoming.discard(stream)
+
+    def _socket_path(self, index):
+        return os.path.join(self.socket_dir, "shard-%s.sock" % index)
+
+    @tornado.gen.coroutine
+    def _connect(self, index):
+        while True:
+            stream = tornado.iostream.IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+            try:
+                yield stream.connect(self._socket_path(index))
+                break
+            except (tornado.iostream.StreamClosedError, socket.error):
+                stream.close()
+                yield tornado.gen.sleep(self.RECONNECT_DELAY)
+        self._outgoing[index] = stream
+        tornado.ioloop.IOLoop.current().spawn_callback(self._receive, index, stream)
+
+    def _accept(self, connection, address):
+        stream = tornado.iostream.IOStream(connection)
+        self._incoming.add(stream)
+        tornado.ioloop.IOLoop.current().spawn_callback(self._serve, stream)
+
+    @tornado.gen.coroutine
+    def _serve(self, stream):
+        """
+        Handles the calls made over a connection from another process.
+        A call that fails is answered with the error, the connection stays usable.
+        """
+        try:
+            while True:
+                try:
+                    message = yield _read_message(stream)
+                    call_id = message["call"]
+                except (ValueError, TypeError, KeyError) as e:
+                    # the message was read completely, the next one can be read.
+                    logger.error("Ignoring invalid message from another process: %s", e)
+                    continue
+                try:
+                    result = self._call_handler(message["method"], message["args"])
+                    _write_message(stream, {"reply": call_id, "result": result})
+                except tornado.iostream.StreamClosedError:
+                    raise
+                except Exception as e:
+                    _write_message(stream, {"reply": call_id, "error": str(e)})
+        except tornado.iostream.StreamClosedError:
+            self._incoming.discard(stream)
+
+    @tornado.gen.coroutine
+    def _receive(self, index, stream):
+        """
+        Handles replies and notifications on our connection to another process.
+        """
+        try:
+            while True:
+                message = yield _read_message(stream)
+                if "notify" in message:
+                    record_id, record_version, data = message["notify"]
+                    self._notify_handler(record_id, record_version, _decode_data(data))
+                else:
+                    _, future = self._pending.pop(message["reply"])
+                    if "error" in message:
+                        future.set_exception(ValueError(message["error"]))
+                    else:
+                        future.set_result(message["result"])
+        except tornado.iostream.StreamClosedError:
+            del self._outgoing[index]
+            for call_id, (call_index, future) in list(self._pending.items()):
+                if call_index == index:
+                    del self._pending[call_id]
+                    future.set_exception(ShardUnavailableError("Shard %s disconnected." % index))
+            # the process is restarted by `fork_processes`.
+            tornado.ioloop.IOLoop.current().spawn_callback(self._connect, index)
+
+
+_HEADER = struct.Struct("!I")
+
+_BYTES = "__bytes__"
+
+def _encode_data(data):
+    """
+    Returns a stored value as it can be sent in JSON. Values stored
+    in binary mode are bytes, they are sent as `{"__bytes__": <base64>}`.
+    Text and `None` are sent as they are. Only values are encoded this way,
+    ids and idepos are always text.
+    """
+    if data is None or isinstance(data, unicode_type):
+        return data
+    return {_BYTES: base64.b64encode(data).decode("ascii")}
+
+def _decode_data(obj):
+    if isinstance(obj, dict):
+        return base64.b64decode(obj[_BYTES])
+    return obj
+
+def _encode_args(method, args):
+    """
+    Encodes the values in the arguments of a call, see :func:`_encode_data`.
+    """
+    if method == "put":
+        record_id, idepo, data = args
+        return [record_id, idepo, _encode_data(data)]
+    elif method == "put_many":
+        puts, = args
+        return [[(record_id, idepo, _encode_data(data)) for record_id, idepo, data in puts]]
+    return args
+
+def _decode_args(method, args):
+    if method == "put":
+        record_id, idepo, data = args
+        return [record_id, idepo, _decode_data(data)]
+    elif method == "put_many":
+        puts, = args
+        return [[(record_id, idepo, _decode_data(data)) for record_id, idepo, data in puts]]
+    return args
+
+def _encode_result(method, result):
+    """
+    Encodes the values in the result of a call, see :func:`_encode_data`.
+    """
+    if method in ("get", "get_or_touch"):
+        return _encode_data(result)
+    elif method == "get_many":
+        return [(r[0], _encode_data(r[1])) if r is not None else None for r in result]
+    elif method == "get_range":
+        results, next_version = result
+        return [(v, _encode_data(data)) for v, data in results], next_version
+    return result
+
+def _decode_result(method, result):
+    if method in ("get", "get_or_touch"):
+        return _decode_data(result)
+    elif method == "get_many":
+        return [(r[0], _decode_data(r[1])) if r is not None else None for r in result]
+    elif method == "get_range":
+        results, next_version = result
+        return [(v, _decode_data(data)) for v, data in results], next_version
+    return result
+
+def _write_message(stream, message):
+    """
+    Raises `TypeError` or `ValueError` without writing anything if the message
+    cannot be serialized.
+    """
+    body = tornado.escape.utf8(json.dumps(message))
+    stream.write(_HEADER.pack(len(body)) + body)
+
+@tornado.gen.coroutine
+def _read_message(stream):
+    header = yield stream.read_bytes(_HEADER.size)
+    length, = _HEADER.unpack(header)
+    body = yield stream.read_bytes(length)
+    raise tornado.gen.Return(json.loads(tornado.escape.to_unicode(body)))
@@ -0,0 +1,76 @@
+import unittest
+from renatserver import admission
+
+
+class TestAdmissionControl(unittest.TestCase):
+
+    def setUp(self):
+        self.target = admission.AdmissionControl(rate=10, burst=5)
+
+    def test_unlimited(self):
+        target = admission.AdmissionControl()
+        for _ in range(1000):
+            self.assertEqual(0, target.admit("a", now=0))
+            self.assertTrue(target.enter_waiter("a"))
+
+    def test_burst(self):
+        for _ in range(5):
+            self.assertEqual(0, self.target.admit("a", now=0))
+        self.assertAlmostEqual(0.1, self.target.admit("a", now=0))
+        self.assertEqual(1, self.target.rejected_rate)
+
+    def test_refill(self):
+        for _ in range(5):
+            self.target.admit("a", now=0)
+        self.assertEqual(0, self.target.admit("a", now=0.1))
+        self.assertNotEqual(0, self.target.admit("a", now=0.1))
+        for _ in range(5):
+            self.assertEqual(0, self.target.admit("a", now=10))
+
+    def test_per_ip(self):
+        for _ in range(5):
+            self.target.admit("a", now=0)
+        self.assertEqual(0, self.target.admit("b", now=0))
+
+    def test_cost(self):
+        self.assertEqual(0, self.target.admit("a", cost=3, now=0))
+        self.assertAlmostEqual(0.1, self.target.admit("a", cost=3, now=0))
+
+    def test_cost_above_burst(self):
+        self.assertEqual(0, self.target.admit("a", cost=100, now=0))
+        self.assertAlmostEqual(0.5, self.target.admit("a", cost=100, now=0))
+
+    def test_prune(self):
+        self.target.admit("a", now=0)
+        self.target.admit("b", now=0.45)
+        self.assertEqual(1, self.target.prune(now=0.5))
+        self.assertEqual(["b"], list(self.target._buckets.keys()))
+
+    def test_prune_periodically(self):
+        self.target.admit("a", now=0)
+        self.target.admit("b", now=self.target.PRUNE_INTERVAL)
+        self.assertEqual(["b"], list(self.target._buckets.keys()))
+
+    def test_waiters_per_ip(self):
+        target = admission.AdmissionControl(max_waiters_per_ip=2)
+        self.assertTrue(target.enter_waiter("a"))
+        self.assertTrue(target.enter_waiter("a"))
+        self.assertFalse(target.enter_waiter("a"))
+        self.assertTrue(target.enter_waiter("b"))
+        target.leave_waiter("a")
+        self.assertTrue(target.enter_waiter("a"))
+        self.assertEqual(3, target.waiters)
+        self.assertEqual(1, target.rejected_waiters)
+
+    def test_waiters_total(self):
+        target = admission.AdmissionControl(max_waiters=2)
+        self.assertTrue(target.enter_waiter("a"))
+        self.assertTrue(target.enter_waiter("b"))
+        self.assertFalse(target.enter_waiter("c"))
+        target.leave_waiter("a")
+        self.assertTrue(target.enter_waiter("c"))
+        self.assertEqual({"b": 1, "c": 1}, target._waiters)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+from renatserver import arenadb, test_db
+
+
+class TestArenaDB(test_db.TestDB):
+    
+    database_class = arenadb.ArenaRecordDatabase
+    
+    def test_text(self):
+        version = self.target.put("key", "1", u"v\xe4lue", self.now)
+        actual = self.target.get("key", version, self.now)
+        self.assertEqual(u"v\xe4lue", actual)
+        self.assertEqual(type(u""), type(actual))
+        
+    def test_bytes(self):
+        version = self.target.put("key", "1", b"\x00\xff", self.now)
+        self.assertEqual(b"\x00\xff", self.target.get("key", version, self.now))
+        
+    def test_many_versions(self):
+        for i in range(100):
+            self.target.put("key", str(i), "value%s" % i, self.now)
+        self.target.touch("key", 50, self.later)
+        self.target.evict(self.muchlater)
+        version = self.target.put("key", "x", "a" * 1000, self.muchlater)
+        self.assertEqual(51, version)
+        self.assertEqual("value49", self.target.get("key", 50, self.muchlater))
+        self.assertEqual("a" * 1000, self.target.get("key", 51, self.muchlater))
+        self.assertEqual(None, self.target.get("key", 49, self.muchlater))
+        self.assertEqual(50, self.target.oldest_version("key", self.muchlater))
+        
+    def test_reuse_slots(self):
+        self.target = arenadb.ArenaRecordDatabase(max_records=3)
+        for i in range(10):
+            self.target.put("key%s" % i, "1", "value%s" % i, self.now)
+        self.assertEqual(3, len(self.target))
+        self.assertEqual(4, len(self.target._record_id))
+        self.assertEqual("value9", self.target.get("key9", 1, self.now))
+        self.assertEqual(None, self.target.get("key6", 1, self.now))
+        
+    def test_max_bytes_size_classes(self):
+        self.target = arenadb.ArenaRecordDatabase(max_bytes=3000)
+        sizes = [10, 100, 500, 1000] * 5
+        for i, size in enumerate(sizes):
+            self.target.put("key%s" % i, "1", "x" * size, self.now)
+            self.assertTrue(self.target.stored_bytes <= 3000)
+        arenas = set(self.target._arena[slot] for slot in self.target._idepo.values())
+        self.assertEqual(4, len(arenas))
+        for i, size in enumerate(sizes):
+            actual = self.target.get("key%s" % i, 1, self.now)
+            self.assertTrue(actual is None or actual == "x" * size)
+        self.assertEqual("x" * 1000, self.target.get("key19", 1, self.now))
+        self.assertEqual(None, self.target.get("key0", 1, self.now))
+        self.assertTrue(self.target.evicted_pressure > 0)
+        
+    def test_max_bytes_reuse_blocks(self):
+        self.target = arenadb.ArenaRecordDatabase(max_bytes=1000)
+        for i in range(50):
+            self.target.put("key%s" % i, "1", "%s" % i * (20 + 20 * (i % 4)), self.now)
+        allocated = [arena.allocated for arena in self.target._arenas]
+        for i in range(50, 100):
+            self.target.put("key%s" % i, "1", "%s" % i * (20 + 20 * (i % 4)), self.now)
+        self.assertEqual(allocated, [arena.allocated for arena in self.target._arenas])
+        self.assertEqual("99" * 80, self.target.get("key99", 1, self.now))
+        self.assertEqual(self.target.stored_bytes,
+                         sum(len(k) - 1 + self.target._length[s] for k, s in self.target._idepo.items()))
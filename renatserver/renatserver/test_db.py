@@ -9,9 +9,11 @@ from renatserver import db
 
 
 class TestDB(unittest.TestCase):
+    
+    database_class = db.InMemoryRecordDatabase
 
     def setUp(self):
-        self.target = db.InMemoryRecordDatabase()
+        self.target = self.database_class()
         self.now = datetime.datetime.now() # not evicted at `later`. Evicted at `muchlater`
         self.later = self.now + datetime.timedelta(seconds=150)   # not evicted at `later`.not evicted at `muchlater`
         self.muchlater = self.now + datetime.timedelta(seconds=310)
@@ -43,6 +45,97 @@ class TestDB(unittest.TestCase):
         actual = self.target.oldest_version("key", self.now)
         self.assertEqual(version1, actual)
         
+    def test_next(self):
+        self.target.put("key", "1", "value1", self.now)
+        self.target.put("key", "2", "value2", self.now)
+        self.assertEqual(1, self.target.next_version("key", 0, self.now))
+        self.assertEqual(2, self.target.next_version("key", 1, self.now))
+        self.assertEqual(None, self.target.next_version("key", 2, self.now))
+        self.assertEqual(None, self.target.next_version("other", 0, self.now))
+        
+    def test_next_evicted_before(self):
+        self.target.put("key", "1", "value1", self.now)
+        self.target.put("key", "2", "value2", self.now)
+        self.target.put("key", "3", "value3", self.later)
+        self.assertEqual(3, self.target.next_version("key", 0, self.muchlater))
+        
+    def test_next_evicted_between(self):
+        for i in range(5):
+            self.target.put("key", str(i), "value%s" % i, self.now)
+        self.target.touch("key", 1, self.later)
+        self.target.touch("key", 4, self.later)
+        self.assertEqual(4, self.target.next_version("key", 1, self.muchlater))
+        
+    def test_next_touches(self):
+        self.target.put("key", "1", "value1", self.now)
+        self.target.next_version("key", 0, self.later)
+        self.assertEqual("value1", self.target.get("key", 1, self.muchlater))
+        
+    def test_info(self):
+        for i in range(3):
+            self.target.put("key", str(i), "value%s" % i, self.now)
+        self.assertEqual((1, 3, 3), self.target.info("key", self.now))
+        self.assertEqual(None, self.target.info("other", self.now))
+        
+    def test_info_evicted(self):
+        for i in range(3):
+            self.target.put("key", str(i), "value%s" % i, self.now)
+        self.target.touch("key", 2, self.later)
+        self.target.touch("key", 3, self.later)
+        self.assertEqual((2, 3, 2), self.target.info("key", self.muchlater))
+        
+    def test_info_does_not_touch(self):
+        self.target.put("key", "1", "value1", self.now)
+        self.target.info("key", self.later)
+        self.assertEqual(None, self.target.info("key", self.muchlater))
+        
+    def test_contains(self):
+        self.target.put("key", "1", "value1", self.now)
+        self.assertTrue(self.target.contains("key", 1, self.now))
+        self.assertFalse(self.target.contains("key", 2, self.now))
+        self.assertFalse(self.target.contains("other", 1, self.now))
+        
+    def test_contains_does_not_touch(self):
+        self.target.put("key", "1", "value1", self.now)
+        self.assertTrue(self.target.contains("key", 1, self.later))
+        self.assertFalse(self.target.contains("key", 1, self.muchlater))
+        
+    def test_range(self):
+        for i in range(5):
+            self.target.put("key", str(i), "value%s" % i, self.now)
+        actual = self.target.get_range("key", 2, 4, self.now, 10, 1000)
+        self.assertEqual(([(2, "value1"), (3, "value2"), (4, "value3")], None), actual)
+        
+    def test_range_empty(self):
+        self.assertEqual(([], None), self.target.get_range("key", 1, 10, self.now, 10, 1000))
+        
+    def test_range_max_count(self):
+        for i in range(5):
+            self.target.put("key", str(i), "value%s" % i, self.now)
+        actual = self.target.get_range("key", 1, 10, self.now, 2, 1000)
+        self.assertEqual(([(1, "value0"), (2, "value1")], 3), actual)
+        
+    def test_range_max_bytes(self):
+        for i in range(5):
+            self.target.put("key", str(i), "value%s" % i, self.now)
+        actual = self.target.get_range("key", 1, 10, self.now, 10, 13)
+        self.assertEqual(([(1, "value0"), (2, "value1")], 3), actual)
+        actual = self.target.get_range("key", 1, 10, self.now, 10, 1)
+        self.assertEqual(([(1, "value0")], 2), actual)
+        
+    def test_range_evicted(self):
+        for i in range(5):
+            self.target.put("key", str(i), "value%s" % i, self.now)
+        self.target.touch("key", 2, self.later)
+        self.target.touch("key", 4, self.later)
+        actual = self.target.get_range("key", 1, 5, self.muchlater, 10, 1000)
+        self.assertEqual(([(2, "value1"), (4, "value3")], None), actual)
+        
+    def test_range_touches(self):
+        self.target.put("key", "1", "value1", self.now)
+        self.target.get_range("key", 1, 1, self.later, 10, 1000)
+        self.assertEqual("value1", self.target.get("key", 1, self.muchlater))
+        
     def test_noevict(self):
         version = self.target.put("key", "1", "value", self.now)
         actual = self.target.get("key", version, self.later)
@@ -65,3 +158,107 @@ class TestDB(unittest.TestCase):
         actual = self.target.oldest_version("key", self.muchlater)
         self.assertEqual(version2, actual)
         
+    def test_evict_count(self):
+        self.target.put("key", "1", "value1", self.now)
+        self.target.put("key", "2", "value2", self.now)
+        self.target.put("key", "3", "value3", self.later)
+        self.assertEqual(2, self.target.evict(self.muchlater))
+        self.assertEqual(1, len(self.target))
+        
+    def test_evict_max_count(self):
+        self.target.put("key", "1", "value1", self.now)
+        self.target.put("key", "2", "value2", self.now)
+        self.target.put("key", "3", "value3", self.now)
+        self.assertEqual(2, self.target.evict(self.muchlater, max_count=2))
+        self.assertEqual(1, self.target.evict(self.muchlater, max_count=2))
+        self.assertEqual(0, len(self.target))
+        
+    def test_evict_lazy(self):
+        version = self.target.put("key", "1", "value", self.now)
+        self.target.get("key", version, self.muchlater)
+        self.assertEqual(0, len(self.target))
+        self.assertEqual(None, self.target.jungest_version("key", self.muchlater))
+        
+    def test_idepo_evicted(self):
+        self.target.put("key", "1", "value1", self.now)
+        self.target.put("key", "2", "value2", self.later)
+        version = self.target.put("key", "1", "value3", self.muchlater)
+        self.assertEqual(3, version)
+        self.assertEqual("value3", self.target.get("key", version, self.muchlater))
+        
+    def test_max_records(self):
+        self.target = self.database_class(max_records=2)
+        self.target.put("key1", "1", "value1", self.now)
+        self.target.put("key2", "2", "value2", self.now)
+        self.target.get("key1", 1, self.now)
+        self.target.put("key3", "3", "value3", self.now)
+        self.assertEqual("value1", self.target.get("key1", 1, self.now))
+        self.assertEqual(None, self.target.get("key2", 1, self.now))
+        self.assertEqual(1, self.target.evicted_pressure)
+        
+    def test_max_bytes(self):
+        self.target = self.database_class(max_bytes=30)
+        self.target.put("key1", "1", "value1", self.now)
+        self.target.put("key2", "2", "value2", self.now)
+        self.assertEqual(22, self.target.stored_bytes)
+        self.target.put("key3", "3", "value3", self.now)
+        self.assertEqual(22, self.target.stored_bytes)
+        self.assertEqual(None, self.target.get("key1", 1, self.now))
+        self.assertEqual("value3", self.target.get("key3", 1, self.now))
+        self.assertEqual(1, self.target.evicted_pressure)
+        self.assertEqual(0, self.target.evicted_expired)
+        
+    def test_max_bytes_too_large(self):
+        self.target = self.database_class(max_bytes=10)
+        self.assertRaises(ValueError, self.target.put, "key1", "1", "value1", self.now)
+        
+    def test_pressure_keeps_version(self):
+        self.target = self.database_class(max_records=1)
+        self.target.put("key", "1", "value1", self.now)
+        version = self.target.put("key", "2", "value2", self.now)
+        self.assertEqual(2, version)
+        
+    def test_evicted_expired(self):
+        self.target.put("key", "1", "value1", self.now)
+        self.target.put("key", "2", "value2", self.now)
+        self.target.get("key", 1, self.muchlater)
+        self.target.evict(self.muchlater)
+        self.assertEqual(2, self.target.evicted_expired)
+        self.assertEqual(0, self.target.stored_bytes)
+        
+        
+    def test_put_version(self):
+        self.target.put_version("key", 5, "1", "value5", self.now)
+        self.assertEqual("value5", self.target.get("key", 5, self.now))
+        self.assertEqual(6, self.target.put("key", "2", "value6", self.now))
+        
+    def test_put_version_idepo(self):
+        self.target.put_version("key", 5, "1", "value5", self.now)
+        self.assertEqual(5, self.target.put("key", "1", "value5", self.now))
+        
+    def test_put_version_idepo_reused(self):
+        self.target.put_version("key", 5, "1", "value5", self.now)
+        self.target.put_version("key", 6, "1", "value6", self.now)
+        self.assertEqual(None, self.target.get("key", 5, self.now))
+        self.assertEqual((6, 6, 1), self.target.info("key", self.now))
+        
+    def test_put_version_renumbered(self):
+        self.target.put_version("key", 5, "1", "value5", self.now)
+        self.target.put_version("key", 6, "2", "value6", self.now)
+        self.target.put_version("key", 1, "3", "value1", self.now)
+        self.assertEqual((1, 1, 1), self.target.info("key", self.now))
+        self.assertEqual("value1", self.target.get("key", 1, self.now))
+        self.assertEqual(len("key3value1"), self.target.stored_bytes)
+        
+    def test_dump(self):
+        self.target.put("key1", "1", "value1", self.now)
+        self.target.put("key2", "2", "value2", self.now)
+        self.target.put("key1", "3", "value3", self.now)
+        self.assertEqual([("key1", 1, "1", "value1"), ("key1", 2, "3", "value3"), ("key2", 1, "2", "value2")],
+                         sorted(self.target.dump(self.now)))
+        
+    def test_dump_expired(self):
+        self.target.put("key", "1", "value1", self.now)
+        self.target.put("key", "2", "value2", self.now)
+        self.target.get("key", 2, self.later)
+        self.assertEqual([("key", 2, "2", "value2")], self.target.dump(self.muchlater))
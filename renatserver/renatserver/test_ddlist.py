@@ -193,4 +193,40 @@ class TestLinkedList(unittest.TestCase):
         self.assertEqual(None, self.target.get_leftmost(None))
         
     def test_rightmost_default(self):
-        self.assertEqual(None, self.target.get_rightmost(None))
\ No newline at end of file
+        self.assertEqual(None, self.target.get_rightmost(None))
+        
+    def test_contains(self):
+        item1 = Item("1")
+        item2 = Item("2")
+        self.target = ddlist.LinkedList([item1])
+        self.assertTrue(item1 in self.target)
+        self.assertFalse(item2 in self.target)
+        
+    def test_append_twice(self):
+        item1 = Item("1")
+        self.target = ddlist.LinkedList([item1])
+        self.assertRaises(ValueError, self.target.append_right, item1)
+        
+    def test_remove_absent(self):
+        item1 = Item("1")
+        self.assertRaises(ValueError, self.target.remove, item1)
+        
+    def test_two_lists(self):
+        item1 = Item("1")
+        item2 = Item("2")
+        other = ddlist.LinkedList([item2, item1])
+        self.target = ddlist.LinkedList([item1, item2])
+        other.remove(item1)
+        self.assertEqual([item1, item2], list(self.target))
+        self.assertEqual([item2], list(other))
+        
+    def test_reuse_slot(self):
+        item1 = Item("1")
+        item2 = Item("2")
+        item3 = Item("3")
+        self.target = ddlist.LinkedList([item1, item2])
+        self.target.remove(item1)
+        self.target.append_left(item3)
+        self.target.append_right(item1)
+        self.assertEqual([item3, item2, item1], list(self.target))
+        self.assertEqual([item1, item2, item3], list(reversed(self.target)))
@@ -0,0 +1,115 @@
+import unittest
+import datetime
+from renatserver import db, asyncdb, metrics, admission
+
+
+class TestHistogram(unittest.TestCase):
+
+    def setUp(self):
+        self.target = metrics.Histogram("latency", "Latency.", ("op",), buckets=(0.1, 1.0))
+
+    def test_cumulative(self):
+        self.target.observe(0.05, ("get",))
+        self.target.observe(0.1, ("get",))
+        self.target.observe(0.5, ("get",))
+        self.target.observe(5.0, ("get",))
+        samples = list(self.target.samples())
+        self.assertEqual([
+            ("latency_bucket", '{op="get",le="0.1"}', 2),
+            ("latency_bucket", '{op="get",le="1.0"}', 3),
+            ("latency_bucket", '{op="get",le="+Inf"}', 4),
+            ("latency_sum", '{op="get"}', 5.65),
+            ("latency_count", '{op="get"}', 4)], samples)
+
+    def test_labels(self):
+        self.target.observe(0.05, ("put",))
+        self.target.observe(0.05, ("get",))
+        names = [labels for name, labels, _ in self.target.samples() if name == "latency_count"]
+        self.assertEqual(['{op="get"}', '{op="put"}'], names)
+
+    def test_escape(self):
+        self.target.observe(0.05, ('a"b\\',))
+        _, labels, _ = next(self.target.samples())
+        self.assertEqual('{op="a\\"b\\\\",le="0.1"}', labels)
+
+
+class TestRegistry(unittest.TestCase):
+
+    def test_render(self):
+        target = metrics.Registry()
+        target.register(metrics.Callback("answer", "The answer.", "gauge", lambda: 42))
+        self.assertEqual("# HELP answer The answer.\n"
+                         "# TYPE answer gauge\n"
+                         "answer 42\n", target.render())
+
+
+class TestServerMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.now = datetime.datetime.now()
+        self.database = asyncdb.ASyncRecordDatabase(db.InMemoryRecordDatabase(max_records=10))
+        self.target = metrics.ServerMetrics(self.database)
+
+    def values(self):
+        values = {}
+        for line in self.target.render().splitlines():
+            if not line.startswith("#"):
+                name, value = line.rsplit(" ", 1)
+                values[name] = value
+        return values
+
+    def test_empty(self):
+        values = self.values()
+        self.assertEqual("0", values["renat_records"])
+        self.assertEqual("10", values["renat_max_records"])
+        self.assertEqual("0", values["renat_max_bytes"])
+
+    def test_puts(self):
+        self.database.put("a", "idepo1", "data", self.now)
+        self.database.put("a", "idepo1", "data", self.now)
+        self.database.put("b", "idepo2", "data", self.now)
+        values = self.values()
+        self.assertEqual("2", values["renat_records"])
+        self.assertEqual("1", values["renat_idepo_repeats"])
+
+    def test_waiters(self):
+        future = self.database.get_future("a", 1, self.now)
+        self.database.jungest_version_future("b", self.now)
+        self.database.wait_any_future({"a": -1, "b": -1}, self.now)
+        values = self.values()
+        self.assertEqual("1", values["renat_get_waiters"])
+        self.assertEqual("1", values["renat_any_waiters"])
+
+        self.database.put("a", "idepo", "data", self.now)
+        self.assertTrue(future.done())
+        values = self.values()
+        self.assertEqual("0", values["renat_get_waiters"])
+        self.assertEqual("2", values["renat_woken_waiters"])
+
+    def test_evictions(self):
+        self.database.put("a", "idepo", "data", self.now)
+        self.database.evict(self.now + self.database.eviction_time * 2)
+        values = self.values()
+        self.assertEqual("1", values["renat_evicted_expired"])
+        self.assertEqual("0", values["renat_evicted_pressure"])
+
+    def test_latency(self):
+        self.target.request_seconds.observe(0.001, ("get", "hit"))
+        values = self.values()
+        self.assertEqual("1", values['renat_request_seconds_count{op="get",outcome="hit"}'])
+
+    def test_admission(self):
+        control = admission.AdmissionControl(rate=1, max_waiters=1)
+        self.target = metrics.ServerMetrics(self.database, admission=control)
+        control.admit("a")
+        control.admit("a")
+        control.enter_waiter("a")
+        control.enter_waiter("b")
+        values = self.values()
+        self.assertEqual("1", values["renat_admitted_waiters"])
+        self.assertEqual("1", values["renat_rejected_rate"])
+        self.assertEqual("1", values["renat_rejected_waiters"])
+
+
+if __name__ == "__main__":
+    unittest.main()
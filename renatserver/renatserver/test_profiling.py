@@ -0,0 +1,86 @@
+import unittest
+import datetime
+import time
+from renatserver import db, profiling
+
+#: CPU time of the process.
+cpu_time = getattr(time, "process_time", None) or time.clock
+
+
+def busy(seconds):
+    """
+    Puts records for `seconds` of CPU time.
+    """
+    database = db.InMemoryRecordDatabase()
+    now = datetime.datetime.now()
+    end = cpu_time() + seconds
+    i = 0
+    while cpu_time() < end:
+        database.put("id%s" % (i % 100), "idepo%s" % i, "data", now)
+        i += 1
+
+
+class TestCPUProfiler(unittest.TestCase):
+
+    def test_report(self):
+        target = profiling.CPUProfiler("tottime", 10)
+        target.start()
+        busy(0.05)
+        report = target.stop()
+        self.assertIn("function calls", report)
+        self.assertIn("(put)", report)
+
+    def test_invalid_sort(self):
+        self.assertRaises(ValueError, profiling.CPUProfiler, "nonsense")
+
+
+class TestStackSampler(unittest.TestCase):
+
+    def test_collapsed(self):
+        target = profiling.StackSampler()
+        target.start()
+        busy(0.2)
+        report = target.stop()
+        lines = report.splitlines()
+        self.assertTrue(lines)
+        stack, count = lines[0].rsplit(" ", 1)
+        self.assertGreater(int(count), 0)
+        self.assertIn("test_collapsed (test_profiling.py:", stack)
+        self.assertTrue(any("busy (test_profiling.py:" in line for line in lines))
+
+
+@unittest.skipIf(profiling.tracemalloc is None, "tracemalloc is not available")
+class TestAllocationTracer(unittest.TestCase):
+
+    def test_report(self):
+        target = profiling.AllocationTracer(5)
+        target.start()
+        kept = ["x" * 1000 + str(i) for i in range(1000)]
+        report = target.stop()
+        self.assertIn("test_profiling.py", report.splitlines()[3])
+        self.assertEqual(1000, len(kept))
+
+    def test_already_tracing(self):
+        target = profiling.AllocationTracer()
+        target.start()
+        try:
+            self.assertRaises(ValueError, profiling.AllocationTracer().start)
+        finally:
+            target.stop()
+
+
+class TestObjectCounter(unittest.TestCase):
+
+    def test_report(self):
+        target = profiling.ObjectCounter(5)
+        target.start()
+        kept = ["x" * 1000 + str(i) for i in range(1000)]
+        report = target.stop()
+        lines = report.splitlines()
+        self.assertEqual(6, len(lines))
+        self.assertTrue(lines[1].endswith(".str"), lines[1])
+        self.assertEqual(1000, len(kept))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,153 @@
+import unittest
+import datetime
+import shutil
+import tempfile
+
+import tornado.gen
+import tornado.ioloop
+
+from renatserver import db, asyncdb, shard
+
+
+class TestShardedRecordDatabase(unittest.TestCase):
+    """
+    Two processes of a multi-process server, in one IOLoop.
+    """
+
+    def setUp(self):
+        self.io_loop = tornado.ioloop.IOLoop()
+        self.io_loop.make_current()
+        self.socket_dir = tempfile.mkdtemp()
+        self.now = datetime.datetime.now()
+        self.shards = [shard.ShardedRecordDatabase(asyncdb.ASyncRecordDatabase(db.InMemoryRecordDatabase()),
+                                                   index, 2, self.socket_dir) for index in range(2)]
+        self.run_sync(lambda: [s.start() for s in self.shards])
+
+        #: record ids owned by each shard.
+        self.owned = [[], []]
+        i = 0
+        while min(len(ids) for ids in self.owned) < 2:
+            record_id = u"id%s" % i
+            self.owned[shard.shard_of(record_id, 2)].append(record_id)
+            i += 1
+
+    def tearDown(self):
+        self.io_loop.clear_current()
+        self.io_loop.close(all_fds=True)
+        shutil.rmtree(self.socket_dir)
+
+    def run_sync(self, func):
+        """
+        Runs the IOLoop until what `func` returns can be yielded, returns the result.
+        """
+        @tornado.gen.coroutine
+        def call():
+            result = yield func()
+            raise tornado.gen.Return(result)
+        return self.io_loop.run_sync(call, timeout=5)
+
+    def test_shard_of(self):
+        self.assertEqual(shard.shard_of(u"abc", 7), shard.shard_of(b"abc", 7))
+        self.assertTrue(0 <= shard.shard_of(u"abc", 7) < 7)
+
+    def test_routed_to_owner(self):
+        remote = self.owned[1][0]
+        version = self.run_sync(lambda: self.shards[0].put(remote, u"idepo", u"value", self.now))
+        self.assertEqual(1, version)
+        self.assertEqual(u"value", self.shards[1].local.get(remote, 1, self.now))
+        self.assertEqual(None, self.shards[0].local.get(remote, 1, self.now))
+        self.assertEqual(u"value", self.run_sync(lambda: self.shards[0].get(remote, 1, self.now)))
+
+    def test_local(self):
+        local = self.owned[0][0]
+        self.run_sync(lambda: self.shards[0].put(local, u"idepo", u"value", self.now))
+        self.assertEqual(u"value", self.shards[0].local.get(local, 1, self.now))
+        self.assertEqual(u"value", self.run_sync(lambda: self.shards[1].get(local, 1, self.now)))
+
+    def test_many(self):
+        puts = [(self.owned[0][0], u"a", u"x"), (self.owned[1][0], u"b", u"y"), (self.owned[1][0], u"c", u"z" * 2000)]
+        results = self.run_sync(lambda: self.shards[0].put_many(puts, self.now))
+        self.assertEqual([1, 1], results[:2])
+        self.assertIsInstance(results[2], ValueError)
+        gets = [(self.owned[1][0], 1), (self.owned[0][0], 1), (self.owned[1][1], 1)]
+        results = self.run_sync(lambda: self.shards[1].get_many(gets, self.now))
+        self.assertEqual([(1, u"y"), (1, u"x"), None], results)
+
+    def test_binary_values(self):
+        remote = self.owned[1][0]
+        data = b"\x00\xffbinary"
+        self.run_sync(lambda: self.shards[0].put(remote, u"a", data, self.now))
+        self.run_sync(lambda: self.shards[0].put_many([(remote, u"b", u"text")], self.now))
+        self.assertEqual(data, self.shards[1].local.get(remote, 1, self.now))
+        self.assertIsInstance(self.run_sync(lambda: self.shards[0].get(remote, 1, self.now)), bytes)
+        self.assertEqual(data, self.run_sync(lambda: self.shards[0].get(remote, 1, self.now)))
+        self.assertEqual(u"text", self.run_sync(lambda: self.shards[0].get(remote, 2, self.now)))
+        self.assertEqual([(1, data), (2, u"text")],
+                         self.run_sync(lambda: self.shards[0].get_many([(remote, 1), (remote, 2)], self.now)))
+        self.assertEqual(([(1, data), (2, u"text")], None),
+                         self.run_sync(lambda: self.shards[0].get_range(remote, 1, 2, 10, 10000, self.now)))
+
+    def test_only_binary_values_tagged(self):
+        messages = []
+        write_message = shard._write_message
+        def record(stream, message):
+            messages.append(message)
+            write_message(stream, message)
+        shard._write_message = record
+        try:
+            remote = self.owned[1][0]
+            self.run_sync(lambda: self.shards[0].put(remote, u"idepo", u"value", self.now))
+            self.run_sync(lambda: self.shards[0].get(remote, 1, self.now))
+            self.assertNotIn(shard._BYTES, repr(messages))
+            self.run_sync(lambda: self.shards[0].put(remote, u"idepo", b"\x00", self.now))
+            calls = [m for m in messages if m.get("method") == "put"]
+            self.assertEqual({shard._BYTES: u"AA=="}, calls[-1]["args"][2])
+        finally:
+            shard._write_message = write_message
+
+    def test_wake_waiter_in_other_process(self):
+        remote = self.owned[1][0]
+        future = self.shards[0].get_future(remote, 1, self.now)
+        self.run_sync(lambda: tornado.gen.moment)
+        self.assertFalse(future.done())
+        self.run_sync(lambda: self.shards[1].put(remote, u"idepo", u"value", self.now))
+        self.run_sync(lambda: future)
+        self.assertEqual(u"value", future.result())
+
+    def test_wait_any_across_shards(self):
+        versions = {self.owned[0][0]: 0, self.owned[1][0]: 0}
+        future = self.shards[0].wait_any_future(versions, self.now)
+        self.run_sync(lambda: self.shards[1].put(self.owned[1][0], u"idepo", u"value", self.now))
+        self.assertEqual({self.owned[1][0]: 1}, self.run_sync(lambda: future))
+
+    def test_error_reply(self):
+        remote = self.owned[1][0]
+        self.assertRaises(ValueError, self.run_sync, lambda: self.shards[0].put(remote, u"idepo", u"x" * 2000, self.now))
+        self.assertRaises(ValueError, self.run_sync, lambda: self.shards[0].bus.call(1, "nonsense", []))
+        self.assertRaises(ValueError, self.run_sync, lambda: self.shards[0].bus.call(1, "get", [remote, 1, 2, 3]))
+        self.assertEqual(1, self.run_sync(lambda: self.shards[0].put(remote, u"idepo", u"value", self.now)))
+
+    def test_invalid_message(self):
+        stream = self.shards[0].bus._outgoing[1]
+        body = b"not json"
+        stream.write(shard._HEADER.pack(len(body)) + body)
+        remote = self.owned[1][0]
+        self.assertEqual(1, self.run_sync(lambda: self.shards[0].put(remote, u"idepo", u"value", self.now)))
+
+    def test_reconnect(self):
+        remote = self.owned[1][0]
+        future = self.shards[0].bus.call(1, "get", [remote, 1, None])
+        for stream in list(self.shards[1].bus._incoming):
+            stream.close()
+        self.assertRaises(shard.ShardUnavailableError, self.run_sync, lambda: future)
+
+        @tornado.gen.coroutine
+        def reconnected():
+            while 1 not in self.shards[0].bus._outgoing:
+                yield tornado.gen.sleep(0.01)
+        self.run_sync(reconnected)
+        self.assertEqual(1, self.run_sync(lambda: self.shards[0].put(remote, u"idepo", u"value", self.now)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+import gc
+import weakref
+
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+from renatserver import timeouts
+
+
+def run_loop(test):
+    """
+    Runs the coroutine test method on a fresh IOLoop.
+    """
+    def wrapper(self):
+        self.io_loop = tornado.ioloop.IOLoop()
+        self.io_loop.make_current()
+        try:
+            self.io_loop.run_sync(lambda: tornado.gen.coroutine(test)(self), timeout=5)
+        finally:
+            self.io_loop.clear_current()
+            self.io_loop.close(all_fds=True)
+    return wrapper
+
+
+class TestTimeoutWheel(unittest.TestCase):
+
+    def setUp(self):
+        self.target = timeouts.TimeoutWheel(resolution=0.05)
+
+    @run_loop
+    def test_result(self):
+        future = tornado.concurrent.Future()
+        result = self.target.with_timeout(1, future)
+        future.set_result("value")
+        actual = yield result
+        self.assertEqual("value", actual)
+
+    @run_loop
+    def test_done(self):
+        future = tornado.concurrent.Future()
+        future.set_result("value")
+        actual = yield self.target.with_timeout(1, future)
+        self.assertEqual("value", actual)
+        self.assertEqual(0, len(self.target))
+
+    @run_loop
+    def test_timeout(self):
+        start = self.io_loop.time()
+        result = self.target.with_timeout(0.1, tornado.concurrent.Future())
+        with self.assertRaises(tornado.gen.TimeoutError):
+            yield result
+        self.assertGreaterEqual(self.io_loop.time() - start, 0.1)
+        self.assertEqual(0, len(self.target))
+
+    @run_loop
+    def test_shared_slot(self):
+        results = [self.target.with_timeout(0.1, tornado.concurrent.Future()) for _ in range(100)]
+        self.assertEqual(100, len(self.target))
+        self.assertLessEqual(len(self.target._slots), 2)
+        for result in results:
+            with self.assertRaises(tornado.gen.TimeoutError):
+                yield result
+
+    @run_loop
+    def test_removed_when_done(self):
+        future = tornado.concurrent.Future()
+        self.target.with_timeout(10, future)
+        future.set_result("value")
+        yield tornado.gen.moment
+        self.assertEqual(0, len(self.target))
+
+    @run_loop
+    def test_keeps_future_alive(self):
+        future = tornado.concurrent.Future()
+        reference = weakref.ref(future)
+        result = self.target.with_timeout(10, future)
+        del future
+        gc.collect()
+        reference().set_result("value")
+        actual = yield result
+        self.assertEqual("value", actual)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+import unittest
+import datetime
+import os
+import shutil
+import tempfile
+from renatserver import db, wal
+
+
+class TestWriteLog(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.now = datetime.datetime.now()
+        self.later = self.now + datetime.timedelta(seconds=150)
+        self.muchlater = self.now + datetime.timedelta(seconds=310)
+        self.target = self.create()
+
+    def tearDown(self):
+        self.target.log.close()
+        shutil.rmtree(self.directory)
+
+    def create(self):
+        return db.InMemoryRecordDatabase(log=wal.WriteLog(self.directory))
+
+    def restart(self, now):
+        self.target.log.close()
+        self.target = self.create()
+        return self.target.replay(now)
+
+    def test_replay(self):
+        self.target.put("key", "1", u"v\xe4lue", self.now)
+        self.target.put("key", "2", b"\x00\xff", self.now)
+        self.assertEqual(2, self.restart(self.now))
+        self.assertEqual(u"v\xe4lue", self.target.get("key", 1, self.now))
+        self.assertEqual(b"\x00\xff", self.target.get("key", 2, self.now))
+        self.assertEqual(3, self.target.put("key", "3", "value", self.now))
+
+    def test_replay_idepo(self):
+        self.target.put("key", "1", "value", self.now)
+        self.restart(self.now)
+        self.assertEqual(1, self.target.put("key", "1", "value", self.now))
+
+    def test_uncommitted(self):
+        self.target.put("key", "1", "value", self.now)
+        self.target.log.commit()
+        self.target.put("key", "2", "value", self.now)
+        self.target.log._buffer = []
+        self.assertEqual(1, self.restart(self.now))
+
+    def test_skip_expired(self):
+        self.target.put("key", "1", "value", self.now)
+        self.assertEqual(0, self.restart(self.muchlater))
+        self.assertEqual(None, self.target.get("key", 1, self.muchlater))
+
+    def test_touch(self):
+        self.target.put("key", "1", "value", self.now)
+        self.target.put("key", "2", "value", self.now)
+        self.target.touch("key", 1, self.later)
+        self.assertEqual(1, self.restart(self.muchlater))
+        self.assertEqual("value", self.target.get("key", 1, self.muchlater))
+
+    def test_touch_coalesced(self):
+        self.target.put("key", "1", "value", self.now)
+        for i in range(100):
+            self.target.touch("key", 1, self.now + datetime.timedelta(milliseconds=i))
+        self.assertEqual(1, len(self.target.log._buffer))
+
+    def test_reput_after_expiry(self):
+        self.target.put("key", "1", "value", self.now)
+        self.target.put("key", "2", "value", self.now)
+        self.target.touch("key", 2, self.later)
+        self.assertEqual(3, self.target.put("key", "1", "new", self.muchlater))
+        self.restart(self.muchlater)
+        self.assertEqual("new", self.target.get("key", 3, self.muchlater))
+        self.assertEqual(3, self.target.put("key", "1", "new", self.muchlater))
+
+    def test_compact(self):
+        for i in range(100):
+            self.target.put("key%s" % i, "1", "value", self.now)
+        self.target.touch("key0", 1, self.later)
+        self.target.evict(self.muchlater)
+        for _ in self.target.log.compact(self.target.snapshot(), chunk_size=7):
+            pass
+        self.target.put("key0", "2", "value", self.muchlater)
+        self.assertEqual(["0000000000000001.snap"], os.listdir(self.directory))
+        self.assertEqual(2, self.restart(self.muchlater))
+        self.assertEqual("value", self.target.get("key0", 1, self.muchlater))
+        self.assertEqual("value", self.target.get("key0", 2, self.muchlater))
+
+    def test_compact_versions(self):
+        self.target.put("key", "1", "v1", self.now)
+        self.target.put("key", "2", "v2", self.now)
+        self.target.put("other", "1", "value", self.now)
+        self.target.get("key", 1, self.now)
+        order = [(r.record_id, r.record_version) for r in self.target.snapshot()]
+        for _ in self.target.log.compact(self.target.snapshot(), chunk_size=2):
+            pass
+        self.assertEqual(3, self.restart(self.now))
+        self.assertEqual(order, [(r.record_id, r.record_version) for r in self.target.snapshot()])
+        self.assertEqual(1, self.target.oldest_version("key", self.now))
+        self.assertEqual(2, self.target.jungest_version("key", self.now))
+        self.assertEqual(3, self.target.put("key", "3", "v3", self.now))
+        self.assertEqual("v2", self.target.get("key", 2, self.now))
+
+    def test_compact_restart(self):
+        self.target.put("a", "1", "value", self.now)
+        for _ in self.target.log.compact(self.target.snapshot()):
+            pass
+        self.restart(self.now)
+        self.target.put("b", "1", "value", self.now)
+        self.target.log.commit()
+        self.assertEqual(2, self.restart(self.now))
+        self.assertEqual("value", self.target.get("b", 1, self.now))
+        for _ in self.target.log.compact(self.target.snapshot()):
+            pass
+        self.assertEqual(2, self.restart(self.now))
+        self.assertEqual("value", self.target.get("b", 1, self.now))
+
+    def test_segments(self):
+        for i in range(10):
+            self.target.put("key%s" % i, "1", "value", self.now)
+            self.target.log.commit()
+        self.target.log.segment_size = 100
+        for i in range(10, 20):
+            self.target.put("key%s" % i, "1", "value", self.now)
+            self.target.log.commit()
+        self.assertEqual(20, self.restart(self.now))
+        self.assertTrue(len(os.listdir(self.directory)) > 2)
+
+    def test_corrupted_tail(self):
+        self.target.put("key", "1", "value", self.now)
+        self.target.put("key", "2", "value", self.now)
+        self.target.log.close()
+        path = os.path.join(self.directory, os.listdir(self.directory)[0])
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) - 1)
+        self.assertEqual(1, self.restart(self.now))
+        self.assertEqual(None, self.target.get("key", 2, self.now))
+
+
+if __name__ == "__main__":
+    unittest.main()
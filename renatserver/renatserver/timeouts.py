@@ -0,0 +1,73 @@
+# Copyright (C) 2014 Stefan C. Mueller
+
+import math
+
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+
+
+class TimeoutWheel(object):
+    """
+    Replacement for `tornado.gen.with_timeout` for many long-polls.
+
+    Deadlines are rounded up to a multiple of `resolution`, and all
+    futures with the same deadline share a single IOLoop timer. With
+    timeouts of up to a minute there are never more than a few hundred
+    timers, regardless of the number of waiting requests.
+    """
+
+    def __init__(self, resolution=0.5):
+        """
+        :param resolution: Seconds between two deadlines. A timeout expires
+          up to this much later than requested.
+        """
+        self.resolution = resolution
+
+        #: dict that maps the deadline (as a multiple of `resolution`)
+        #: to the set of `(result, future)` pairs that fail on it.
+        #: Also keeps `future` alive, the futures of :class:`ASyncRecordDatabase`
+        #: are only weakly referenced by the database.
+        self._slots = {}
+
+    def with_timeout(self, timeout, future):
+        """
+        Returns a future with the result of `future`, or that fails with
+        `tornado.gen.TimeoutError` if `future` is not done within
+        `timeout` seconds.
+        """
+        result = tornado.concurrent.Future()
+        if future.done():
+            tornado.concurrent.chain_future(future, result)
+            return result
+
+        io_loop = tornado.ioloop.IOLoop.current()
+        slot = int(math.ceil((io_loop.time() + timeout) / self.resolution))
+        waiters = self._slots.get(slot, None)
+        if waiters is None:
+            waiters = set()
+            self._slots[slot] = waiters
+            io_loop.call_at(slot * self.resolution, self._expire, slot)
+        waiter = (result, future)
+        waiters.add(waiter)
+
+        def done(future):
+            waiters.discard(waiter)
+            if not result.done():
+                if future.exception() is not None:
+                    result.set_exception(future.exception())
+                else:
+                    result.set_result(future.result())
+        future.add_done_callback(done)
+        return result
+
+    def __len__(self):
+        """
+        Number of futures waiting for their deadline.
+        """
+        return sum(len(waiters) for waiters in self._slots.values())
+
+    def _expire(self, slot):
+        for result, _ in self._slots.pop(slot, ()):
+            if not result.done():
+                result.set_exception(tornado.gen.TimeoutError("Timeout"))
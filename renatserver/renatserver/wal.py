@@ -0,0 +1,262 @@
+# Copyright (C) 2014 Stefan C. Mueller
+
+import datetime
+import logging
+import mmap
+import os
+import re
+import struct
+import zlib
+
+logger = logging.getLogger(__name__)
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+#: Entry types.
+PUT = 1
+TOUCH = 2
+
+#: Flags of an entry.
+_TEXT = 1
+
+#: crc32, type, flags, version, time, id length, idepo length, data length.
+#: The crc covers everything after it, including the variable length fields.
+_HEADER = struct.Struct("<IBBqdHHI")
+
+_SEGMENT = re.compile(r"^(\d{16})\.log$")
+_SNAPSHOT = re.compile(r"^(\d{16})\.snap$")
+
+
+class LogEntry(object):
+    """
+    A put or touch read from the log.
+    For touches, `idepo` and `data` are `None`.
+    """
+
+    __slots__ = ("type", "record_id", "record_version", "idepo", "time", "data")
+
+    def __init__(self, type, record_id, record_version, idepo, time, data):
+        self.type = type
+        self.record_id = record_id
+        self.record_version = record_version
+        self.idepo = idepo
+        self.time = time
+        self.data = data
+
+
+class WriteLog(object):
+    """
+    Append-only log of the puts and touches of a record store, used to
+    rebuild the store after a restart.
+
+    The log is a sequence of segment files. Appended entries are buffered
+    and written with a single `fsync` per :meth:`commit` (group commit).
+    :meth:`compact` writes a snapshot of the live records and deletes
+    the segments it replaces, which keeps the replay time bounded.
+    """
+
+    def __init__(self, directory, segment_size=64*1024*1024):
+        """
+        :param directory: Directory for the log files. Created if it does not exist.
+
+        :param segment_size: A new segment file is started once the current
+          one is larger than this.
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        #: entries appended since the last commit.
+        self._buffer = []
+
+        #: number of bytes written to the current segment.
+        self._segment_bytes = 0
+
+        # after all existing files, so that new segments are never older than the newest snapshot.
+        sequences = self._sequences(_SEGMENT) + self._sequences(_SNAPSHOT)
+        self._sequence = max(sequences) + 1 if sequences else 0
+        self._file = None
+
+    def append_put(self, record_id, record_version, idepo, time, data):
+        self._buffer.append(_encode(PUT, record_id, record_version, idepo, time, data))
+
+    def append_touch(self, record_id, record_version, time):
+        self._buffer.append(_encode(TOUCH, record_id, record_version, u"", time, u""))
+
+    def commit(self):
+        """
+        Writes the appended entries to disk and waits until they are durable.
+        """
+        if not self._buffer:
+            return
+        if self._file is None:
+            self._open_segment()
+        data = b"".join(self._buffer)
+        self._buffer = []
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._segment_bytes += len(data)
+        if self._segment_bytes >= self.segment_size:
+            self._close_segment()
+
+    def replay(self):
+        """
+        Returns an iterator over the :class:`LogEntry` of the newest snapshot
+        followed by all segments written after it, in order.
+
+        Stops reading a file at the first incomplete or corrupted entry,
+        which is what a crash in the middle of a commit leaves behind.
+        """
+        snapshots = self._sequences(_SNAPSHOT)
+        start = snapshots[-1] if snapshots else 0
+        if snapshots:
+            for entry in self._read(self._path(start, "snap")):
+                yield entry
+        for sequence in self._sequences(_SEGMENT):
+            if sequence >= start:
+                for entry in self._read(self._path(sequence, "log")):
+                    yield entry
+
+    def compact(self, records, chunk_size=10000):
+        """
+        Replaces the log by a snapshot of the given records.
+
+        The snapshot has a put for each record version, the versions of a record
+        in increasing order, followed by a touch for each version in the given
+        order. The puts restore the version lists, and the touches the access order.
+
+        Generator that processes `chunk_size` records per step, so that the
+        caller can do other work in between. The current segment is closed
+        first; entries appended while the snapshot is written go to the next
+        segment, which is kept. The old segments are deleted once the
+        snapshot is complete.
+
+        :param records: List of objects with the attributes `record_id`,
+          `record_version`, `idepo_nr`, `time` and `data`, in the order they
+          should be restored (least recently accessed first).
+        """
+        self.commit()
+        self._close_segment()
+        sequence = self._sequence
+
+        versions = {}
+        for start in range(0, len(records), chunk_size):
+            for r in records[start:start + chunk_size]:
+                versions.setdefault(r.record_id, []).append(r)
+            yield
+        
+        path = self._path(sequence, "snap")
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            chunk = []
+            for record_versions in versions.values():
+                record_versions.sort(key=lambda r: r.record_version)
+                chunk.extend(_encode(PUT, r.record_id, r.record_version, r.idepo_nr, r.time, r.data)
+                             for r in record_versions)
+                if len(chunk) >= chunk_size:
+                    f.write(b"".join(chunk))
+                    chunk = []
+                    yield
+            f.write(b"".join(chunk))
+            for start in range(0, len(records), chunk_size):
+                f.write(b"".join(_encode(TOUCH, r.record_id, r.record_version, u"", r.time, u"")
+                                 for r in records[start:start + chunk_size]))
+                yield
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+
+        for old in self._sequences(_SNAPSHOT):
+            if old < sequence:
+                os.remove(self._path(old, "snap"))
+        for old in self._sequences(_SEGMENT):
+            if old < sequence:
+                os.remove(self._path(old, "log"))
+
+    def close(self):
+        self.commit()
+        self._close_segment()
+
+    def _open_segment(self):
+        self._file = open(self._path(self._sequence, "log"), "ab")
+        self._segment_bytes = self._file.tell()
+
+    def _close_segment(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._sequence += 1
+
+    def _path(self, sequence, extension):
+        return os.path.join(self.directory, "%016d.%s" % (sequence, extension))
+
+    def _sequences(self, pattern):
+        sequences = []
+        for name in os.listdir(self.directory):
+            match = pattern.match(name)
+            if match:
+                sequences.append(int(match.group(1)))
+        return sorted(sequences)
+
+    def _read(self, path):
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                position = 0
+                while position < len(data):
+                    entry, position = _decode(data, position)
+                    if entry is None:
+                        logger.warning("Ignoring corrupted end of %s at byte %s.", path, position)
+                        break
+                    yield entry
+            finally:
+                data.close()
+
+
+def _encode(type, record_id, record_version, idepo, time, data):
+    record_id = record_id.encode("utf-8")
+    idepo = idepo.encode("utf-8")
+    if isinstance(data, bytes):
+        flags = 0
+    else:
+        data = data.encode("utf-8")
+        flags = _TEXT
+    seconds = (time - _EPOCH).total_seconds()
+    header = _HEADER.pack(0, type, flags, record_version, seconds, len(record_id), len(idepo), len(data))
+    body = header[4:] + record_id + idepo + data
+    return struct.pack("<I", zlib.crc32(body) & 0xffffffff) + body
+
+
+def _decode(data, position):
+    """
+    Returns the entry starting at `position` and the position of the next one,
+    or `(None, position)` if there is no valid entry.
+    """
+    if position + _HEADER.size > len(data):
+        return None, position
+    crc, type, flags, record_version, seconds, id_length, idepo_length, data_length = _HEADER.unpack_from(data, position)
+    end = position + _HEADER.size + id_length + idepo_length + data_length
+    if end > len(data):
+        return None, position
+    if zlib.crc32(data[position + 4:end]) & 0xffffffff != crc:
+        return None, position
+
+    offset = position + _HEADER.size
+    record_id = data[offset:offset + id_length].decode("utf-8")
+    offset += id_length
+    idepo = data[offset:offset + idepo_length].decode("utf-8")
+    offset += idepo_length
+    payload = data[offset:end]
+    if flags & _TEXT:
+        payload = payload.decode("utf-8")
+    time = _EPOCH + datetime.timedelta(seconds=seconds)
+
+    if type == TOUCH:
+        return LogEntry(TOUCH, record_id, record_version, None, time, None), end
+    else:
+        return LogEntry(PUT, record_id, record_version, idepo, time, payload), end